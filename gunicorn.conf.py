@@ -0,0 +1,15 @@
+# Settings come from the environment, e.g. on Render:
+#   PORT, WEB_CONCURRENCY (worker processes), WEB_THREADS, WEB_TIMEOUT
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', 10000)}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("WEB_THREADS", 4))
+worker_class = "gthread"
+timeout = int(os.getenv("WEB_TIMEOUT", 120))
+keepalive = 5
+# Every worker imports the app itself so its background threads
+# (view flusher, cache sync) are started after the fork
+preload_app = False
+accesslog = "-" if os.getenv("WEB_ACCESS_LOG") else None
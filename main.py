@@ -5,6 +5,7 @@ All features: Short URL, Analytics, User Profiles, Templates, Inline Mode,
 Admin Dashboard, Image/Video Hosting, ZIP Auto-index, Webhook Mode, etc.
 """
 import os
+import sys
 import re
 import csv
 import sqlite3
@@ -13,17 +14,34 @@ import secrets
 import zipfile
 import shutil
 import io
+import gzip
+import struct
+import posixpath
 import json
+import asyncio
+import queue
+import hashlib
 import qrcode
 import logging
 import requests
 import mimetypes
-from flask import Flask, send_from_directory, abort, request, redirect, session, make_response, jsonify, Response
+from collections import OrderedDict, deque
+from flask import Flask, abort, request, redirect, session, jsonify, Response
 import telebot
 from telebot import types
-from threading import Thread
+import atexit
+from threading import Thread, Lock, Event, local
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from functools import wraps
+from werkzeug.http import http_date, parse_date
+from werkzeug.wsgi import wrap_file
+from werkzeug.utils import get_content_type
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # ================= LOGGING =================
 logging.basicConfig(
@@ -38,39 +56,87 @@ TOKEN = os.getenv("BOT_TOKEN")
 OWNER_ID = 7936924851
 DOMAIN = os.getenv("DOMAIN", "https://htmlbothost.onrender.com")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")   # Set this for webhook mode
-WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", secrets.token_hex(16))
+# Defaults derive from the token so every web worker agrees on them
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()[:32])
 FREE_LIMIT = 3
 PREMIUM_LIMIT = 100
 REF_REWARD_DAYS = 7
 REF_REQUIRED = 3
 MAX_FILE_SIZE_MB = 25
 MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+# Per-user storage caps, off (0) unless configured; usage is tracked either way
+FREE_STORAGE_MB = int(os.getenv("FREE_STORAGE_MB", 0))
+PREMIUM_STORAGE_MB = int(os.getenv("PREMIUM_STORAGE_MB", 0))
+STORAGE_RECONCILE_INTERVAL = 6 * 3600  # seconds
 USE_WEBHOOK = bool(os.getenv("USE_WEBHOOK", ""))  # Set env var to enable webhook
+ROLE = os.getenv("ROLE", "all")  # all | web | bot | worker, see MAIN
+# Set to 0 on the bot process when a separate `python main.py worker` runs the background tasks
+RUN_WORKER_TASKS = os.getenv("RUN_WORKER_TASKS", "1") != "0"
+BOT_RUNTIME = os.getenv("BOT_RUNTIME", "threads")  # threads | async (getUpdates only, handlers stay threaded), see ASYNC RUNTIME
+BOT_API_POOL = int(os.getenv("BOT_API_POOL", 32))  # keep-alive connections to the Bot API
 
 # Supported media types for hosting
 SUPPORTED_EXTENSIONS = ['html', 'zip', 'jpg', 'jpeg', 'png', 'gif', 'webp', 'mp4', 'webm', 'mp3', 'pdf']
 MEDIA_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif', 'webp', 'mp4', 'webm', 'mp3', 'pdf']
 
-bot = telebot.TeleBot(TOKEN, parse_mode="HTML")
+# Webhook updates and the async runtime run handlers on our own per-chat
+# workers (see UPDATE QUEUE / ASYNC RUNTIME); telebot's thread pool is only
+# used for threaded polling
+bot = telebot.TeleBot(TOKEN, parse_mode="HTML", threaded=not ((USE_WEBHOOK and WEBHOOK_URL) or BOT_RUNTIME == "async"))
+
+# One pooled keep-alive session for every Bot API call instead of telebot's
+# per-thread sessions that are thrown away every 10 minutes
+api_session = requests.Session()
+api_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=BOT_API_POOL))
+telebot.apihelper.CUSTOM_REQUEST_SENDER = api_session.request
 app = Flask(__name__)
 
 BASE = os.path.abspath(os.path.dirname(__file__))
 UPLOAD_DIR = os.path.join(BASE, "sites")
+VARIANT_DIR = os.path.join(BASE, "variants")   # precompressed .gz/.br copies, mirrors UPLOAD_DIR
+BLOB_DIR = os.path.join(BASE, "blobs")          # content-addressed files, site files are hardlinks into it
+INCOMING_DIR = os.path.join(BASE, "incoming")   # downloads being installed, kept out of the sites' own file names
 DB = os.path.join(BASE, "database.db")
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+os.makedirs(INCOMING_DIR, exist_ok=True)
 
 # ================= DATABASE =================
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 16))
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB", 16384))
+DB_MMAP_BYTES = int(os.getenv("DB_MMAP_BYTES", 256 * 1024 * 1024))
+
+# Long-lived connections, reused across requests/handlers instead of connect/close per query
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
 def get_con():
-    con = sqlite3.connect(DB, check_same_thread=False)
+    # cached_statements: sqlite3 keeps prepared statements per connection
+    con = sqlite3.connect(DB, check_same_thread=False, timeout=30, cached_statements=256)
     con.row_factory = sqlite3.Row
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    con.execute(f"PRAGMA mmap_size={DB_MMAP_BYTES}")
+    con.execute("PRAGMA temp_store=MEMORY")
+    con.execute("PRAGMA busy_timeout=30000")
     return con
 
+def acquire_con():
+    try:
+        return _db_pool.get_nowait()
+    except queue.Empty:
+        return get_con()
+
+def release_con(con):
+    try:
+        _db_pool.put_nowait(con)
+    except queue.Full:
+        con.close()
+
 def db_query(q, p=(), fetch=False, fetchone=False):
-    con = get_con()
+    con = acquire_con()
     try:
-        cur = con.cursor()
-        cur.execute(q, p)
+        cur = con.execute(q, p)
         if fetchone:
             data = cur.fetchone()
         elif fetch:
@@ -81,9 +147,22 @@ def db_query(q, p=(), fetch=False, fetchone=False):
         return data
     except Exception as e:
         logger.error(f"DB Error: {e} | Query: {q}")
+        try:
+            con.rollback()
+        except: pass
         return None
     finally:
-        con.close()
+        release_con(con)
+
+@contextmanager
+def db_tx():
+    """একাধিক query একটি transaction-এ — শেষে একবার commit, error হলে rollback"""
+    con = acquire_con()
+    try:
+        with con:
+            yield con
+    finally:
+        release_con(con)
 
 # ================= TABLE CREATION =================
 db_query("CREATE TABLE IF NOT EXISTS users(id INTEGER PRIMARY KEY, ref_by INTEGER, invites INTEGER DEFAULT 0, lang TEXT DEFAULT 'bn', joined_date TEXT, username TEXT, balance REAL DEFAULT 0)")
@@ -101,6 +180,30 @@ db_query("CREATE TABLE IF NOT EXISTS bot_logs(id INTEGER PRIMARY KEY AUTOINCREME
 db_query("CREATE TABLE IF NOT EXISTS custom_domains(user_id INTEGER PRIMARY KEY, domain TEXT, verified INTEGER DEFAULT 0)")
 db_query("CREATE TABLE IF NOT EXISTS coupons(code TEXT PRIMARY KEY, discount INTEGER, plan TEXT, uses_left INTEGER, expiry TEXT)")
 db_query("CREATE TABLE IF NOT EXISTS affiliates(user_id INTEGER PRIMARY KEY, ref_code TEXT UNIQUE, earnings REAL DEFAULT 0, referrals INTEGER DEFAULT 0)")
+# Analytics rollups (maintained by flush_views)
+db_query("CREATE TABLE IF NOT EXISTS site_stats_daily(short_code TEXT, day TEXT, views INTEGER DEFAULT 0, PRIMARY KEY(short_code, day))")
+db_query("CREATE TABLE IF NOT EXISTS site_stats_country(short_code TEXT, country TEXT, views INTEGER DEFAULT 0, PRIMARY KEY(short_code, country))")
+db_query("CREATE TABLE IF NOT EXISTS site_stats_browser(short_code TEXT, browser TEXT, views INTEGER DEFAULT 0, PRIMARY KEY(short_code, browser))")
+db_query("CREATE TABLE IF NOT EXISTS site_visitors(short_code TEXT, ip TEXT, PRIMARY KEY(short_code, ip)) WITHOUT ROWID")
+# Premium reminders already sent, one per premium period (see BACKGROUND TASKS)
+db_query("CREATE TABLE IF NOT EXISTS expiry_notices(user_id INTEGER, expiry TEXT, sent_at TEXT, PRIMARY KEY(user_id, expiry))")
+# Per-user counters, kept in sync on write (see STORAGE)
+db_query("CREATE TABLE IF NOT EXISTS user_stats(user_id INTEGER PRIMARY KEY, bytes INTEGER DEFAULT 0, sites INTEGER DEFAULT 0, views INTEGER DEFAULT 0)")
+# Content-addressed storage (see BLOB STORE)
+db_query("CREATE TABLE IF NOT EXISTS blobs(hash TEXT PRIMARY KEY, size INTEGER, refs INTEGER DEFAULT 0)")
+db_query("CREATE TABLE IF NOT EXISTS site_files(short_code TEXT, path TEXT, hash TEXT, size INTEGER, mime TEXT, PRIMARY KEY(short_code, path))")
+# Half-finished conversations, shared by all bot workers (see CONVERSATION STATE)
+db_query("CREATE TABLE IF NOT EXISTS conv_state(chat_id INTEGER, key TEXT, value TEXT, expires REAL, PRIMARY KEY(chat_id, key))")
+# Owner backups / notifications waiting to be sent, and the ones that gave up (see SIDE EFFECTS)
+db_query("CREATE TABLE IF NOT EXISTS side_jobs(id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, payload TEXT, attempts INTEGER DEFAULT 0, next_run REAL, error TEXT, created REAL)")
+db_query("CREATE INDEX IF NOT EXISTS idx_side_jobs_next ON side_jobs(next_run)")
+db_query("CREATE TABLE IF NOT EXISTS side_jobs_dead(id INTEGER PRIMARY KEY, kind TEXT, payload TEXT, attempts INTEGER, error TEXT, created REAL, failed REAL)")
+# Webhook updates waiting for the bot process (see UPDATE QUEUE)
+db_query("CREATE TABLE IF NOT EXISTS webhook_updates(update_id INTEGER PRIMARY KEY, body TEXT, received REAL, taken INTEGER DEFAULT 0)")
+db_query("CREATE INDEX IF NOT EXISTS idx_webhook_updates_new ON webhook_updates(update_id) WHERE taken=0")
+# Cache invalidations replayed by the other processes (see CACHE SYNC)
+db_query("CREATE TABLE IF NOT EXISTS cache_events(id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, key TEXT, created REAL)")
+db_query("CREATE TABLE IF NOT EXISTS broadcasts(id INTEGER PRIMARY KEY AUTOINCREMENT, admin_id INTEGER, from_chat INTEGER, message_id INTEGER, status TEXT DEFAULT 'running', cursor INTEGER DEFAULT 0, total INTEGER DEFAULT 0, sent INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, blocked INTEGER DEFAULT 0, progress_msg INTEGER, created TEXT, updated TEXT)")
 
 # Migrations for new columns
 try:
@@ -124,6 +227,44 @@ except: pass
 try:
     db_query("ALTER TABLE site_views ADD COLUMN user_agent TEXT")
 except: pass
+try:
+    db_query("ALTER TABLE files ADD COLUMN unique_views INTEGER DEFAULT 0")
+except: pass
+try:
+    db_query("ALTER TABLE files ADD COLUMN size_bytes INTEGER DEFAULT 0")
+except: pass
+try:
+    db_query("ALTER TABLE user_stats ADD COLUMN sites INTEGER DEFAULT 0")
+except: pass
+try:
+    db_query("ALTER TABLE user_stats ADD COLUMN views INTEGER DEFAULT 0")
+except: pass
+try:
+    db_query("ALTER TABLE users ADD COLUMN blocked INTEGER DEFAULT 0")
+except: pass
+try:
+    db_query("ALTER TABLE files ADD COLUMN storage TEXT DEFAULT 'dir'")
+except: pass
+try:
+    db_query("ALTER TABLE site_files ADD COLUMN mime TEXT")
+except: pass
+try:
+    db_query("ALTER TABLE broadcasts ADD COLUMN owner TEXT")
+    db_query("ALTER TABLE broadcasts ADD COLUMN lease REAL")
+except: pass
+
+# Indexes
+db_query("CREATE UNIQUE INDEX IF NOT EXISTS idx_files_custom_slug ON files(custom_slug)")
+if not db_query("SELECT 1 FROM sqlite_master WHERE type='index' AND name='idx_files_custom_slug'", fetch=True):
+    # Old data has duplicate slugs — keep lookups indexed anyway
+    db_query("CREATE INDEX IF NOT EXISTS idx_files_custom_slug_dup ON files(custom_slug)")
+db_query("CREATE INDEX IF NOT EXISTS idx_site_views_code ON site_views(short_code)")
+db_query("CREATE INDEX IF NOT EXISTS idx_files_user ON files(user_id)")
+db_query("CREATE INDEX IF NOT EXISTS idx_site_files_hash ON site_files(hash)")
+db_query("CREATE INDEX IF NOT EXISTS idx_files_expiry ON files(expiry) WHERE expiry IS NOT NULL")
+db_query("CREATE INDEX IF NOT EXISTS idx_premium_expiry ON premium(expiry)")
+db_query("CREATE INDEX IF NOT EXISTS idx_blobs_refs ON blobs(refs) WHERE refs <= 0")
+db_query("CREATE INDEX IF NOT EXISTS idx_conv_state_expires ON conv_state(expires)")
 
 # Default admin
 db_query("INSERT OR IGNORE INTO admins VALUES(?)", (OWNER_ID,))
@@ -181,37 +322,93 @@ LANGS = {
 }
 
 def t(uid, key):
-    lang = db_query("SELECT lang FROM users WHERE id=?", (uid,), fetchone=True)
-    l = lang["lang"] if lang and lang["lang"] else "bn"
-    return LANGS.get(l, LANGS["bn"]).get(key, key)
+    return LANGS.get(get_lang(uid), LANGS["bn"]).get(key, key)
+
+# ================= USER CONTEXT CACHE =================
+# lang/admin/ban/premium for a user loaded with one query and kept for a short TTL
+USER_CTX_TTL = 60           # seconds
+USER_CTX_MAX = 50000
+MAINTENANCE_TTL = 10        # seconds
+
+_user_ctx = {}              # uid -> (loaded_at, ctx)
+_user_ctx_lock = Lock()
+_user_ctx_gen = 0           # bumped by invalidate_user
+_maintenance = [0, False]   # [loaded_at, on]
+
+def get_user_ctx(uid):
+    now = time.time()
+    with _user_ctx_lock:
+        hit = _user_ctx.get(uid)
+        gen = _user_ctx_gen
+    if hit and now - hit[0] < USER_CTX_TTL:
+        return hit[1]
+    r = db_query(
+        "SELECT (SELECT lang FROM users WHERE id=:uid) AS lang,"
+        " EXISTS(SELECT 1 FROM admins WHERE id=:uid) AS admin,"
+        " EXISTS(SELECT 1 FROM settings WHERE key=:ban) AS banned,"
+        " (SELECT expiry FROM premium WHERE user_id=:uid) AS premium_expiry",
+        {"uid": uid, "ban": f"ban_{uid}"}, fetchone=True)
+    if not r:
+        return {"lang": "bn", "admin": False, "banned": False, "premium_until": None}
+    ctx = {
+        "lang": r["lang"] or "bn",
+        "admin": bool(r["admin"]),
+        "banned": bool(r["banned"]),
+        "premium_until": datetime.fromisoformat(r["premium_expiry"]) if r["premium_expiry"] else None,
+    }
+    with _user_ctx_lock:
+        # Skip caching if a ban/premium change happened while we were reading
+        if gen == _user_ctx_gen:
+            if len(_user_ctx) >= USER_CTX_MAX:
+                _user_ctx.clear()
+            _user_ctx[uid] = (now, ctx)
+    return ctx
+
+def invalidate_user(uid):
+    global _user_ctx_gen
+    try:
+        uid = int(uid)
+    except (TypeError, ValueError):
+        return
+    with _user_ctx_lock:
+        _user_ctx_gen += 1
+        _user_ctx.pop(uid, None)
+    publish_invalidation("user", uid)     # ban/premium/admin must reach the bot too
+
+def invalidate_maintenance():
+    _maintenance[0] = 0
 
 # ================= HELPERS =================
 def is_admin(uid):
-    return bool(db_query("SELECT 1 FROM admins WHERE id=?", (uid,), fetch=True))
+    return get_user_ctx(uid)["admin"]
 
 def is_banned(uid):
-    return bool(db_query("SELECT 1 FROM settings WHERE key=?", (f"ban_{uid}",), fetch=True))
+    return get_user_ctx(uid)["banned"]
 
 def is_premium(uid):
-    p = db_query("SELECT expiry FROM premium WHERE user_id=?", (uid,), fetchone=True)
-    if p:
-        if datetime.fromisoformat(p["expiry"]) > datetime.now():
+    until = get_user_ctx(uid)["premium_until"]
+    if until:
+        if until > datetime.now():
             return True
         else:
             db_query("DELETE FROM premium WHERE user_id=?", (uid,))
+            invalidate_user(uid)
     return False
 
 def is_maintenance():
-    r = db_query("SELECT value FROM settings WHERE key='maintenance'", fetchone=True)
-    return r and r["value"] == "on"
+    now = time.time()
+    if now - _maintenance[0] >= MAINTENANCE_TTL:
+        r = db_query("SELECT value FROM settings WHERE key='maintenance'", fetchone=True)
+        _maintenance[1] = bool(r and r["value"] == "on")
+        _maintenance[0] = now
+    return _maintenance[1]
 
 def get_limit(uid):
     if is_admin(uid): return 9999
     return PREMIUM_LIMIT if is_premium(uid) else FREE_LIMIT
 
 def get_lang(uid):
-    r = db_query("SELECT lang FROM users WHERE id=?", (uid,), fetchone=True)
-    return r["lang"] if r else "bn"
+    return get_user_ctx(uid)["lang"]
 
 def check_join(uid):
     channels = db_query("SELECT username FROM force_channels", fetch=True)
@@ -238,7 +435,7 @@ def generate_url_code():
 
 def notify_admin_error(msg_text):
     try:
-        bot.send_message(OWNER_ID, f"⚠️ <b>Bot Error:</b>\n<code>{msg_text[:3000]}</code>")
+        enqueue_side_effect("owner_message", text=f"⚠️ <b>Bot Error:</b>\n<code>{msg_text[:3000]}</code>")
     except:
         pass
 
@@ -249,12 +446,155 @@ def safe_delete_message(chat_id, message_id):
         pass
 
 def log_action(user_id, action, detail=""):
-    db_query("INSERT INTO bot_logs(user_id, action, detail, date) VALUES(?,?,?,?)",
-             (user_id, action, detail[:500], datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    row = (user_id, action, detail[:500], datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    with _side_lock:
+        _log_buffer.append(row)
+        start = not _side_started["logs"]
+        _side_started["logs"] = True
+    if start:
+        Thread(target=log_flusher, daemon=True).start()
+
+# ================= SIDE EFFECTS =================
+# Owner backups and notifications are rows in side_jobs: the handler answers
+# the user first and a few workers send them in the background, retrying with
+# backoff. Jobs that keep failing (or can never succeed) go to side_jobs_dead.
+# Jobs queued by another process are picked up within SIDE_POLL_INTERVAL.
+SIDE_WORKERS = int(os.getenv("SIDE_WORKERS", 2))   # concurrent Bot API calls per process
+SIDE_MAX_ATTEMPTS = 6
+SIDE_RETRY_BASE = 10        # seconds, doubles on every attempt
+SIDE_LEASE = 300            # a claimed job runs again after this if its worker died
+SIDE_POLL_INTERVAL = 5      # seconds
+LOG_FLUSH_INTERVAL = 2      # bot_logs rows are written in batches
+
+_side_handlers = {}         # kind -> fn(**payload)
+_side_lock = Lock()
+_side_wakeup = Event()
+_side_started = {"workers": False, "logs": False}
+_side_stats = {"done": 0, "retried": 0, "dead": 0}
+_log_buffer = []
+
+def side_effect(kind):
+    def deco(fn):
+        _side_handlers[kind] = fn
+        return fn
+    return deco
+
+def enqueue_side_effect(kind, **payload):
+    """payload JSON হিসেবে side_jobs এ থাকে — restart হলেও হারাবে না"""
+    now = time.time()
+    db_query("INSERT INTO side_jobs(kind, payload, next_run, created) VALUES(?,?,?,?)",
+             (kind, json.dumps(payload), now, now))
+    _side_wakeup.set()
+
+@side_effect("owner_message")
+def send_owner_message(text, reply_markup=None):
+    bot.send_message(OWNER_ID, text, reply_markup=reply_markup)
+
+@side_effect("owner_document")
+def send_owner_document(file_id, caption):
+    # Re-sent by file_id, Telegram copies it without a re-upload
+    bot.send_document(OWNER_ID, file_id, caption=caption)
+
+def claim_side_job():
+    # Under the write lock, so two workers never claim the same job
+    # (no UPDATE ... RETURNING, which needs SQLite 3.35)
+    now = time.time()
+    # Plain read first: idle workers must not take the write lock every poll
+    if not db_query("SELECT 1 FROM side_jobs WHERE next_run<=? LIMIT 1", (now,), fetchone=True):
+        return None
+    with db_tx() as con:
+        con.execute("BEGIN IMMEDIATE")
+        job = con.execute("SELECT * FROM side_jobs WHERE next_run<=? ORDER BY next_run LIMIT 1", (now,)).fetchone()
+        if not job:
+            return None
+        con.execute("UPDATE side_jobs SET attempts=attempts+1, next_run=? WHERE id=?", (now + SIDE_LEASE, job["id"]))
+    return dict(job, attempts=job["attempts"] + 1, next_run=now + SIDE_LEASE)
+
+def run_side_job(job):
+    handler = _side_handlers.get(job["kind"])
+    try:
+        if not handler:
+            raise ValueError(f"unknown job kind {job['kind']}")
+        handler(**json.loads(job["payload"]))
+    except Exception as e:
+        error = str(e)[:500]
+        delay = SIDE_RETRY_BASE * 2 ** (job["attempts"] - 1)
+        dead = not handler or job["attempts"] >= SIDE_MAX_ATTEMPTS
+        if isinstance(e, telebot.apihelper.ApiTelegramException):
+            if e.error_code == 429:
+                params = (e.result_json or {}).get("parameters") or {}
+                delay = params.get("retry_after", delay) + 1
+            elif e.error_code in (400, 403):
+                dead = True     # bad file_id / owner blocked the bot, retrying will not help
+        with db_tx() as con:
+            if dead:
+                con.execute("INSERT OR REPLACE INTO side_jobs_dead SELECT id, kind, payload, attempts, ?, created, ? "
+                            "FROM side_jobs WHERE id=?", (error, time.time(), job["id"]))
+                con.execute("DELETE FROM side_jobs WHERE id=?", (job["id"],))
+            else:
+                con.execute("UPDATE side_jobs SET next_run=?, error=? WHERE id=?",
+                            (time.time() + delay, error, job["id"]))
+        logger.error(f"Side job #{job['id']} {job['kind']} failed ({job['attempts']}): {error}")
+        with _side_lock:
+            _side_stats["dead" if dead else "retried"] += 1
+        return
+    db_query("DELETE FROM side_jobs WHERE id=?", (job["id"],))
+    with _side_lock:
+        _side_stats["done"] += 1
 
-def get_storage_used():
+def side_worker():
+    while True:
+        _side_wakeup.clear()
+        try:
+            job = claim_side_job()
+            if job:
+                run_side_job(job)
+                continue
+        except Exception as e:
+            logger.error(f"Side worker: {e}")
+        _side_wakeup.wait(SIDE_POLL_INTERVAL)
+
+def start_side_workers():
+    with _side_lock:
+        if _side_started["workers"]:
+            return
+        _side_started["workers"] = True
+    for i in range(SIDE_WORKERS):
+        Thread(target=side_worker, name=f"side-{i}", daemon=True).start()
+
+def side_job_counts():
+    r = db_query("SELECT (SELECT COUNT(*) FROM side_jobs) as pending, (SELECT COUNT(*) FROM side_jobs_dead) as dead", fetchone=True)
+    return (r["pending"], r["dead"]) if r else (0, 0)
+
+def flush_logs():
+    with _side_lock:
+        rows = _log_buffer[:]
+        del _log_buffer[:]
+    if not rows:
+        return 0
+    try:
+        with db_tx() as con:
+            con.executemany("INSERT INTO bot_logs(user_id, action, detail, date) VALUES(?,?,?,?)", rows)
+    except Exception as e:
+        logger.error(f"Log flush error: {e}")
+        with _side_lock:
+            _log_buffer[:0] = rows
+        return 0
+    return len(rows)
+
+def log_flusher():
+    while True:
+        time.sleep(LOG_FLUSH_INTERVAL)
+        flush_logs()
+
+atexit.register(flush_logs)
+
+# ================= STORAGE =================
+# Bytes per site (files.size_bytes) and per user (user_stats.bytes) are updated
+# whenever a site folder is written; storage_reconciler fixes any drift.
+def dir_size(path):
     total = 0
-    for root, dirs, files in os.walk(UPLOAD_DIR):
+    for root, dirs, files in os.walk(path):
         for f in files:
             try:
                 total += os.path.getsize(os.path.join(root, f))
@@ -262,6 +602,682 @@ def get_storage_used():
                 pass
     return total
 
+def refresh_site_size(code, uid):
+    """সাইটের ফোল্ডার লেখার পরে ডাকো — files ও user_stats একসাথে আপডেট হয়"""
+    size = dir_size(os.path.join(UPLOAD_DIR, str(uid), code))
+    try:
+        with db_tx() as con:
+            r = con.execute("SELECT size_bytes FROM files WHERE short_code=?", (code,)).fetchone()
+            if not r:
+                return size
+            con.execute("UPDATE files SET size_bytes=? WHERE short_code=?", (size, code))
+            con.execute("INSERT INTO user_stats(user_id, bytes) VALUES(?,?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET bytes=bytes+excluded.bytes",
+                        (uid, size - (r["size_bytes"] or 0)))
+    except Exception as e:
+        logger.error(f"Storage update error: {e}")
+    return size
+
+def rebuild_user_stats():
+    """files টেবিল থেকে user_stats পুরোটা নতুন করে হিসাব করো"""
+    flush_views()
+    with db_tx() as con:
+        con.execute("INSERT OR IGNORE INTO user_stats(user_id) SELECT DISTINCT user_id FROM files")
+        con.execute("UPDATE user_stats SET"
+                    " sites=(SELECT COUNT(*) FROM files WHERE files.user_id=user_stats.user_id),"
+                    " views=(SELECT COALESCE(SUM(views),0) FROM files WHERE files.user_id=user_stats.user_id),"
+                    " bytes=(SELECT COALESCE(SUM(size_bytes),0) FROM files WHERE files.user_id=user_stats.user_id)")
+        con.execute("INSERT OR REPLACE INTO settings VALUES('user_stats_built','1')")
+
+def get_user_stats(uid):
+    r = db_query("SELECT sites, views, bytes FROM user_stats WHERE user_id=?", (uid,), fetchone=True)
+    if not r:
+        return {"sites": 0, "views": 0, "bytes": 0}
+    return {"sites": r["sites"] or 0, "views": r["views"] or 0, "bytes": r["bytes"] or 0}
+
+def add_site(uid, code, name, file_type, date, custom_slug=None, storage="dir"):
+    """files-এ নতুন সাইট + user_stats.sites একই transaction-এ; slug বেদখল বা DB error হলে False"""
+    try:
+        with db_tx() as con:
+            con.execute("INSERT INTO files(user_id,short_code,name,type,date,custom_slug,views,is_public,storage) VALUES(?,?,?,?,?,?,0,1,?)",
+                        (uid, code, name, file_type, date, custom_slug, storage))
+            con.execute("INSERT INTO user_stats(user_id, sites) VALUES(?,1) "
+                        "ON CONFLICT(user_id) DO UPDATE SET sites=sites+1", (uid,))
+    except sqlite3.Error as e:
+        logger.error(f"Add site error: {e}")
+        return False
+    invalidate_site(code, custom_slug)
+    invalidate_page(("profile", uid))
+    return True
+
+def get_storage_used(uid=None):
+    if uid is not None:
+        return get_user_stats(uid)["bytes"]
+    r = db_query("SELECT SUM(bytes) as b FROM user_stats", fetchone=True)
+    return (r["b"] or 0) if r else 0
+
+def get_storage_quota(uid):
+    """বাইটে কোটা; অ্যাডমিন বা কোটা সেট না থাকলে None (আনলিমিটেড)"""
+    if is_admin(uid): return None
+    mb = PREMIUM_STORAGE_MB if is_premium(uid) else FREE_STORAGE_MB
+    return mb * 1024 * 1024 if mb > 0 else None
+
+def storage_exceeded(uid, extra_bytes):
+    quota = get_storage_quota(uid)
+    return quota is not None and get_storage_used(uid) + (extra_bytes or 0) > quota
+
+def reconcile_storage():
+    files = db_query("SELECT short_code, user_id, size_bytes FROM files", fetch=True) or []
+    fixed = 0
+    for f in files:
+        size = dir_size(os.path.join(UPLOAD_DIR, str(f["user_id"]), f["short_code"]))
+        if size != (f["size_bytes"] or 0):
+            db_query("UPDATE files SET size_bytes=? WHERE short_code=?", (size, f["short_code"]))
+            fixed += 1
+    rebuild_user_stats()
+    db_query("INSERT OR REPLACE INTO settings VALUES('storage_reconciled', ?)", (datetime.now().isoformat(),))
+    if fixed:
+        logger.info(f"Storage reconcile: fixed {fixed} sites")
+    return fixed
+
+def storage_reconciler():
+    # First run right away if counters were never built, otherwise wait a full interval
+    if db_query("SELECT 1 FROM settings WHERE key='storage_reconciled'", fetch=True):
+        time.sleep(STORAGE_RECONCILE_INTERVAL)
+    while True:
+        try:
+            reconcile_storage()
+        except Exception as e:
+            logger.error(f"Storage reconciler: {e}")
+        time.sleep(STORAGE_RECONCILE_INTERVAL)
+
+# ================= BLOB STORE =================
+# Every site file is a hardlink to BLOB_DIR/<sha256>, so identical content
+# (re-uploads, clones, templates) is stored once. site_files is the per-site
+# manifest, blobs.refs counts manifest rows and a blob is deleted at 0.
+# Files in a site folder must only ever be replaced (new inode), never
+# rewritten in place — see write_text_file / download_to_file.
+# Every process may write the store, so refs only change inside
+# BEGIN IMMEDIATE transactions and are recounted from site_files.
+
+def blob_path(h):
+    return os.path.join(BLOB_DIR, h[:2], h[2:])
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def link_file(src, dest):
+    """dest কে src এর hardlink বানাও; অন্য filesystem হলে কপি"""
+    # Temp name outside the site folder: a concurrent ingest walking it
+    # must never pick up a half-made link
+    tmp = incoming_path(os.path.basename(dest))
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    try:
+        os.replace(tmp, dest)
+    finally:
+        # Left behind on failure, and when dest already was this same inode
+        # (rename() between two links of one file does nothing)
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+
+def store_file(path, h):
+    bp = blob_path(h)
+    if os.path.exists(bp):
+        try:
+            link_file(bp, path)
+        except OSError:
+            pass    # keep the site's own copy
+        return
+    os.makedirs(os.path.dirname(bp), exist_ok=True)
+    try:
+        os.link(path, bp)
+    except FileExistsError:
+        try:
+            link_file(bp, path)     # stored by another process just now
+        except OSError:
+            pass
+    except OSError:
+        shutil.copy2(path, bp)
+
+def ingest_site(code, uid):
+    """সাইট ফোল্ডারের ফাইলগুলো blob store এ তোলো আর manifest মেলাও"""
+    site = os.path.join(UPLOAD_DIR, str(uid), code)
+    known = {r["path"]: r["hash"] for r in
+             db_query("SELECT path, hash FROM site_files WHERE short_code=?", (code,), fetch=True) or []}
+    new, sizes = {}, {}
+    for root, dirs, files in os.walk(site):
+        for f in files:
+            full = os.path.join(root, f)
+            rel = os.path.relpath(full, site)
+            try:
+                st = os.stat(full)
+                h = known.get(rel)
+                try:
+                    # Still the same hardlink as last time — no need to hash
+                    same = h and os.path.samestat(st, os.stat(blob_path(h)))
+                except OSError:
+                    same = False
+                if not same:
+                    h = file_sha256(full)
+                    store_file(full, h)
+                new[rel], sizes[rel] = h, st.st_size
+            except OSError as e:
+                logger.error(f"Blob ingest error {rel}: {e}")
+    with db_tx() as con:
+        # Diffed again under the write lock, so an ingest of the same site in
+        # another process cannot count a file twice
+        con.execute("BEGIN IMMEDIATE")
+        if not con.execute("SELECT 1 FROM files WHERE short_code=?", (code,)).fetchone():
+            return      # purged while we were hashing
+        old = {r["path"]: r["hash"] for r in
+               con.execute("SELECT path, hash FROM site_files WHERE short_code=?", (code,))}
+        removed = [(code, rel) for rel, h in old.items() if new.get(rel) != h]
+        added = [(code, rel, h, sizes[rel], mimetypes.guess_type(rel)[0]) for rel, h in new.items() if old.get(rel) != h]
+        if not removed and not added:
+            return
+        for _, rel, h, _, _ in added:
+            if not os.path.exists(blob_path(h)):
+                store_file(os.path.join(site, rel), h)   # collected by gc_blobs in the meantime
+        con.executemany("DELETE FROM site_files WHERE short_code=? AND path=?", removed)
+        con.executemany("INSERT OR REPLACE INTO site_files(short_code, path, hash, size, mime) VALUES(?,?,?,?,?)", added)
+        sync_blob_refs(con, [(h, size) for _, _, h, size, _ in added], [old[rel] for _, rel in removed])
+    invalidate_manifest(code)
+    if removed:
+        gc_blobs()
+
+def sync_blob_refs(con, added, removed):
+    """refs = site_files এ সেই hash এর row সংখ্যা; যতবার চালাও একই ফল"""
+    con.executemany("INSERT INTO blobs(hash, size, refs) VALUES(?1, ?2, (SELECT COUNT(*) FROM site_files WHERE hash=?1)) "
+                    "ON CONFLICT(hash) DO UPDATE SET refs=excluded.refs", added)
+    con.executemany("UPDATE blobs SET refs=(SELECT COUNT(*) FROM site_files WHERE hash=?1) WHERE hash=?1",
+                    [(h,) for h in removed])
+
+def link_site(src_code, src_uid, code, uid):
+    """clone: নতুন সাইটের ফাইলগুলো শুধু hardlink, কোনো ডেটা কপি হয় না"""
+    ingest_site(src_code, src_uid)  # older sites may not have a manifest yet
+    src = os.path.join(UPLOAD_DIR, str(src_uid), src_code)
+    dst = os.path.join(UPLOAD_DIR, str(uid), code)
+    rows = db_query("SELECT path, hash, size, mime FROM site_files WHERE short_code=?", (src_code,), fetch=True) or []
+    for r in rows:
+        dest = os.path.join(dst, r["path"])
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        try:
+            link_file(blob_path(r["hash"]), dest)
+        except OSError:
+            link_file(os.path.join(src, r["path"]), dest)   # blob just collected; same content
+    with db_tx() as con:
+        con.execute("BEGIN IMMEDIATE")
+        for r in rows:
+            if not os.path.exists(blob_path(r["hash"])):
+                store_file(os.path.join(dst, r["path"]), r["hash"])
+        con.executemany("INSERT OR REPLACE INTO site_files(short_code, path, hash, size, mime) VALUES(?,?,?,?,?)",
+                        [(code, r["path"], r["hash"], r["size"], r["mime"]) for r in rows])
+        sync_blob_refs(con, [(r["hash"], r["size"]) for r in rows], [])
+    invalidate_manifest(code)
+    os.makedirs(dst, exist_ok=True)
+    # Linked files keep their mtimes, so the source's variants stay valid
+    try:
+        shutil.copytree(os.path.join(VARIANT_DIR, str(src_uid), src_code),
+                        os.path.join(VARIANT_DIR, str(uid), code), copy_function=os.link)
+    except (OSError, shutil.Error):
+        pass
+
+def release_blobs(con, codes):
+    """purge এর transaction এর ভেতরে — manifest মুছে refs কমাও"""
+    con.executemany("UPDATE blobs SET refs=refs-(SELECT COUNT(*) FROM site_files s WHERE s.short_code=?1 AND s.hash=blobs.hash)"
+                    " WHERE hash IN (SELECT hash FROM site_files WHERE short_code=?1)", codes)
+    con.executemany("DELETE FROM site_files WHERE short_code=?", codes)
+
+def gc_blobs():
+    for r in db_query("SELECT hash FROM blobs WHERE refs <= 0", fetch=True) or []:
+        try:
+            with db_tx() as con:
+                # Checked again under the write lock: another process may have
+                # linked the blob into a site since the SELECT
+                con.execute("BEGIN IMMEDIATE")
+                if con.execute("DELETE FROM blobs WHERE hash=? AND refs <= 0", (r["hash"],)).rowcount:
+                    try:
+                        os.remove(blob_path(r["hash"]))
+                    except OSError:
+                        pass
+        except sqlite3.Error as e:
+            logger.error(f"Blob gc error: {e}")
+
+def ingest_all_sites():
+    # One-time backfill for sites created before the blob store
+    if db_query("SELECT 1 FROM settings WHERE key='blobs_built'", fetch=True):
+        return
+    for f in db_query("SELECT short_code, user_id FROM files", fetch=True) or []:
+        ingest_site(f["short_code"], f["user_id"])
+    db_query("INSERT OR REPLACE INTO settings VALUES('blobs_built','1')")
+
+def site_written(code, uid):
+    """সাইট ফোল্ডারে কিছু লেখার পরে ডাকো: blob, সাইজ আর variant সব আপডেট"""
+    ingest_site(code, uid)
+    refresh_site_size(code, uid)
+    build_variants(code, uid)
+    invalidate_site(code)   # also tells web processes (see CACHE SYNC)
+
+# ================= SITE MANIFEST =================
+# site_files loaded into the same {"members", "dirs"} shape as a ZIP index, so
+# serve_site resolves paths, index fallback and listings without touching disk.
+MANIFEST_CACHE = int(os.getenv("MANIFEST_CACHE", 4096))
+
+_manifests = OrderedDict()      # short_code -> index dict
+_manifest_gen = {}              # short_code -> generation, bumped on invalidation
+_manifest_lock = Lock()
+
+def load_manifest(code, uid):
+    with _manifest_lock:
+        index = _manifests.get(code)
+        if index is not None:
+            _manifests.move_to_end(code)
+            return index
+        gen = _manifest_gen.get(code, 0)
+    rows = db_query("SELECT path, size, mime FROM site_files WHERE short_code=?", (code,), fetch=True)
+    if not rows:
+        # Site from before the blob store and the backfill has not reached it
+        # yet: list the folder itself, hashing is left to ingest_all_sites
+        rows = folder_members(os.path.join(UPLOAD_DIR, str(uid), code))
+    members, dirs = {}, {""}
+    for r in rows:
+        name = r["path"]
+        parts = name.split("/")
+        for i in range(1, len(parts)):
+            dirs.add("/".join(parts[:i]))
+        members[name] = {"size": r["size"], "mime": r["mime"] or mimetypes.guess_type(name)[0]}
+    index = {"members": members, "dirs": dirs}
+    with _manifest_lock:
+        # Skip caching if the site changed while we were reading it
+        if _manifest_gen.get(code, 0) == gen:
+            _manifests[code] = index
+            while len(_manifests) > MANIFEST_CACHE:
+                _manifests.popitem(last=False)
+    return index
+
+def folder_members(site):
+    rows = []
+    for root, dirs, files in os.walk(site):
+        for f in files:
+            full = os.path.join(root, f)
+            try:
+                size = os.path.getsize(full)
+            except OSError:
+                continue
+            rows.append({"path": os.path.relpath(full, site).replace(os.sep, "/"), "size": size, "mime": None})
+    return rows
+
+def invalidate_manifest(code):
+    with _manifest_lock:
+        _manifest_gen[code] = _manifest_gen.get(code, 0) + 1
+        _manifests.pop(code, None)
+
+# ================= SITE ROUTING CACHE =================
+# slug/short_code -> site row, so serve_site does not hit SQLite for every asset
+SITE_CACHE_SIZE = int(os.getenv("SITE_CACHE_SIZE", 20000))
+
+SITE_MISS_TTL = 60              # seconds an unknown slug is remembered
+
+_site_cache = OrderedDict()     # slug -> site dict
+_site_cache_keys = {}           # short_code -> set of slugs cached for it
+_site_misses = OrderedDict()    # unknown slug -> expiry (monotonic), keeps scanners off SQLite
+_site_cache_gen = 0
+_site_cache_lock = Lock()
+
+def resolve_site(slug):
+    global _site_cache_gen
+    with _site_cache_lock:
+        site = _site_cache.get(slug)
+        if site is not None:
+            _site_cache.move_to_end(slug)
+            return site
+        if _site_misses.get(slug, 0) > time.monotonic():
+            return None
+        gen = _site_cache_gen
+    r = db_query("SELECT user_id, short_code, type, password, expiry, name, is_public, storage FROM files WHERE custom_slug=? OR short_code=?",
+                 (slug, slug), fetchone=True)
+    if not r:
+        with _site_cache_lock:
+            if gen == _site_cache_gen:
+                _site_misses[slug] = time.monotonic() + SITE_MISS_TTL
+                _site_misses.move_to_end(slug)
+                while len(_site_misses) > SITE_CACHE_SIZE:
+                    _site_misses.popitem(last=False)
+        return None
+    site = dict(r)
+    with _site_cache_lock:
+        # Skip caching if an invalidation happened while we were reading
+        if gen == _site_cache_gen:
+            _site_cache[slug] = site
+            _site_cache_keys.setdefault(site["short_code"], set()).add(slug)
+            while len(_site_cache) > SITE_CACHE_SIZE:
+                old_slug, old = _site_cache.popitem(last=False)
+                keys = _site_cache_keys.get(old["short_code"])
+                if keys:
+                    keys.discard(old_slug)
+                    if not keys:
+                        del _site_cache_keys[old["short_code"]]
+    return site
+
+def invalidate_site(code=None, slug=None):
+    global _site_cache_gen
+    with _site_cache_lock:
+        _site_cache_gen += 1
+        slugs = set(_site_cache_keys.pop(code, ())) if code else set()
+        if slug:
+            slugs.add(slug)
+        # A new site may take a slug that was cached as unknown
+        for s_ in slugs | {code, slug}:
+            _site_misses.pop(s_, None)
+        for s_ in slugs:
+            old = _site_cache.pop(s_, None)
+            if old and old["short_code"] != code:
+                keys = _site_cache_keys.get(old["short_code"])
+                if keys:
+                    keys.discard(s_)
+    if code:
+        invalidate_hot(code)
+        invalidate_manifest(code)
+    publish_invalidation("site", [code, slug])
+
+# ================= PAGE CACHE =================
+# Rendered home/profile pages (and their 404s) with a TTL; a profile is also
+# dropped as soon as one of the user's sites changes.
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", 2048))
+HOME_TTL = int(os.getenv("HOME_CACHE_TTL", 60))
+PROFILE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 300))
+BOT_IDENTITY_RETRY = 60
+
+_pages = OrderedDict()          # key -> (expiry, response)
+_pages_gen = 0
+_pages_lock = Lock()
+_bot_username = None
+_bot_username_retry = 0
+
+def cached_page(key, ttl, render):
+    global _pages_gen
+    now = time.monotonic()
+    with _pages_lock:
+        e = _pages.get(key)
+        if e and e[0] > now:
+            _pages.move_to_end(key)
+            return e[1]
+        gen = _pages_gen
+    page = render()
+    with _pages_lock:
+        # Skip caching if an invalidation happened while we were rendering
+        if gen == _pages_gen:
+            _pages[key] = (now + ttl, page)
+            _pages.move_to_end(key)
+            while len(_pages) > PAGE_CACHE_SIZE:
+                _pages.popitem(last=False)
+    return page
+
+def invalidate_page(key):
+    global _pages_gen
+    with _pages_lock:
+        _pages_gen += 1
+        _pages.pop(key, None)
+    publish_invalidation("page", key)
+
+def bot_username():
+    """bot.get_me() একবারই; ব্যর্থ হলে কিছুক্ষণ পরে আবার চেষ্টা — "" যতক্ষণ জানা নেই"""
+    global _bot_username, _bot_username_retry
+    if _bot_username is None and time.monotonic() >= _bot_username_retry:
+        try:
+            _bot_username = bot.get_me().username
+        except Exception as e:
+            logger.error(f"get_me error: {e}")
+            _bot_username_retry = time.monotonic() + BOT_IDENTITY_RETRY
+    return _bot_username or ""
+
+# ================= CACHE SYNC =================
+# The caches above exist once per process (gunicorn workers, bot, worker,
+# or an `all` process next to gunicorn). Every invalidation is also written
+# to cache_events, and each process replays the others' events every few
+# seconds. CACHE_SYNC=0 turns it off for a single process that serves everything.
+CACHE_SYNC = os.getenv("CACHE_SYNC", "1") != "0"
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", 2))
+CACHE_EVENT_KEEP = 3600     # seconds
+
+_cache_sync = local()
+_cache_sync_started = False
+_cache_sync_lock = Lock()
+
+def publish_invalidation(kind, key):
+    if not CACHE_SYNC or getattr(_cache_sync, "replaying", False):
+        return
+    try:
+        db_query("INSERT INTO cache_events(kind, key, created) VALUES(?,?,?)", (kind, json.dumps(key), time.time()))
+    except Exception as e:
+        logger.error(f"Cache event error: {e}")
+
+def apply_invalidation(kind, key):
+    _cache_sync.replaying = True
+    try:
+        if kind == "site":
+            invalidate_site(*key)
+        elif kind == "page":
+            invalidate_page(tuple(key) if isinstance(key, list) else key)
+        elif kind == "expiry":
+            schedule_expiry_check()
+        elif kind == "user":
+            invalidate_user(key)
+    finally:
+        _cache_sync.replaying = False
+
+def start_cache_sync():
+    global _cache_sync_started
+    with _cache_sync_lock:
+        if not CACHE_SYNC or _cache_sync_started:
+            return
+        _cache_sync_started = True
+    Thread(target=cache_sync_listener, daemon=True).start()
+
+def cache_sync_listener():
+    r = db_query("SELECT MAX(id) as m FROM cache_events", fetchone=True)
+    last = (r["m"] if r else None) or 0
+    pruned = time.monotonic()
+    while True:
+        time.sleep(CACHE_SYNC_INTERVAL)
+        try:
+            # Our own events come back too; invalidating twice is harmless
+            for e in db_query("SELECT id, kind, key FROM cache_events WHERE id > ? ORDER BY id", (last,), fetch=True) or []:
+                apply_invalidation(e["kind"], json.loads(e["key"]))
+                last = e["id"]
+            if time.monotonic() - pruned > CACHE_EVENT_KEEP:
+                db_query("DELETE FROM cache_events WHERE created < ?", (time.time() - CACHE_EVENT_KEEP,))
+                pruned = time.monotonic()
+        except Exception as e:
+            logger.error(f"Cache sync: {e}")
+
+def purge_sites(sites):
+    """sites: (short_code, user_id) লিস্ট — DB row, views ও ফোল্ডার সব মুছে ফেলো"""
+    sites = [(code, uid) for code, uid in sites]
+    if not sites:
+        return 0
+    codes = [(code,) for code, _ in sites]
+    discard_views(code for code, _ in sites)
+    try:
+        with db_tx() as con:
+            con.executemany("UPDATE user_stats SET sites=sites-1,"
+                            " bytes=bytes-(SELECT COALESCE(size_bytes,0) FROM files WHERE short_code=?1),"
+                            " views=views-(SELECT COALESCE(views,0) FROM files WHERE short_code=?1)"
+                            " WHERE user_id=?2 AND EXISTS(SELECT 1 FROM files WHERE short_code=?1)",
+                            sites)
+            con.executemany("DELETE FROM files WHERE short_code=?", codes)
+            con.executemany("DELETE FROM site_views WHERE short_code=?", codes)
+            con.executemany("DELETE FROM site_stats_daily WHERE short_code=?", codes)
+            con.executemany("DELETE FROM site_stats_country WHERE short_code=?", codes)
+            con.executemany("DELETE FROM site_stats_browser WHERE short_code=?", codes)
+            con.executemany("DELETE FROM site_visitors WHERE short_code=?", codes)
+            release_blobs(con, codes)
+    except Exception as e:
+        logger.error(f"Purge error: {e}")
+        return 0
+    # Only after the commit, otherwise a request in between re-caches the old row
+    for code, uid in sites:
+        invalidate_site(code)
+        invalidate_page(("profile", uid))
+        shutil.rmtree(os.path.join(UPLOAD_DIR, str(uid), code), ignore_errors=True)
+        shutil.rmtree(os.path.join(VARIANT_DIR, str(uid), code), ignore_errors=True)
+    gc_blobs()
+    return len(sites)
+
+def discard_new_site(code, uid):
+    """add_site ব্যর্থ হলে ডাকো — ডিস্কে লেখা ফাইল আর manifest ফেলে দাও"""
+    try:
+        with db_tx() as con:
+            release_blobs(con, [(code,)])
+    except Exception as e:
+        logger.error(f"Discard site error: {e}")
+    shutil.rmtree(os.path.join(UPLOAD_DIR, str(uid), code), ignore_errors=True)
+    shutil.rmtree(os.path.join(VARIANT_DIR, str(uid), code), ignore_errors=True)
+    gc_blobs()
+
+# ================= VIEW COUNTER =================
+# Page views are aggregated in memory and written in one transaction
+VIEW_FLUSH_INTERVAL = 5     # seconds
+VIEW_FLUSH_SIZE = 500       # pending view events that trigger an early flush
+VIEW_BUFFER_MAX = 100000    # events kept for retry while the DB is failing; oldest dropped first
+
+_view_lock = Lock()
+_view_counts = {}           # short_code -> [views, last_view]
+_view_events = []           # (short_code, ip, country, viewed_at, user_agent)
+_view_flush_event = Event()
+
+def record_view(code, ip, country, ua):
+    now = datetime.now().strftime("%Y-%m-%d %H:%M")
+    with _view_lock:
+        c = _view_counts.get(code)
+        if c:
+            c[0] += 1
+            c[1] = now
+        else:
+            _view_counts[code] = [1, now]
+        _view_events.append((code, ip, country, now, ua[:200]))
+        pending = len(_view_events)
+    if pending >= VIEW_FLUSH_SIZE:
+        _view_flush_event.set()
+
+def discard_views(codes):
+    with _view_lock:
+        codes = set(codes)
+        for code in codes:
+            _view_counts.pop(code, None)
+        _view_events[:] = [e for e in _view_events if e[0] not in codes]
+
+def browser_family(ua):
+    ua = ua or ""
+    if "Mobile" in ua: return "📱 Mobile"
+    if "Chrome" in ua: return "🌐 Chrome"
+    if "Firefox" in ua: return "🦊 Firefox"
+    if "Safari" in ua: return "🍎 Safari"
+    return "💻 Desktop"
+
+def _rollup_events(con, events):
+    daily, country, browser, visitors = {}, {}, {}, set()
+    for code, ip, ctry, viewed_at, ua in events:
+        k = (code, viewed_at[:10])
+        daily[k] = daily.get(k, 0) + 1
+        k = (code, ctry or "Unknown")
+        country[k] = country.get(k, 0) + 1
+        k = (code, browser_family(ua))
+        browser[k] = browser.get(k, 0) + 1
+        if ip:
+            visitors.add((code, ip))
+    con.executemany("INSERT INTO site_stats_daily(short_code, day, views) VALUES(?,?,?) "
+                    "ON CONFLICT(short_code, day) DO UPDATE SET views=views+excluded.views",
+                    [(c, d, n) for (c, d), n in daily.items()])
+    con.executemany("INSERT INTO site_stats_country(short_code, country, views) VALUES(?,?,?) "
+                    "ON CONFLICT(short_code, country) DO UPDATE SET views=views+excluded.views",
+                    [(c, k, n) for (c, k), n in country.items()])
+    con.executemany("INSERT INTO site_stats_browser(short_code, browser, views) VALUES(?,?,?) "
+                    "ON CONFLICT(short_code, browser) DO UPDATE SET views=views+excluded.views",
+                    [(c, k, n) for (c, k), n in browser.items()])
+    new_visitors = {}
+    for code, ip in visitors:
+        if con.execute("INSERT OR IGNORE INTO site_visitors(short_code, ip) VALUES(?,?)", (code, ip)).rowcount:
+            new_visitors[code] = new_visitors.get(code, 0) + 1
+    con.executemany("UPDATE files SET unique_views=unique_views+? WHERE short_code=?",
+                    [(n, code) for code, n in new_visitors.items()])
+
+def build_rollups():
+    """পুরনো site_views থেকে একবার rollup টেবিল তৈরি করো"""
+    if db_query("SELECT 1 FROM settings WHERE key='rollups_built'", fetch=True):
+        return
+    try:
+        with db_tx() as con:
+            con.execute("INSERT OR REPLACE INTO site_stats_daily SELECT short_code, substr(viewed_at,1,10), COUNT(*) FROM site_views GROUP BY 1, 2")
+            con.execute("INSERT OR REPLACE INTO site_stats_country SELECT short_code, COALESCE(country,'Unknown'), COUNT(*) FROM site_views GROUP BY 1, 2")
+            con.execute("INSERT OR REPLACE INTO site_stats_browser SELECT short_code, CASE"
+                        " WHEN instr(user_agent,'Mobile') THEN '📱 Mobile'"
+                        " WHEN instr(user_agent,'Chrome') THEN '🌐 Chrome'"
+                        " WHEN instr(user_agent,'Firefox') THEN '🦊 Firefox'"
+                        " WHEN instr(user_agent,'Safari') THEN '🍎 Safari'"
+                        " ELSE '💻 Desktop' END, COUNT(*) FROM site_views GROUP BY 1, 2")
+            con.execute("INSERT OR IGNORE INTO site_visitors SELECT DISTINCT short_code, ip FROM site_views WHERE ip IS NOT NULL")
+            con.execute("UPDATE files SET unique_views=(SELECT COUNT(*) FROM site_visitors v WHERE v.short_code=files.short_code)")
+            con.execute("INSERT OR REPLACE INTO settings VALUES('rollups_built','1')")
+    except Exception as e:
+        logger.error(f"Rollup build error: {e}")
+
+build_rollups()
+
+def flush_views():
+    global _view_counts, _view_events
+    with _view_lock:
+        counts, events = _view_counts, _view_events
+        _view_counts, _view_events = {}, []
+    if not counts:
+        return 0
+    try:
+        with db_tx() as con:
+            con.executemany("UPDATE files SET views=views+?, last_view=? WHERE short_code=?",
+                            [(n, last, code) for code, (n, last) in counts.items()])
+            con.executemany("UPDATE user_stats SET views=views+? WHERE user_id=(SELECT user_id FROM files WHERE short_code=?)",
+                            [(n, code) for code, (n, _) in counts.items()])
+            con.executemany("INSERT INTO site_views(short_code,ip,country,viewed_at,user_agent) VALUES(?,?,?,?,?)",
+                            events)
+            _rollup_events(con, events)
+    except Exception as e:
+        logger.error(f"View flush error: {e}")
+        # Put the batch back so the next flush retries it
+        with _view_lock:
+            for code, (n, last) in counts.items():
+                c = _view_counts.setdefault(code, [0, last])
+                c[0] += n
+            _view_events[:0] = events
+            dropped = len(_view_events) - VIEW_BUFFER_MAX
+            if dropped > 0:
+                del _view_events[:dropped]
+        if dropped > 0:
+            logger.error(f"View buffer full, {dropped} view events dropped")
+        return 0
+    return len(events)
+
+def view_flusher():
+    while True:
+        _view_flush_event.wait(VIEW_FLUSH_INTERVAL)
+        _view_flush_event.clear()
+        try:
+            flush_views()
+        except Exception as e:
+            logger.error(f"View flusher: {e}")
+
+# Drain pending views on shutdown
+atexit.register(flush_views)
+
+if not db_query("SELECT 1 FROM settings WHERE key='user_stats_built'", fetch=True):
+    rebuild_user_stats()
+
 def format_bytes(size):
     for unit in ['B', 'KB', 'MB', 'GB']:
         if size < 1024:
@@ -269,21 +1285,89 @@ def format_bytes(size):
         size /= 1024
     return f"{size:.1f} TB"
 
-def get_zip_file_list(zip_bytes):
+def get_zip_file_list(zip_path):
     try:
-        with zipfile.ZipFile(io.BytesIO(zip_bytes), 'r') as z:
+        with zipfile.ZipFile(zip_path, 'r') as z:
             return [n for n in z.namelist() if not n.endswith('/')]
     except:
         return []
 
-def make_dir_listing_html(folder, slug, subpath=""):
-    """ZIP Auto-index: index.html না থাকলে ফাইল লিস্ট দেখাও"""
+# ================= UPLOAD PIPELINE =================
+# Uploads stream from Telegram straight to disk; listing/extraction work on the file
+DOWNLOAD_CHUNK = 256 * 1024
+
+def download_to_file(file_id, dest):
+    """ফাইল টুকরো টুকরো করে ডিস্কে লেখো, পুরো ফাইল মেমোরিতে রাখা হয় না। Returns (size, sha256)"""
+    file_info = bot.get_file(file_id)
+    url = (telebot.apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(TOKEN, file_info.file_path)
+    h = hashlib.sha256()
+    size = 0
+    tmp = dest + ".part"
+    try:
+        with api_session.get(url, stream=True, timeout=(10, 120), proxies=telebot.apihelper.proxy) as r:
+            r.raise_for_status()
+            with open(tmp, "wb") as f:
+                for chunk in r.iter_content(DOWNLOAD_CHUNK):
+                    size += len(chunk)
+                    if size > MAX_FILE_SIZE_BYTES:
+                        raise ValueError(f"File larger than {MAX_FILE_SIZE_MB}MB")
+                    h.update(chunk)
+                    f.write(chunk)
+        os.replace(tmp, dest)
+    except:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+    return size, h.hexdigest()
+
+def install_upload(src, path, ext, file_name, code):
+    """ডাউনলোড হওয়া ফাইল (src) সাইট ফোল্ডারে বসাও। Returns (file_type, zip file list, storage)"""
+    if ext == 'html':
+        os.replace(src, os.path.join(path, "index.html"))
+        return "html", [], "dir"
+    if ext == 'zip' and ZIP_STORAGE == "archive":
+        try:
+            with zipfile.ZipFile(src, 'r') as z:
+                all_files = [n for n in z.namelist() if not n.endswith('/')]
+        except:
+            os.remove(src)
+            raise
+        os.replace(src, os.path.join(path, ARCHIVE_NAME))
+        return "zip", all_files, "archive"
+    if ext == 'zip':
+        try:
+            all_files = get_zip_file_list(src)
+            with zipfile.ZipFile(src, 'r') as z:
+                z.extractall(path)
+        finally:
+            os.remove(src)
+        return "zip", all_files, "dir"
+    # For media files, save the file and create a nice viewer HTML
+    file_name = os.path.basename(file_name)
+    os.replace(src, os.path.join(path, file_name))
+    mime, _ = mimetypes.guess_type(file_name)
+    write_text_file(os.path.join(path, "index.html"), _make_media_viewer(file_name, mime or "", code))
+    return "media", [], "dir"
+
+def incoming_path(name):
+    """ডাউনলোড/temp ফাইলের জায়গা — সাইট ফোল্ডারের বাইরে, তাই ZIP এর কোনো ফাইলের সাথে নাম মেলে না"""
+    return os.path.join(INCOMING_DIR, f"{name[:64]}-{secrets.token_hex(4)}")
+
+def write_text_file(path, text):
+    """নতুন ফাইলে লিখে replace — আধা-লেখা ফাইল কখনো সার্ভ হয় না"""
+    tmp = incoming_path(os.path.basename(path))
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def make_dir_listing_html(slug, subpath, index):
+    """ZIP Auto-index: index.html না থাকলে ফাইল লিস্ট দেখাও (index: ZIP index বা সাইটের manifest)"""
     items = []
-    full = os.path.join(folder, subpath)
-    for name in sorted(os.listdir(full)):
-        path = os.path.join(full, name)
-        size = format_bytes(os.path.getsize(path)) if os.path.isfile(path) else "DIR"
-        icon = "📁" if os.path.isdir(path) else "📄"
+    for name, is_dir, size in sorted(archive_children(index, subpath)):
+        size = "DIR" if is_dir else format_bytes(size)
+        icon = "📁" if is_dir else "📄"
         href = f"/v/{slug}/{(subpath + '/' + name).strip('/')}"
         items.append(f'<tr><td>{icon}</td><td><a href="{href}">{name}</a></td><td>{size}</td></tr>')
     rows = "\n".join(items)
@@ -319,6 +1403,202 @@ def make_dir_listing_html(folder, slug, subpath=""):
 </body>
 </html>"""
 
+# ================= ZIP ARCHIVE SITES =================
+# With ZIP_STORAGE=archive an uploaded ZIP is kept as a single file
+# (files.storage='archive') and members are served from it using a cached
+# central-directory index instead of extracting thousands of files.
+ZIP_STORAGE = os.getenv("ZIP_STORAGE", "extract")
+ARCHIVE_NAME = ".site.zip"
+ZIP_INDEX_CACHE = 256
+
+_zip_index = OrderedDict()      # archive path -> index dict
+_zip_index_lock = Lock()
+
+def archive_path(uid, code):
+    return os.path.join(UPLOAD_DIR, str(uid), code, ARCHIVE_NAME)
+
+def clean_member_name(name):
+    """ZIP এর নাম → নিরাপদ relative path; ফোল্ডারের বাইরে গেলে None"""
+    name = posixpath.normpath(name.replace("\\", "/")).lstrip("/")
+    if name in ("", ".", "..") or name.startswith("../"):
+        return None
+    return name
+
+def read_zip_index(path):
+    members, dirs = {}, {""}
+    with open(path, "rb") as fh, zipfile.ZipFile(fh) as z:
+        for info in z.infolist():
+            name = clean_member_name(info.filename)
+            if not name:
+                continue
+            parts = name.split("/")
+            for i in range(1, len(parts)):
+                dirs.add("/".join(parts[:i]))
+            if info.is_dir():
+                dirs.add(name)
+                continue
+            # Data starts after the local header, whose name/extra lengths can differ from the central dir
+            fh.seek(info.header_offset)
+            header = fh.read(30)
+            if header[:4] != b"PK\x03\x04":
+                continue
+            n, m = struct.unpack("<HH", header[26:30])
+            members[name] = {
+                "offset": info.header_offset + 30 + n + m,
+                "csize": info.compress_size,
+                "size": info.file_size,
+                "method": info.compress_type,
+                "crc": info.CRC,
+                "encrypted": bool(info.flag_bits & 1),
+                "raw_name": info.filename,
+            }
+    return {"members": members, "dirs": dirs}
+
+def get_zip_index(path):
+    """mtime মিললে cache থেকে; OSError/BadZipFile ছুড়তে পারে"""
+    st = os.stat(path)
+    with _zip_index_lock:
+        index = _zip_index.get(path)
+        if index and index["mtime_ns"] == st.st_mtime_ns:
+            _zip_index.move_to_end(path)
+            return index
+    index = read_zip_index(path)
+    index.update(path=path, mtime_ns=st.st_mtime_ns, size=st.st_size)
+    with _zip_index_lock:
+        _zip_index[path] = index
+        while len(_zip_index) > ZIP_INDEX_CACHE:
+            _zip_index.popitem(last=False)
+    return index
+
+def archive_lookup(index, subpath):
+    """Returns ("file", name) / ("dir", name) / ("bad", None) / (None, None)"""
+    name = clean_member_name(subpath) if subpath else ""
+    if name is None:
+        return "bad", None
+    if name in index["members"]:
+        return "file", name
+    if name in index["dirs"]:
+        idx = (name + "/index.html").lstrip("/")
+        if idx in index["members"]:
+            return "file", idx
+        return "dir", name
+    return None, None
+
+def archive_children(index, subpath):
+    prefix = subpath + "/" if subpath else ""
+    entries = {}
+    for d in index["dirs"]:
+        if d.startswith(prefix) and d != subpath and "/" not in d[len(prefix):]:
+            entries[d[len(prefix):]] = (d[len(prefix):], True, 0)
+    for name, m in index["members"].items():
+        if name.startswith(prefix) and "/" not in name[len(prefix):]:
+            entries[name[len(prefix):]] = (name[len(prefix):], False, m["size"])
+    return list(entries.values())
+
+def unpack_archive(code, uid):
+    """archive সাইটকে সাধারণ ফোল্ডারে রূপান্তর (HTML edit এর আগে)"""
+    f = db_query("SELECT storage FROM files WHERE short_code=?", (code,), fetchone=True)
+    path = archive_path(uid, code)
+    # A folder site may hold a user file that happens to be named ARCHIVE_NAME
+    if not f or f["storage"] != "archive" or not os.path.exists(path):
+        return
+    # Moved out first: the archive may itself contain a member named ARCHIVE_NAME
+    src = incoming_path(code)
+    os.replace(path, src)
+    try:
+        with zipfile.ZipFile(src, 'r') as z:
+            z.extractall(os.path.dirname(path))
+    except Exception:
+        os.replace(src, path)
+        raise
+    os.remove(src)
+    db_query("UPDATE files SET storage='dir' WHERE short_code=?", (code,))
+    invalidate_site(code)
+
+# ================= PRECOMPRESSED VARIANTS =================
+# Compressed once after a site is written; a variant is only valid while its
+# mtime equals the source's, so a stale one is never served.
+COMPRESSIBLE_EXTENSIONS = ('.html', '.htm', '.css', '.js', '.mjs', '.json', '.svg', '.xml', '.txt', '.map', '.webmanifest')
+COMPRESS_MIN_BYTES = 1024
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", 11))
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+def is_compressible(path):
+    return path.lower().endswith(COMPRESSIBLE_EXTENSIONS)
+
+def variant_path(uid, code, rel):
+    return os.path.join(VARIANT_DIR, str(uid), code, rel)
+
+def build_variants(code, uid):
+    """সাইটের টেক্সট ফাইলগুলোর .gz/.br কপি বানাও, পুরনোগুলো মুছে ফেলো"""
+    site = os.path.join(UPLOAD_DIR, str(uid), code)
+    vroot = os.path.join(VARIANT_DIR, str(uid), code)
+    wanted = set()
+    for root, dirs, files in os.walk(site):
+        for f in files:
+            src = os.path.join(root, f)
+            rel = os.path.relpath(src, site)
+            try:
+                st = os.stat(src)
+                if not is_compressible(f) or st.st_size < COMPRESS_MIN_BYTES:
+                    continue
+                data = None
+                for enc, suffix in ENCODINGS:
+                    if enc == "br" and brotli is None:
+                        continue
+                    dest = os.path.join(vroot, rel + suffix)
+                    try:
+                        if os.stat(dest).st_mtime_ns == st.st_mtime_ns:
+                            wanted.add(dest)
+                            continue
+                    except OSError:
+                        pass
+                    if data is None:
+                        with open(src, "rb") as fh:
+                            data = fh.read()
+                    packed = brotli.compress(data, quality=BROTLI_QUALITY) if enc == "br" else gzip.compress(data, 9, mtime=0)
+                    if len(packed) >= len(data) * 0.9:
+                        continue
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    with open(dest + ".tmp", "wb") as out:
+                        out.write(packed)
+                    os.utime(dest + ".tmp", ns=(st.st_atime_ns, st.st_mtime_ns))
+                    os.replace(dest + ".tmp", dest)
+                    wanted.add(dest)
+            except Exception as e:
+                logger.error(f"Compress error {rel}: {e}")
+    for root, dirs, files in os.walk(vroot):
+        for f in files:
+            if os.path.join(root, f) not in wanted:
+                try:
+                    os.remove(os.path.join(root, f))
+                except OSError:
+                    pass
+    # Called after every site write, so cached responses are stale now
+    invalidate_hot(code)
+
+def build_all_variants():
+    # One-time backfill for sites uploaded before variants existed
+    if db_query("SELECT 1 FROM settings WHERE key='variants_built'", fetch=True):
+        return
+    for f in db_query("SELECT short_code, user_id FROM files", fetch=True) or []:
+        build_variants(f["short_code"], f["user_id"])
+    db_query("INSERT OR REPLACE INTO settings VALUES('variants_built','1')")
+
+def pick_variant(vpath, st):
+    """Accept-Encoding অনুযায়ী (encoding, file, stat) — না থাকলে None"""
+    accepted = request.accept_encodings
+    for enc, suffix in ENCODINGS:
+        if not accepted[enc]:
+            continue
+        try:
+            vst = os.stat(vpath + suffix)
+        except OSError:
+            continue
+        if vst.st_mtime_ns == st.st_mtime_ns:
+            return enc, vpath + suffix, vst
+    return None
+
 # ================= TEMPLATES =================
 TEMPLATES = {
     "portfolio": {
@@ -492,35 +1772,16 @@ setInterval(update, 1000); update();
 }
 
 # ================= KEYBOARDS =================
+MENU_LAYOUT = [("upload", "myfiles"), ("account", "referral"), ("premium", "help"), ("templates", "shorturl"), ("lang",)]
+ADMIN_MENU = {"stats": "📊 Stats", "broadcast": "📣 Broadcast", "admin": "⚙ Admin Panel"}
+
 def main_menu(uid):
-    lang = get_lang(uid)
+    labels = LANGS.get(get_lang(uid), LANGS["en"])
     m = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    if lang == "bn":
-        m.row("📤 সাইট আপলোড", "📂 আমার ফাইল")
-        m.row("👤 আমার একাউন্ট", "👫 রেফারেল")
-        m.row("💎 প্রিমিয়াম কিনুন", "❓ সাহায্য")
-        m.row("📋 টেমপ্লেট", "🔗 Short URL")
-        m.row("🌐 ভাষা পরিবর্তন")
-    elif lang == "hi":
-        m.row("📤 साइट अपलोड", "📂 मेरी फाइलें")
-        m.row("👤 मेरा अकाउंट", "👫 रेफरल")
-        m.row("💎 प्रीमियम खरीदें", "❓ सहायता")
-        m.row("📋 टेम्पलेट", "🔗 Short URL")
-        m.row("🌐 भाषा बदलें")
-    elif lang == "ar":
-        m.row("📤 رفع موقع", "📂 ملفاتي")
-        m.row("👤 حسابي", "👫 إحالة")
-        m.row("💎 اشترك بريميوم", "❓ مساعدة")
-        m.row("📋 قوالب", "🔗 رابط قصير")
-        m.row("🌐 تغيير اللغة")
-    else:
-        m.row("📤 Upload Site", "📂 My Files")
-        m.row("👤 My Account", "👫 Referral")
-        m.row("💎 Buy Premium", "❓ Help")
-        m.row("📋 Templates", "🔗 Short URL")
-        m.row("🌐 Change Language")
+    for row in MENU_LAYOUT:
+        m.row(*(labels[k] for k in row))
     if is_admin(uid):
-        m.row("📊 Stats", "📣 Broadcast", "⚙ Admin Panel")
+        m.row(*ADMIN_MENU.values())
     return m
 
 # ================= DECORATORS =================
@@ -537,6 +1798,153 @@ def banned_check(func):
         return func(msg, *args, **kwargs)
     return wrapper
 
+# ================= MENU ROUTER =================
+# Every reply-keyboard label (all languages) -> handler in one dict, so a text
+# message costs one lookup; the admin check only runs for admin buttons.
+_menu_routes = {}   # label -> (handler, admin_only)
+
+def menu_route(key, admin=False):
+    labels = [ADMIN_MENU[key]] if admin else {lang[key] for lang in LANGS.values()}
+    def decorator(func):
+        for label in labels:
+            _menu_routes[label] = (func, admin)
+        return func
+    return decorator
+
+@bot.message_handler(func=lambda m: m.text in _menu_routes)
+def menu_dispatch(msg):
+    func, admin = _menu_routes[msg.text]
+    if admin and not is_admin(msg.from_user.id):
+        return
+    func(msg)
+
+# ================= CALLBACK ROUTER =================
+# callback_data is "<prefix><arg>_<arg>..."; prefixes live in a character trie,
+# so resolving a button press is one walk over the (≤64 byte) data no matter
+# how many handlers exist. The longest registered prefix wins; an exact route
+# (no arguments) only matches the whole string.
+CALLBACK_DATA_MAX = 64      # bytes, Telegram's limit
+
+_cb_trie = {}               # char -> node; node[None] = (handler, arg_types, exact)
+
+def callback_route(prefix, *arg_types):
+    def decorator(func):
+        node = _cb_trie
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        if None in node:
+            raise ValueError(f"Callback route {prefix!r} registered twice")
+        node[None] = (func, arg_types, not arg_types)
+        return func
+    return decorator
+
+def resolve_callback(data):
+    node, found = _cb_trie, None
+    for i, ch in enumerate(data):
+        node = node.get(ch)
+        if node is None:
+            break
+        route = node.get(None)
+        if route and (not route[2] or i == len(data) - 1):
+            found = route, data[i + 1:]
+    return found
+
+def cb(prefix, *args):
+    """callback_data বানাও — 64 byte এর বেশি হলে ValueError"""
+    data = prefix + "_".join(str(a) for a in args)
+    if len(data.encode()) > CALLBACK_DATA_MAX:
+        raise ValueError(f"callback_data too long: {data!r}")
+    return data
+
+@bot.callback_query_handler(func=lambda c: True)
+def callback_dispatch(call):
+    found = resolve_callback(call.data or "")
+    if not found:
+        return
+    (func, arg_types, _), rest = found
+    args = rest.split("_", len(arg_types) - 1) if arg_types else []
+    if len(args) != len(arg_types):
+        return
+    try:
+        args = [kind(a) for kind, a in zip(arg_types, args)]
+    except ValueError:
+        logger.error(f"Bad callback_data: {call.data!r}")
+        return
+    func(call, *args)
+
+# ================= CONVERSATION STATE =================
+# Next-step handlers and per-user flow data live in conv_state instead of
+# process memory, so any bot worker can continue a flow and a restart keeps it.
+# Steps are stored by name (see conversation_step) with JSON arguments.
+CONVERSATION_TTL = int(os.getenv("CONVERSATION_TTL", 3600))   # seconds
+CONVERSATION_CLEAN_INTERVAL = 600
+
+_steps = {}     # name -> next-step function
+
+def conversation_step(func):
+    """register_next_step_handler এ দেওয়া যাবে এমন function"""
+    _steps[func.__name__] = func
+    return func
+
+def conv_set(chat_id, key, value, ttl=CONVERSATION_TTL):
+    db_query("INSERT OR REPLACE INTO conv_state VALUES(?,?,?,?)", (chat_id, key, json.dumps(value), time.time() + ttl))
+
+def conv_pop(chat_id, key):
+    if not db_query("SELECT 1 FROM conv_state WHERE chat_id=? AND key=?", (chat_id, key), fetchone=True):
+        return None
+    # SELECT + DELETE under the write lock instead of DELETE ... RETURNING (SQLite 3.35+)
+    try:
+        with db_tx() as con:
+            con.execute("BEGIN IMMEDIATE")
+            r = con.execute("SELECT value, expires FROM conv_state WHERE chat_id=? AND key=?", (chat_id, key)).fetchone()
+            if r:
+                con.execute("DELETE FROM conv_state WHERE chat_id=? AND key=?", (chat_id, key))
+    except sqlite3.Error as e:
+        logger.error(f"Conversation state error: {e}")
+        return None
+    if not r or r["expires"] < time.time():
+        return None
+    return json.loads(r["value"])
+
+class ConversationBackend(telebot.handler_backends.HandlerBackend):
+    """telebot next_step_backend — conv_state এর 'next_step' key তে"""
+    def register_handler(self, handler_group_id, handler):
+        name = handler.callback.__name__
+        if _steps.get(name) is not handler.callback:
+            raise ValueError(f"{name} is not a @conversation_step")
+        with db_tx() as con:
+            r = con.execute("SELECT value FROM conv_state WHERE chat_id=? AND key='next_step' AND expires > ?",
+                            (handler_group_id, time.time())).fetchone()
+            steps = json.loads(r["value"]) if r else []
+            steps.append([name, list(handler.args), handler.kwargs])
+            con.execute("INSERT OR REPLACE INTO conv_state VALUES(?,'next_step',?,?)",
+                        (handler_group_id, json.dumps(steps), time.time() + CONVERSATION_TTL))
+
+    def clear_handlers(self, handler_group_id):
+        db_query("DELETE FROM conv_state WHERE chat_id=? AND key='next_step'", (handler_group_id,))
+
+    def get_handlers(self, handler_group_id):
+        # Called for every message; pops atomically so only one worker runs the step
+        handlers = []
+        for name, args, kwargs in conv_pop(handler_group_id, "next_step") or []:
+            if name in _steps:
+                handlers.append({"callback": _steps[name], "args": args, "kwargs": kwargs})
+        return handlers or None
+
+bot.next_step_backend = ConversationBackend()
+
+def conversation_janitor():
+    while True:
+        time.sleep(CONVERSATION_CLEAN_INTERVAL)
+        db_query("DELETE FROM conv_state WHERE expires < ?", (time.time(),))
+
+# Custom slugs used to wait in settings as pending_slug_<uid>
+if db_query("SELECT 1 FROM settings WHERE key LIKE 'pending_slug_%' LIMIT 1", fetchone=True):
+    with db_tx() as _con:
+        _con.execute("INSERT OR REPLACE INTO conv_state SELECT CAST(substr(key, 14) AS INTEGER), 'pending_slug', json_quote(value), ?"
+                     " FROM settings WHERE key LIKE 'pending_slug_%'", (time.time() + CONVERSATION_TTL,))
+        _con.execute("DELETE FROM settings WHERE key LIKE 'pending_slug_%'")
+
 # ================= START / WELCOME =================
 @bot.message_handler(commands=["start"])
 @banned_check
@@ -550,12 +1958,15 @@ def start(msg):
         ref_id = int(args[1]) if len(args) > 1 and args[1].isdigit() else None
         joined = datetime.now().strftime("%Y-%m-%d %H:%M")
         db_query("INSERT INTO users (id, ref_by, joined_date, username) VALUES(?,?,?,?)", (uid, ref_id, joined, uname))
+        invalidate_user(uid)
         if ref_id and ref_id != uid:
             db_query("UPDATE users SET invites = invites + 1 WHERE id=?", (ref_id,))
             invites = db_query("SELECT invites FROM users WHERE id=?", (ref_id,), fetchone=True)
             if invites and invites["invites"] % REF_REQUIRED == 0:
                 expiry = (datetime.now() + timedelta(days=REF_REWARD_DAYS)).isoformat()
                 db_query("INSERT OR REPLACE INTO premium VALUES(?,?,?)", (ref_id, expiry, "referral"))
+                schedule_expiry_check()
+                invalidate_user(ref_id)
                 # Affiliate reward
                 db_query("UPDATE affiliates SET earnings=earnings+50, referrals=referrals+1 WHERE user_id=?", (ref_id,))
                 try:
@@ -563,7 +1974,8 @@ def start(msg):
                 except:
                     pass
     else:
-        db_query("UPDATE users SET username=? WHERE id=?", (uname, uid))
+        # /start again means the user unblocked the bot
+        db_query("UPDATE users SET username=?, blocked=0 WHERE id=?", (uname, uid))
 
     # Generate affiliate code if not exists
     db_query("INSERT OR IGNORE INTO affiliates(user_id, ref_code) VALUES(?,?)", (uid, secrets.token_hex(4)))
@@ -582,9 +1994,8 @@ def start(msg):
 def send_welcome(chat_id, uid):
     uname = db_query("SELECT username FROM users WHERE id=?", (uid,), fetchone=True)
     uname_text = f"@{uname['username']}" if uname and uname['username'] else f"#{uid}"
-    count = len(db_query("SELECT short_code FROM files WHERE user_id=?", (uid,), fetch=True) or [])
-    total_views = db_query("SELECT SUM(views) as v FROM files WHERE user_id=?", (uid,), fetchone=True)
-    views = total_views['v'] or 0 if total_views else 0
+    stats = get_user_stats(uid)
+    count, views = stats["sites"], stats["views"]
     status = "💎 Premium" if is_premium(uid) else "🆓 Free"
     profile_url = f"{DOMAIN}/u/{uid}"
 
@@ -621,7 +2032,7 @@ def send_welcome(chat_id, uid):
     bot.send_message(chat_id, welcome_text, reply_markup=kb, disable_web_page_preview=True)
     bot.send_message(chat_id, "👇 নিচের মেনু থেকে যেকোনো অপশন বেছে নিন:", reply_markup=main_menu(uid))
 
-@bot.callback_query_handler(func=lambda c: c.data == "verify")
+@callback_route("verify")
 def verify_callback(call):
     if check_join(call.from_user.id):
         safe_delete_message(call.message.chat.id, call.message.message_id)
@@ -629,7 +2040,10 @@ def verify_callback(call):
     else:
         bot.answer_callback_query(call.id, "❌ এখনো জয়েন করেননি!", show_alert=True)
 
-@bot.callback_query_handler(func=lambda c: c.data in ["btn_upload", "btn_myfiles", "btn_premium", "btn_shorturl"])
+@callback_route("btn_upload")
+@callback_route("btn_myfiles")
+@callback_route("btn_premium")
+@callback_route("btn_shorturl")
 def quick_buttons(call):
     uid = call.from_user.id
     if call.data == "btn_upload":
@@ -643,7 +2057,7 @@ def quick_buttons(call):
 
 # ================= HELP =================
 @bot.message_handler(commands=["help"])
-@bot.message_handler(func=lambda m: m.text in ["❓ Help", "❓ সাহায্য", "❓ सहायता", "❓ مساعدة"])
+@menu_route("help")
 @banned_check
 def help_cmd(msg):
     text = f"""❓ <b>সাহায্য / Help</b>
@@ -672,7 +2086,7 @@ def help_cmd(msg):
     bot.send_message(msg.chat.id, text)
 
 # ================= LANGUAGE =================
-@bot.message_handler(func=lambda m: m.text in ["🌐 ভাষা পরিবর্তন", "🌐 Change Language", "🌐 भाषा बदलें", "🌐 تغيير اللغة"])
+@menu_route("lang")
 @banned_check
 def change_lang(msg):
     kb = types.InlineKeyboardMarkup()
@@ -686,17 +2100,17 @@ def change_lang(msg):
     )
     bot.send_message(msg.chat.id, "🌐 ভাষা বেছে নিন / Choose Language:", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("lang_"))
-def set_lang(call):
-    lang = call.data.split("_")[1]
+@callback_route("lang_", str)
+def set_lang(call, lang):
     db_query("UPDATE users SET lang=? WHERE id=?", (lang, call.from_user.id))
+    invalidate_user(call.from_user.id)
     bot.answer_callback_query(call.id, "✅ ভাষা পরিবর্তন হয়েছে!")
     safe_delete_message(call.message.chat.id, call.message.message_id)
     bot.send_message(call.message.chat.id, t(call.from_user.id, "welcome"), reply_markup=main_menu(call.from_user.id))
 
 # ================= TEMPLATES =================
-@bot.message_handler(func=lambda m: m.text in ["📋 টেমপ্লেট", "📋 Templates", "📋 टेम्पलेट", "📋 قوالب"])
-@bot.callback_query_handler(func=lambda c: c.data == "show_templates")
+@menu_route("templates")
+@callback_route("show_templates")
 @banned_check
 def show_templates_menu(msg_or_call):
     if isinstance(msg_or_call, types.CallbackQuery):
@@ -709,19 +2123,17 @@ def show_templates_menu(msg_or_call):
 
     kb = types.InlineKeyboardMarkup()
     for key, tmpl in TEMPLATES.items():
-        kb.add(types.InlineKeyboardButton(f"{tmpl['name']} — {tmpl['desc']}", callback_data=f"use_template_{key}"))
+        kb.add(types.InlineKeyboardButton(f"{tmpl['name']} — {tmpl['desc']}", callback_data=cb("use_template_", key)))
     bot.send_message(chat_id, "📋 <b>রেডিমেড টেমপ্লেট:</b>\n\nটেমপ্লেট বেছে নিন:", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("use_template_"))
-def use_template(call):
+@callback_route("use_template_", str)
+def use_template(call, key):
     uid = call.from_user.id
-    key = call.data.replace("use_template_", "")
     if key not in TEMPLATES:
         bot.answer_callback_query(call.id, "❌ টেমপ্লেট পাওয়া যায়নি!", show_alert=True)
         return
 
-    count = len(db_query("SELECT short_code FROM files WHERE user_id=?", (uid,), fetch=True) or [])
-    if count >= get_limit(uid):
+    if get_user_stats(uid)["sites"] >= get_limit(uid):
         bot.answer_callback_query(call.id, "⚠️ লিমিট শেষ! প্রিমিয়াম নিন।", show_alert=True)
         return
 
@@ -729,19 +2141,21 @@ def use_template(call):
     code = generate_short_code()
     path = os.path.join(UPLOAD_DIR, str(uid), code)
     os.makedirs(path, exist_ok=True)
-    with open(os.path.join(path, "index.html"), "w", encoding="utf-8") as f:
-        f.write(tmpl["html"])
+    write_text_file(os.path.join(path, "index.html"), tmpl["html"])
 
     date = datetime.now().strftime("%Y-%m-%d %H:%M")
-    db_query("INSERT INTO files(user_id,short_code,name,type,date,views,is_public) VALUES(?,?,?,?,?,0,1)",
-             (uid, code, f"template_{key}.html", "html", date))
+    if not add_site(uid, code, f"template_{key}.html", "html", date):
+        discard_new_site(code, uid)
+        bot.answer_callback_query(call.id, "❌ সাইট সেভ করতে সমস্যা হয়েছে, আবার চেষ্টা করুন।", show_alert=True)
+        return
+    site_written(code, uid)
 
     url = f"{DOMAIN}/v/{code}"
     bot.answer_callback_query(call.id, "✅ টেমপ্লেট হোস্ট হয়েছে!")
     kb = types.InlineKeyboardMarkup()
     kb.row(
         types.InlineKeyboardButton("🔗 দেখুন", url=url),
-        types.InlineKeyboardButton("📝 এডিট করুন", callback_data=f"edit_{code}")
+        types.InlineKeyboardButton("📝 এডিট করুন", callback_data=cb("edit_", code))
     )
     bot.send_message(call.message.chat.id,
                      f"✅ <b>{tmpl['name']} টেমপ্লেট হোস্ট হয়েছে!</b>\n\n🌐 URL: <code>{url}</code>\n\nএডিট করতে নিজের HTML পাঠান।",
@@ -749,7 +2163,7 @@ def use_template(call):
     log_action(uid, "template_used", key)
 
 # ================= SHORT URL =================
-@bot.message_handler(func=lambda m: m.text in ["🔗 Short URL", "🔗 رابط قصير"])
+@menu_route("shorturl")
 @bot.message_handler(commands=["shorturl"])
 @banned_check
 def short_url_handler(msg):
@@ -762,18 +2176,15 @@ def short_url_handler(msg):
 
 def shorturl_menu(msg, uid):
     bot.send_message(msg.chat.id, "🔗 <b>Short URL সিস্টেম</b>\n\nশর্ট করতে চান এমন URL পাঠান:", reply_markup=types.ForceReply())
-    bot.register_next_step_handler(msg, lambda m: create_short_url_for(m, uid, m.text.strip()))
+    bot.register_next_step_handler(msg, short_url_save, uid)
 
 def shorturl_menu_msg(msg, uid):
     bot.send_message(msg.chat.id, "🔗 <b>Short URL সিস্টেম</b>\n\nশর্ট করতে চান এমন URL পাঠান:")
-    bot.register_next_step_handler(msg, lambda m: create_short_url_for(m, uid, m.text.strip()))
+    bot.register_next_step_handler(msg, short_url_save, uid)
 
-@bot.callback_query_handler(func=lambda c: c.data == "btn_shorturl")
-def short_url_callback(call):
-    uid = call.from_user.id
-    bot.answer_callback_query(call.id)
-    bot.send_message(call.message.chat.id, "🔗 <b>Short URL সিস্টেম</b>\n\nশর্ট করতে চান এমন URL পাঠান:")
-    bot.register_next_step_handler(call.message, lambda m: create_short_url_for(m, uid, m.text.strip()))
+@conversation_step
+def short_url_save(msg, uid):
+    create_short_url_for(msg, uid, (msg.text or "").strip())
 
 def create_short_url_for(msg, uid, url):
     if not url.startswith("http"):
@@ -787,16 +2198,15 @@ def create_short_url_for(msg, uid, url):
     kb = types.InlineKeyboardMarkup()
     kb.row(
         types.InlineKeyboardButton("🔗 Short URL", url=short),
-        types.InlineKeyboardButton("📊 Stats", callback_data=f"urlstats_{code}")
+        types.InlineKeyboardButton("📊 Stats", callback_data=cb("urlstats_", code))
     )
-    kb.add(types.InlineKeyboardButton("🗑 ডিলিট", callback_data=f"delurl_{code}"))
+    kb.add(types.InlineKeyboardButton("🗑 ডিলিট", callback_data=cb("delurl_", code)))
     bot.reply_to(msg, f"✅ <b>Short URL তৈরি হয়েছে!</b>\n\n🔗 <code>{short}</code>\n📄 Original: {url[:60]}...",
                  reply_markup=kb)
     log_action(uid, "short_url_created", url[:100])
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("urlstats_"))
-def url_stats(call):
-    code = call.data.split("_")[1]
+@callback_route("urlstats_", str)
+def url_stats(call, code):
     r = db_query("SELECT * FROM short_urls WHERE code=? AND user_id=?", (code, call.from_user.id), fetchone=True)
     if not r:
         bot.answer_callback_query(call.id, "❌ পাওয়া যায়নি!", show_alert=True)
@@ -806,9 +2216,8 @@ def url_stats(call):
                      f"📊 <b>Short URL Stats</b>\n\n🔗 {DOMAIN}/s/{code}\n📄 {r['original_url'][:60]}\n"
                      f"👁 Clicks: {r['clicks']}\n📅 তৈরি: {r['date']}")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("delurl_"))
-def del_url(call):
-    code = call.data.split("_")[1]
+@callback_route("delurl_", str)
+def del_url(call, code):
     db_query("DELETE FROM short_urls WHERE code=? AND user_id=?", (code, call.from_user.id))
     bot.answer_callback_query(call.id, "🗑 ডিলিট হয়েছে!", show_alert=True)
     bot.edit_message_text("🗑 Short URL ডিলিট হয়েছে।", call.message.chat.id, call.message.message_id)
@@ -823,12 +2232,11 @@ def clone_site(msg):
         bot.reply_to(msg, "ব্যবহার: /clone [site_code]\nউদাহরণ: /clone abc123")
         return
     slug = args[1]
-    f = db_query("SELECT * FROM files WHERE (custom_slug=? OR short_code=?) AND is_public=1", (slug, slug), fetchone=True)
-    if not f:
+    f = resolve_site(slug)
+    if not f or not f["is_public"]:
         bot.reply_to(msg, "❌ সাইটটি পাওয়া যায়নি বা পাবলিক নয়।")
         return
-    count = len(db_query("SELECT short_code FROM files WHERE user_id=?", (uid,), fetch=True) or [])
-    if count >= get_limit(uid):
+    if get_user_stats(uid)["sites"] >= get_limit(uid):
         bot.reply_to(msg, "⚠️ লিমিট শেষ! প্রিমিয়াম নিন।")
         return
 
@@ -836,13 +2244,25 @@ def clone_site(msg):
     if not os.path.exists(src):
         bot.reply_to(msg, "❌ সোর্স ফাইল পাওয়া যায়নি।")
         return
+    src_size = db_query("SELECT size_bytes FROM files WHERE short_code=?", (f["short_code"],), fetchone=True)
+    if storage_exceeded(uid, src_size["size_bytes"] if src_size else 0):
+        bot.reply_to(msg, "⚠️ আপনার স্টোরেজ কোটা শেষ!")
+        return
 
     new_code = generate_short_code()
-    dst = os.path.join(UPLOAD_DIR, str(uid), new_code)
-    shutil.copytree(src, dst)
+    try:
+        link_site(f["short_code"], f["user_id"], new_code, uid)
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"Clone error: {e}")
+        discard_new_site(new_code, uid)
+        bot.reply_to(msg, "❌ সাইট ক্লোন করা যায়নি, আবার চেষ্টা করুন।")
+        return
     date = datetime.now().strftime("%Y-%m-%d %H:%M")
-    db_query("INSERT INTO files(user_id,short_code,name,type,date,views,is_public) VALUES(?,?,?,?,?,0,1)",
-             (uid, new_code, f"clone_{f['name']}", f["type"], date))
+    if not add_site(uid, new_code, f"clone_{f['name']}", f["type"], date, storage=f["storage"]):
+        discard_new_site(new_code, uid)
+        bot.reply_to(msg, "❌ সাইট সেভ করতে সমস্যা হয়েছে, আবার চেষ্টা করুন।")
+        return
+    site_written(new_code, uid)
     url = f"{DOMAIN}/v/{new_code}"
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("🔗 দেখুন", url=url))
@@ -850,14 +2270,14 @@ def clone_site(msg):
     log_action(uid, "clone", f["short_code"])
 
 # ================= UPLOAD LOGIC =================
-@bot.message_handler(func=lambda m: m.text in ["📤 Upload Site", "📤 সাইট আপলোড", "📤 साइट अपलोड", "📤 رفع موقع"])
+@menu_route("upload")
 @banned_check
 def ask_file(msg):
     uid = msg.from_user.id
     ask_file_inline(msg, uid)
 
 def ask_file_inline(msg, uid):
-    count = len(db_query("SELECT short_code FROM files WHERE user_id=?", (uid,), fetch=True) or [])
+    count = get_user_stats(uid)["sites"]
     limit = get_limit(uid)
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("⚙️ কাস্টম স্লাগ সেট করুন", callback_data="set_custom_slug"))
@@ -869,11 +2289,12 @@ def ask_file_inline(msg, uid):
         f"ফাইল পাঠান:",
         reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data == "set_custom_slug")
+@callback_route("set_custom_slug")
 def ask_custom_slug(call):
     bot.send_message(call.message.chat.id, "🔗 কাস্টম slug লিখুন (শুধু a-z, 0-9, - ব্যবহার করুন):\nউদাহরণ: my-portfolio")
     bot.register_next_step_handler(call.message, save_custom_slug_temp)
 
+@conversation_step
 def save_custom_slug_temp(msg):
     slug = msg.text.strip().lower().replace(" ", "-")
     if not re.match(r'^[a-z0-9\-]+$', slug):
@@ -882,15 +2303,14 @@ def save_custom_slug_temp(msg):
     if db_query("SELECT 1 FROM files WHERE custom_slug=?", (slug,), fetch=True):
         bot.reply_to(msg, "❌ এই slug ইতিমধ্যে ব্যবহৃত। অন্যটি বেছে নিন।")
         return
-    db_query("INSERT OR REPLACE INTO settings VALUES(?,?)", (f"pending_slug_{msg.from_user.id}", slug))
+    conv_set(msg.from_user.id, "pending_slug", slug)
     bot.reply_to(msg, f"✅ Slug সেট: <code>{slug}</code>\n\nএখন ফাইল পাঠান।")
 
 @bot.message_handler(content_types=["document", "photo", "video", "audio"])
 @banned_check
 def handle_docs(msg):
     uid = msg.from_user.id
-    count = len(db_query("SELECT short_code FROM files WHERE user_id=?", (uid,), fetch=True) or [])
-    if count >= get_limit(uid):
+    if get_user_stats(uid)["sites"] >= get_limit(uid):
         bot.reply_to(msg, "⚠️ লিমিট শেষ! প্রিমিয়াম নিন অথবা বন্ধু রেফার করুন।")
         return
 
@@ -917,6 +2337,9 @@ def handle_docs(msg):
     if file_size and file_size > MAX_FILE_SIZE_BYTES:
         bot.reply_to(msg, f"❌ ফাইল সাইজ {MAX_FILE_SIZE_MB}MB এর বেশি!")
         return
+    if storage_exceeded(uid, file_size):
+        bot.reply_to(msg, "⚠️ আপনার স্টোরেজ কোটা শেষ! পুরনো সাইট ডিলিট করুন অথবা প্রিমিয়াম নিন।")
+        return
 
     ext = file_name.split('.')[-1].lower()
     if ext not in SUPPORTED_EXTENSIONS:
@@ -926,77 +2349,56 @@ def handle_docs(msg):
     # Loading animation
     wait_msg = bot.reply_to(msg, "⏳ <b>স্টেপ ১/৩:</b> ফাইল ডাউনলোড হচ্ছে...")
 
+    code = generate_short_code()
+    path = os.path.join(UPLOAD_DIR, str(uid), code)
+    os.makedirs(path, exist_ok=True)
+    upload_path = incoming_path(code)
     try:
-        file_info = bot.get_file(file_id)
-        downloaded = bot.download_file(file_info.file_path)
+        download_to_file(file_id, upload_path)
     except Exception as e:
+        logger.error(f"Download error: {e}")
+        shutil.rmtree(path, ignore_errors=True)
+        try:
+            os.remove(upload_path)
+        except OSError:
+            pass
         bot.edit_message_text("❌ ফাইল ডাউনলোডে সমস্যা হয়েছে।", msg.chat.id, wait_msg.message_id)
         return
 
     bot.edit_message_text("⏳ <b>স্টেপ ২/৩:</b> সাইট তৈরি হচ্ছে...", msg.chat.id, wait_msg.message_id)
 
     # Custom slug
-    slug_row = db_query("SELECT value FROM settings WHERE key=?", (f"pending_slug_{uid}",), fetchone=True)
-    custom_slug = slug_row["value"] if slug_row else None
-    if custom_slug:
-        db_query("DELETE FROM settings WHERE key=?", (f"pending_slug_{uid}",))
+    custom_slug = conv_pop(uid, "pending_slug")
 
-    code = generate_short_code()
-    path = os.path.join(UPLOAD_DIR, str(uid), code)
-    os.makedirs(path, exist_ok=True)
-    date = datetime.now().strftime("%Y-%m-%d %H:%M")
+    if custom_slug and db_query("SELECT 1 FROM files WHERE custom_slug=?", (custom_slug,), fetch=True):
+        custom_slug = None  # taken by someone else in the meantime
 
-    file_type = "html"
+    date = datetime.now().strftime("%Y-%m-%d %H:%M")
     extra = ""
 
-    if ext == 'html':
-        with open(os.path.join(path, "index.html"), "wb") as f:
-            f.write(downloaded)
-        file_type = "html"
-    elif ext == 'zip':
-        zip_path = os.path.join(path, "site.zip")
-        with open(zip_path, "wb") as f:
-            f.write(downloaded)
-        try:
-            with zipfile.ZipFile(zip_path, 'r') as z:
-                z.extractall(path)
-            os.remove(zip_path)
-            file_type = "zip"
-            all_files = get_zip_file_list(downloaded)
-            preview_list = "\n".join([f"  📄 {f}" for f in all_files[:8]])
-            if len(all_files) > 8:
-                preview_list += f"\n  ...এবং আরো {len(all_files)-8}টি"
-            extra = f"\n\n📦 <b>ফাইল লিস্ট ({len(all_files)}টি):</b>\n{preview_list}"
-        except zipfile.BadZipFile:
-            bot.edit_message_text("❌ বৈধ ZIP ফাইল নয়।", msg.chat.id, wait_msg.message_id)
-            shutil.rmtree(path)
+    try:
+        file_type, all_files, storage = install_upload(upload_path, path, ext, file_name, code)
+    except zipfile.BadZipFile:
+        bot.edit_message_text("❌ বৈধ ZIP ফাইল নয়।", msg.chat.id, wait_msg.message_id)
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    if file_type == "zip":
+        preview_list = "\n".join([f"  📄 {f}" for f in all_files[:8]])
+        if len(all_files) > 8:
+            preview_list += f"\n  ...এবং আরো {len(all_files)-8}টি"
+        extra = f"\n\n📦 <b>ফাইল লিস্ট ({len(all_files)}টি):</b>\n{preview_list}"
+
+    if not add_site(uid, code, file_name, file_type, date, custom_slug, storage):
+        # Custom slug got taken between the check and the insert
+        custom_slug = None
+        if not add_site(uid, code, file_name, file_type, date, storage=storage):
+            discard_new_site(code, uid)
+            bot.edit_message_text("❌ সাইট সেভ করতে সমস্যা হয়েছে, আবার চেষ্টা করুন।", msg.chat.id, wait_msg.message_id)
             return
-    elif ext in MEDIA_EXTENSIONS:
-        # For media files, create a nice viewer HTML and save the file
-        save_path = os.path.join(path, file_name)
-        with open(save_path, "wb") as f:
-            f.write(downloaded)
-        file_type = "media"
-        # Create a viewer HTML
-        mime, _ = mimetypes.guess_type(file_name)
-        viewer = _make_media_viewer(file_name, mime or "", code)
-        with open(os.path.join(path, "index.html"), "w", encoding="utf-8") as f:
-            f.write(viewer)
-
-    db_query("INSERT INTO files(user_id,short_code,name,type,date,custom_slug,views,is_public) VALUES(?,?,?,?,?,?,0,1)",
-             (uid, code, file_name, file_type, date, custom_slug))
+    site_written(code, uid)
 
     url = f"{DOMAIN}/v/{custom_slug or code}"
 
-    # Send to owner as backup
-    try:
-        backup_file = io.BytesIO(downloaded)
-        backup_file.name = file_name
-        bot.send_document(OWNER_ID, backup_file,
-            caption=f"📦 <b>নতুন আপলোড</b>\n👤 <code>{uid}</code>\n📄 {file_name}\n🌐 {url}")
-    except:
-        pass
-
     bot.edit_message_text(
         f"✅ <b>স্টেপ ৩/৩: সফলভাবে হোস্ট হয়েছে!</b>\n\n"
         f"🌐 URL: <code>{url}</code>\n"
@@ -1010,17 +2412,20 @@ def handle_docs(msg):
     kb = types.InlineKeyboardMarkup()
     kb.row(
         types.InlineKeyboardButton("🔗 দেখুন", url=url),
-        types.InlineKeyboardButton("📊 Analytics", callback_data=f"analytics_{code}")
+        types.InlineKeyboardButton("📊 Analytics", callback_data=cb("analytics_", code))
     )
     kb.row(
-        types.InlineKeyboardButton("🔒 পাসওয়ার্ড", callback_data=f"setpass_{code}"),
-        types.InlineKeyboardButton("🔗 QR কোড", callback_data=f"qr_{code}")
+        types.InlineKeyboardButton("🔒 পাসওয়ার্ড", callback_data=cb("setpass_", code)),
+        types.InlineKeyboardButton("🔗 QR কোড", callback_data=cb("qr_", code))
     )
     kb.row(
-        types.InlineKeyboardButton("🏷 ট্যাগ", callback_data=f"settag_{code}"),
-        types.InlineKeyboardButton("👁 Public/Private", callback_data=f"toggle_public_{code}")
+        types.InlineKeyboardButton("🏷 ট্যাগ", callback_data=cb("settag_", code)),
+        types.InlineKeyboardButton("👁 Public/Private", callback_data=cb("toggle_public_", code))
     )
     bot.send_message(msg.chat.id, "⚙️ <b>সাইট অপশন:</b>", reply_markup=kb)
+    # Owner backup goes out after the user already has the link
+    enqueue_side_effect("owner_document", file_id=file_id,
+        caption=f"📦 <b>নতুন আপলোড</b>\n👤 <code>{uid}</code>\n📄 {file_name}\n🌐 {url}")
     log_action(uid, "upload", f"{file_name} -> {code}")
 
 def _make_media_viewer(filename, mime, code):
@@ -1056,42 +2461,39 @@ h2{{margin-bottom:16px;font-size:18px;color:#888}}
 </html>"""
 
 # ================= SITE TAGS =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("settag_"))
-def set_tag(call):
-    code = call.data.split("_")[1]
+@callback_route("settag_", str)
+def set_tag(call, code):
     kb = types.InlineKeyboardMarkup()
     tags = ["portfolio", "landing-page", "blog", "store", "tool", "game", "media", "other"]
     rows = [tags[i:i+2] for i in range(0, len(tags), 2)]
     for row in rows:
-        kb.row(*[types.InlineKeyboardButton(f"🏷 {t}", callback_data=f"dotag_{code}_{t}") for t in row])
+        kb.row(*[types.InlineKeyboardButton(f"🏷 {t}", callback_data=cb("dotag_", code, t)) for t in row])
     bot.send_message(call.message.chat.id, "🏷 সাইটের ট্যাগ বেছে নিন:", reply_markup=kb)
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("dotag_"))
-def do_tag(call):
-    parts = call.data.split("_")
-    code = parts[1]
-    tag = parts[2]
+@callback_route("dotag_", str, str)
+def do_tag(call, code, tag):
     db_query("UPDATE files SET tags=? WHERE short_code=? AND user_id=?", (tag, code, call.from_user.id))
+    invalidate_page(("profile", call.from_user.id))
     bot.answer_callback_query(call.id, f"✅ ট্যাগ সেট: {tag}", show_alert=True)
 
 # ================= PUBLIC/PRIVATE TOGGLE =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("toggle_public_"))
-def toggle_public(call):
-    code = call.data.split("_")[2]
+@callback_route("toggle_public_", str)
+def toggle_public(call, code):
     f = db_query("SELECT is_public FROM files WHERE short_code=? AND user_id=?", (code, call.from_user.id), fetchone=True)
     if not f:
         bot.answer_callback_query(call.id, "❌ পাওয়া যায়নি!", show_alert=True)
         return
     new_val = 0 if f["is_public"] else 1
     db_query("UPDATE files SET is_public=? WHERE short_code=?", (new_val, code))
+    invalidate_site(code)
+    invalidate_page(("profile", call.from_user.id))
     status = "পাবলিক 🌐" if new_val else "প্রাইভেট 🔒"
     bot.answer_callback_query(call.id, f"✅ সাইট এখন {status}", show_alert=True)
 
 # ================= FAVORITE =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("fav_"))
-def toggle_fav(call):
-    code = call.data.split("_")[1]
+@callback_route("fav_", str)
+def toggle_fav(call, code):
     f = db_query("SELECT is_favorite FROM files WHERE short_code=? AND user_id=?", (code, call.from_user.id), fetchone=True)
     if not f:
         bot.answer_callback_query(call.id, "❌ পাওয়া যায়নি!", show_alert=True)
@@ -1103,7 +2505,7 @@ def toggle_fav(call):
 
 # ================= MY FILES =================
 @bot.message_handler(commands=["myfiles"])
-@bot.message_handler(func=lambda m: m.text in ["📂 My Files", "📂 আমার ফাইল", "📂 मेरी फाइलें", "📂 ملفاتي"])
+@menu_route("myfiles")
 @banned_check
 def list_files(msg):
     uid = msg.from_user.id
@@ -1125,27 +2527,27 @@ def list_files_for(msg, uid):
         kb = types.InlineKeyboardMarkup()
         kb.row(
             types.InlineKeyboardButton("🔗 দেখুন", url=url),
-            types.InlineKeyboardButton("🗑 ডিলিট", callback_data=f"del_{code}"),
-            types.InlineKeyboardButton("📊 Analytics", callback_data=f"analytics_{code}")
+            types.InlineKeyboardButton("🗑 ডিলিট", callback_data=cb("del_", code)),
+            types.InlineKeyboardButton("📊 Analytics", callback_data=cb("analytics_", code))
         )
         row2 = [
-            types.InlineKeyboardButton("📥 ব্যাকআপ", callback_data=f"backup_{code}"),
-            types.InlineKeyboardButton("🔗 QR", callback_data=f"qr_{code}"),
-            types.InlineKeyboardButton(fav + " Fav", callback_data=f"fav_{code}")
+            types.InlineKeyboardButton("📥 ব্যাকআপ", callback_data=cb("backup_", code)),
+            types.InlineKeyboardButton("🔗 QR", callback_data=cb("qr_", code)),
+            types.InlineKeyboardButton(fav + " Fav", callback_data=cb("fav_", code))
         ]
         if f["type"] == 'html':
             kb.row(*row2)
-            kb.row(types.InlineKeyboardButton("📝 এডিট", callback_data=f"edit_{code}"))
+            kb.row(types.InlineKeyboardButton("📝 এডিট", callback_data=cb("edit_", code)))
         else:
             kb.row(*row2)
         kb.row(
-            types.InlineKeyboardButton("🔒 পাসওয়ার্ড", callback_data=f"setpass_{code}"),
-            types.InlineKeyboardButton("⏰ এক্সপায়ারি", callback_data=f"setexpiry_{code}"),
-            types.InlineKeyboardButton("🔄 আপডেট", callback_data=f"update_{code}")
+            types.InlineKeyboardButton("🔒 পাসওয়ার্ড", callback_data=cb("setpass_", code)),
+            types.InlineKeyboardButton("⏰ এক্সপায়ারি", callback_data=cb("setexpiry_", code)),
+            types.InlineKeyboardButton("🔄 আপডেট", callback_data=cb("update_", code))
         )
         kb.row(
-            types.InlineKeyboardButton(f"{pub} Public/Private", callback_data=f"toggle_public_{code}"),
-            types.InlineKeyboardButton("🏷 ট্যাগ", callback_data=f"settag_{code}")
+            types.InlineKeyboardButton(f"{pub} Public/Private", callback_data=cb("toggle_public_", code)),
+            types.InlineKeyboardButton("🏷 ট্যাগ", callback_data=cb("settag_", code))
         )
         bot.send_message(
             msg.chat.id,
@@ -1156,9 +2558,8 @@ def list_files_for(msg, uid):
         )
 
 # ================= QR CODE =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("qr_"))
-def send_qr(call):
-    code = call.data.split("_")[1]
+@callback_route("qr_", str)
+def send_qr(call, code):
     f = db_query("SELECT custom_slug FROM files WHERE short_code=?", (code,), fetchone=True)
     slug = f["custom_slug"] if f and f["custom_slug"] else code
     url = f"{DOMAIN}/v/{slug}"
@@ -1171,10 +2572,9 @@ def send_qr(call):
     bot.answer_callback_query(call.id)
 
 # ================= ANALYTICS =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("analytics_"))
-def show_analytics(call):
-    code = call.data.split("_")[1]
-    f = db_query("SELECT name, views, last_view FROM files WHERE short_code=? AND user_id=?",
+@callback_route("analytics_", str)
+def show_analytics(call, code):
+    f = db_query("SELECT name, views, last_view, unique_views FROM files WHERE short_code=? AND user_id=?",
                  (code, call.from_user.id), fetchone=True)
     if not f:
         bot.answer_callback_query(call.id, "❌ পাওয়া যায়নি!", show_alert=True)
@@ -1182,33 +2582,24 @@ def show_analytics(call):
 
     # Country stats
     by_country = db_query(
-        "SELECT country, COUNT(*) as cnt FROM site_views WHERE short_code=? GROUP BY country ORDER BY cnt DESC LIMIT 5",
+        "SELECT country, views as cnt FROM site_stats_country WHERE short_code=? ORDER BY views DESC LIMIT 5",
         (code,), fetch=True) or []
     country_text = "".join(f"\n  🌍 {r['country'] or 'Unknown'}: {r['cnt']}" for r in by_country)
 
     # Daily stats (last 7 days)
     by_day = db_query(
-        "SELECT substr(viewed_at,1,10) as day, COUNT(*) as cnt FROM site_views WHERE short_code=? GROUP BY day ORDER BY day DESC LIMIT 7",
+        "SELECT day, views as cnt FROM site_stats_daily WHERE short_code=? ORDER BY day DESC LIMIT 7",
         (code,), fetch=True) or []
     day_text = "".join(f"\n  📅 {r['day']}: {r['cnt']}" for r in by_day)
 
     # Unique IPs
-    unique = db_query("SELECT COUNT(DISTINCT ip) as c FROM site_views WHERE short_code=?", (code,), fetchone=True)
-    unique_v = unique['c'] if unique else 0
+    unique_v = f['unique_views'] or 0
 
     # Browser/UA basic
     ua_rows = db_query(
-        "SELECT user_agent, COUNT(*) as c FROM site_views WHERE short_code=? AND user_agent IS NOT NULL GROUP BY user_agent ORDER BY c DESC LIMIT 3",
+        "SELECT browser, views as c FROM site_stats_browser WHERE short_code=? ORDER BY views DESC LIMIT 3",
         (code,), fetch=True) or []
-    ua_text = ""
-    for r in ua_rows:
-        ua = r['user_agent'] or ""
-        if "Mobile" in ua: br = "📱 Mobile"
-        elif "Chrome" in ua: br = "🌐 Chrome"
-        elif "Firefox" in ua: br = "🦊 Firefox"
-        elif "Safari" in ua: br = "🍎 Safari"
-        else: br = "💻 Desktop"
-        ua_text += f"\n  {br}: {r['c']}"
+    ua_text = "".join(f"\n  {r['browser']}: {r['c']}" for r in ua_rows)
 
     bot.answer_callback_query(call.id)
     bot.send_message(call.message.chat.id,
@@ -1222,11 +2613,10 @@ def show_analytics(call):
     )
 
 # ================= BACKUP =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("backup_"))
-def send_backup(call):
-    code = call.data.split("_")[1]
+@callback_route("backup_", str)
+def send_backup(call, code):
     uid = call.from_user.id
-    f = db_query("SELECT name, type FROM files WHERE short_code=? AND user_id=?", (code, uid), fetchone=True)
+    f = db_query("SELECT name, type, storage FROM files WHERE short_code=? AND user_id=?", (code, uid), fetchone=True)
     if not f:
         bot.answer_callback_query(call.id, "❌ পাওয়া যায়নি!", show_alert=True)
         return
@@ -1234,66 +2624,77 @@ def send_backup(call):
     if not os.path.exists(folder):
         bot.answer_callback_query(call.id, "❌ ফাইল পাওয়া যায়নি!", show_alert=True)
         return
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for root, dirs, files_list in os.walk(folder):
-            for file in files_list:
-                filepath = os.path.join(root, file)
-                arcname = os.path.relpath(filepath, folder)
-                zf.write(filepath, arcname)
+    archive = os.path.join(folder, ARCHIVE_NAME)
+    if f["storage"] == "archive":
+        # Archive sites already are a ZIP
+        with open(archive, "rb") as af:
+            buf = io.BytesIO(af.read())
+    else:
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for root, dirs, files_list in os.walk(folder):
+                for file in files_list:
+                    filepath = os.path.join(root, file)
+                    arcname = os.path.relpath(filepath, folder)
+                    zf.write(filepath, arcname)
     buf.seek(0)
     buf.name = f"backup_{code}.zip"
     bot.send_document(call.message.chat.id, buf, caption=f"📥 Backup: <b>{f['name']}</b>")
     bot.answer_callback_query(call.id, "✅ ব্যাকআপ পাঠানো হয়েছে!")
 
 # ================= PASSWORD =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("setpass_"))
-def set_password(call):
-    code = call.data.split("_")[1]
+@callback_route("setpass_", str)
+def set_password(call, code):
     bot.send_message(call.message.chat.id, "🔒 পাসওয়ার্ড লিখুন (মুছে দিতে 'remove' লিখুন):")
     bot.register_next_step_handler(call.message, save_password, code)
 
+@conversation_step
 def save_password(msg, code):
     pw = msg.text.strip()
     if pw.lower() == "remove":
         db_query("UPDATE files SET password=NULL WHERE short_code=? AND user_id=?", (code, msg.from_user.id))
+        invalidate_site(code)
         bot.reply_to(msg, "✅ পাসওয়ার্ড সরানো হয়েছে!")
     else:
         db_query("UPDATE files SET password=? WHERE short_code=? AND user_id=?", (pw, code, msg.from_user.id))
+        invalidate_site(code)
         bot.reply_to(msg, f"✅ পাসওয়ার্ড সেট: <code>{pw}</code>")
 
 # ================= EXPIRY / SCHEDULED DELETE =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("setexpiry_"))
-def set_expiry(call):
-    code = call.data.split("_")[1]
+@callback_route("setexpiry_", str)
+def set_expiry(call, code):
     bot.send_message(call.message.chat.id, "⏰ কতদিন পরে সাইট ডিলিট হবে? (দিনের সংখ্যা লিখুন, মুছতে 'remove' লিখুন):")
     bot.register_next_step_handler(call.message, save_expiry, code)
 
+@conversation_step
 def save_expiry(msg, code):
     val = msg.text.strip()
     if val.lower() == "remove":
         db_query("UPDATE files SET expiry=NULL WHERE short_code=? AND user_id=?", (code, msg.from_user.id))
+        invalidate_site(code)
         bot.reply_to(msg, "✅ এক্সপায়ারি সরানো হয়েছে!")
     elif val.isdigit():
         expiry = (datetime.now() + timedelta(days=int(val))).isoformat()
         db_query("UPDATE files SET expiry=? WHERE short_code=? AND user_id=?", (expiry, code, msg.from_user.id))
+        invalidate_site(code)
+        schedule_expiry_check()
         bot.reply_to(msg, f"✅ সাইট {val} দিন পরে ডিলিট হবে।")
     else:
         bot.reply_to(msg, "❌ অবৈধ ইনপুট!")
 
 # ================= UPDATE SITE =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("update_"))
-def update_site_ask(call):
-    code = call.data.split("_")[1]
+@callback_route("update_", str)
+def update_site_ask(call, code):
     bot.send_message(call.message.chat.id, "🔄 নতুন ফাইল পাঠান:")
     bot.register_next_step_handler(call.message, update_site_save, code)
 
+@conversation_step
 def update_site_save(msg, code):
     if not msg.document:
         bot.reply_to(msg, "❌ ফাইল পাঠান।")
         return
     uid = msg.from_user.id
-    f = db_query("SELECT type FROM files WHERE short_code=? AND user_id=?", (code, uid), fetchone=True)
+    f = db_query("SELECT type, size_bytes FROM files WHERE short_code=? AND user_id=?", (code, uid), fetchone=True)
     if not f:
         bot.reply_to(msg, "❌ পাওয়া যায়নি।")
         return
@@ -1301,88 +2702,118 @@ def update_site_save(msg, code):
     if ext not in SUPPORTED_EXTENSIONS:
         bot.reply_to(msg, "❌ সাপোর্টেড নয়।")
         return
+    if storage_exceeded(uid, (msg.document.file_size or 0) - (f["size_bytes"] or 0)):
+        bot.reply_to(msg, "⚠️ আপনার স্টোরেজ কোটা শেষ!")
+        return
     path = os.path.join(UPLOAD_DIR, str(uid), code)
+    # Build the new version next to the live one, then swap
+    staging = path + ".new"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging, exist_ok=True)
+    upload_path = incoming_path(code)
+    try:
+        download_to_file(msg.document.file_id, upload_path)
+        file_type, _, storage = install_upload(upload_path, staging, ext, msg.document.file_name, code)
+    except zipfile.BadZipFile:
+        shutil.rmtree(staging, ignore_errors=True)
+        bot.reply_to(msg, "❌ বৈধ ZIP ফাইল নয়।")
+        return
+    except Exception as e:
+        logger.error(f"Update download error: {e}")
+        shutil.rmtree(staging, ignore_errors=True)
+        try:
+            os.remove(upload_path)
+        except OSError:
+            pass
+        bot.reply_to(msg, "❌ ফাইল ডাউনলোডে সমস্যা হয়েছে।")
+        return
     shutil.rmtree(path, ignore_errors=True)
-    os.makedirs(path, exist_ok=True)
-    file_info = bot.get_file(msg.document.file_id)
-    downloaded = bot.download_file(file_info.file_path)
-    if ext == 'html':
-        with open(os.path.join(path, "index.html"), "wb") as f_:
-            f_.write(downloaded)
-    elif ext == 'zip':
-        zip_path = os.path.join(path, "site.zip")
-        with open(zip_path, "wb") as f_:
-            f_.write(downloaded)
-        with zipfile.ZipFile(zip_path, 'r') as z:
-            z.extractall(path)
-        os.remove(zip_path)
-    else:
-        with open(os.path.join(path, msg.document.file_name), "wb") as f_:
-            f_.write(downloaded)
-    db_query("UPDATE files SET name=?, type=?, date=? WHERE short_code=?",
-             (msg.document.file_name, ext if ext in ['html','zip'] else 'media', datetime.now().strftime("%Y-%m-%d %H:%M"), code))
+    os.replace(staging, path)
+    db_query("UPDATE files SET name=?, type=?, date=?, storage=? WHERE short_code=?",
+             (msg.document.file_name, file_type, datetime.now().strftime("%Y-%m-%d %H:%M"), storage, code))
+    invalidate_site(code)
+    invalidate_page(("profile", uid))
+    site_written(code, uid)
     bot.reply_to(msg, "✅ সাইট আপডেট হয়েছে!")
 
 # ================= EDIT HTML =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("edit_"))
-def edit_init(call):
-    code = call.data.split("_")[1]
+@callback_route("edit_", str)
+def edit_init(call, code):
     bot.send_message(call.message.chat.id, "📝 নতুন HTML কোড পাঠান অথবা .html ফাইল পাঠান:")
     bot.register_next_step_handler(call.message, edit_save, code)
 
+@conversation_step
 def edit_save(msg, code):
     uid = msg.from_user.id
     path = os.path.join(UPLOAD_DIR, str(uid), code, "index.html")
+    if not os.path.isdir(os.path.dirname(path)):
+        bot.reply_to(msg, "❌ পাওয়া যায়নি।")
+        return
+    new_size = (msg.document.file_size or 0) if msg.document else len((msg.text or "").encode())
+    old_size = os.path.getsize(path) if os.path.exists(path) else 0
+    if storage_exceeded(uid, new_size - old_size):
+        bot.reply_to(msg, "⚠️ আপনার স্টোরেজ কোটা শেষ!")
+        return
+    try:
+        unpack_archive(code, uid)
+    except Exception as e:
+        logger.error(f"Unpack error: {e}")
+        bot.reply_to(msg, "❌ সাইট আপডেট করা যায়নি।")
+        return
     if msg.document:
-        file_info = bot.get_file(msg.document.file_id)
-        content = bot.download_file(file_info.file_path)
-        with open(path, "wb") as f:
-            f.write(content)
+        # Staged outside the site folder, then swapped in (see incoming_path)
+        tmp = incoming_path("index.html")
+        try:
+            download_to_file(msg.document.file_id, tmp)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.error(f"Edit download error: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            bot.reply_to(msg, "❌ ফাইল ডাউনলোডে সমস্যা হয়েছে।")
+            return
     elif msg.text:
-        with open(path, "w", encoding="utf-8") as f:
-            f.write(msg.text)
+        write_text_file(path, msg.text)
     else:
         bot.reply_to(msg, "❌ HTML কোড বা ফাইল পাঠান।")
         return
+    site_written(code, uid)
     bot.reply_to(msg, "✅ সাইট আপডেট হয়েছে!")
 
 # ================= DELETE =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("del_"))
-def delete_site(call):
-    code = call.data.split("_")[1]
+@callback_route("del_", str)
+def delete_site(call, code):
     f = db_query("SELECT user_id FROM files WHERE short_code=?", (code,), fetchone=True)
     if not f or (f["user_id"] != call.from_user.id and not is_admin(call.from_user.id)):
         bot.answer_callback_query(call.id, "❌ অনুমতি নেই!", show_alert=True)
         return
-    db_query("DELETE FROM files WHERE short_code=?", (code,))
-    db_query("DELETE FROM site_views WHERE short_code=?", (code,))
-    try:
-        shutil.rmtree(os.path.join(UPLOAD_DIR, str(f["user_id"]), code))
-    except:
-        pass
+    purge_sites([(code, f["user_id"])])
     bot.edit_message_text("🗑 সাইট ডিলিট হয়েছে!", call.message.chat.id, call.message.message_id)
 
 # ================= REPORT SITE =================
-@bot.callback_query_handler(func=lambda c: c.data.startswith("report_"))
-def report_site(call):
-    code = call.data.split("_")[1]
+@callback_route("report_", str)
+def report_site(call, code):
     bot.send_message(call.message.chat.id, "⚠️ রিপোর্টের কারণ লিখুন:")
     bot.register_next_step_handler(call.message, save_report, code)
 
+@conversation_step
 def save_report(msg, code):
     db_query("INSERT INTO reports(reporter_id, short_code, reason, date) VALUES(?,?,?,?)",
              (msg.from_user.id, code, msg.text, datetime.now().strftime("%Y-%m-%d %H:%M")))
     bot.reply_to(msg, "✅ রিপোর্ট পাঠানো হয়েছে।")
-    bot.send_message(OWNER_ID, f"🚨 <b>নতুন রিপোর্ট</b>\n👤 Reporter: <code>{msg.from_user.id}</code>\n🔗 Code: {code}\n📝 কারণ: {msg.text}")
+    enqueue_side_effect("owner_message", text=f"🚨 <b>নতুন রিপোর্ট</b>\n👤 Reporter: <code>{msg.from_user.id}</code>\n🔗 Code: {code}\n📝 কারণ: {msg.text}")
 
 # ================= ACCOUNT =================
 @bot.message_handler(commands=["account"])
-@bot.message_handler(func=lambda m: m.text in ["👤 My Account", "👤 আমার একাউন্ট", "👤 मेरा अकाउंट", "👤 حسابي"])
+@menu_route("account")
 @banned_check
 def my_account(msg):
     uid = msg.from_user.id
     status = "Premium 💎" if is_premium(uid) else "ফ্রি ইউজার"
-    count = len(db_query("SELECT short_code FROM files WHERE user_id=?", (uid,), fetch=True) or [])
+    stats = get_user_stats(uid)
+    count = stats["sites"]
     u = db_query("SELECT joined_date, invites, username FROM users WHERE id=?", (uid,), fetchone=True)
     prem = db_query("SELECT expiry, plan FROM premium WHERE user_id=?", (uid,), fetchone=True)
     aff = db_query("SELECT ref_code, earnings, referrals FROM affiliates WHERE user_id=?", (uid,), fetchone=True)
@@ -1392,8 +2823,9 @@ def my_account(msg):
     aff_text = ""
     if aff:
         aff_text = f"\n🔗 Ref Code: <code>{aff['ref_code']}</code>\n💰 Earnings: {aff['earnings']} পয়েন্ট"
-    total_views = db_query("SELECT SUM(views) as v FROM files WHERE user_id=?", (uid,), fetchone=True)
-    views = total_views['v'] or 0 if total_views else 0
+    views = stats["views"]
+    quota = get_storage_quota(uid)
+    storage_text = format_bytes(stats["bytes"]) + (f" / {format_bytes(quota)}" if quota else "")
     profile_url = f"{DOMAIN}/u/{uid}"
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("🌐 পাবলিক প্রোফাইল", url=profile_url))
@@ -1405,6 +2837,7 @@ def my_account(msg):
         f"🌟 স্ট্যাটাস: {status}{prem_text}\n"
         f"📂 ফাইল: {count}/{get_limit(uid)}\n"
         f"👁 মোট Views: {views}\n"
+        f"💾 Storage: {storage_text}\n"
         f"👫 রেফারেল: {u['invites'] if u else 0}{aff_text}\n"
         f"📅 যোগদান: {u['joined_date'] if u else 'N/A'}",
         reply_markup=kb
@@ -1412,13 +2845,13 @@ def my_account(msg):
 
 # ================= REFERRAL =================
 @bot.message_handler(commands=["referral"])
-@bot.message_handler(func=lambda m: m.text in ["👫 Referral", "👫 রেফারেল", "👫 रेफरल", "👫 إحالة"])
+@menu_route("referral")
 @banned_check
 def referral_sys(msg):
     uid = msg.from_user.id
     u = db_query("SELECT invites FROM users WHERE id=?", (uid,), fetchone=True)
     inv = u["invites"] if u else 0
-    link = f"https://t.me/{bot.get_me().username}?start={uid}"
+    link = f"https://t.me/{bot_username()}?start={uid}"
     bot.send_message(
         msg.chat.id,
         f"👫 <b>রেফারেল প্রোগ্রাম</b>\n\n"
@@ -1429,7 +2862,7 @@ def referral_sys(msg):
     )
 
 # ================= BUY PREMIUM =================
-@bot.message_handler(func=lambda m: m.text in ["💎 Buy Premium", "💎 প্রিমিয়াম কিনুন", "💎 प्रीमियम खरीदें", "💎 اشترك بريميوم"])
+@menu_route("premium")
 @banned_check
 def buy_prem_msg(msg):
     show_premium(msg, msg.from_user.id)
@@ -1454,11 +2887,12 @@ def show_premium(msg, uid):
     )
 
 # Coupon system
-@bot.callback_query_handler(func=lambda c: c.data == "use_coupon")
+@callback_route("use_coupon")
 def ask_coupon(call):
     bot.send_message(call.message.chat.id, "🎟 Coupon কোড লিখুন:")
     bot.register_next_step_handler(call.message, apply_coupon)
 
+@conversation_step
 def apply_coupon(msg):
     code = msg.text.strip().upper()
     coupon = db_query("SELECT * FROM coupons WHERE code=?", (code,), fetchone=True)
@@ -1477,12 +2911,13 @@ def apply_coupon(msg):
     days = int(plan_days * (1 - coupon['discount'] / 100)) if coupon['discount'] < 100 else plan_days
     expiry = (datetime.now() + timedelta(days=days)).isoformat()
     db_query("INSERT OR REPLACE INTO premium VALUES(?,?,?)", (uid, expiry, f"coupon_{code}"))
+    schedule_expiry_check()
+    invalidate_user(uid)
     db_query("UPDATE coupons SET uses_left=uses_left-1 WHERE code=?", (code,))
     bot.reply_to(msg, f"🎉 Coupon সফলভাবে প্রয়োগ! আপনি {days} দিনের Premium পেয়েছেন!")
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("plan_"))
-def plan_selected(call):
-    plan = call.data.split("_")[1]
+@callback_route("plan_", str)
+def plan_selected(call, plan):
     plans = {"silver": ("৩০ দিন", "30"), "gold": ("৯০ দিন", "90"), "lifetime": ("Lifetime", "99999")}
     plan_name, days = plans.get(plan, ("Custom", "30"))
     bot.send_message(
@@ -1491,6 +2926,7 @@ def plan_selected(call):
     )
     bot.register_next_step_handler(call.message, receive_txn, plan, days)
 
+@conversation_step
 def receive_txn(msg, plan, days):
     txn = msg.text.strip()
     date = datetime.now().strftime("%Y-%m-%d %H:%M")
@@ -1499,41 +2935,40 @@ def receive_txn(msg, plan, days):
     bot.reply_to(msg, "✅ পেমেন্ট রিকোয়েস্ট পাঠানো হয়েছে! অ্যাডমিন যাচাই করবেন।")
     kb = types.InlineKeyboardMarkup()
     kb.row(
-        types.InlineKeyboardButton("✅ অনুমোদন", callback_data=f"apppay_{msg.from_user.id}_{days}_{plan}"),
-        types.InlineKeyboardButton("❌ প্রত্যাখ্যান", callback_data=f"rejpay_{msg.from_user.id}")
+        types.InlineKeyboardButton("✅ অনুমোদন", callback_data=cb("apppay_", msg.from_user.id, days, plan)),
+        types.InlineKeyboardButton("❌ প্রত্যাখ্যান", callback_data=cb("rejpay_", msg.from_user.id))
     )
-    bot.send_message(OWNER_ID,
-        f"💳 <b>নতুন পেমেন্ট রিকোয়েস্ট</b>\n"
+    enqueue_side_effect("owner_message",
+        text=f"💳 <b>নতুন পেমেন্ট রিকোয়েস্ট</b>\n"
         f"👤 User: <code>{msg.from_user.id}</code>\n"
         f"📦 প্ল্যান: {plan}\n"
         f"🔢 TXN ID: <code>{txn}</code>\n"
-        f"📅 তারিখ: {date}", reply_markup=kb)
+        f"📅 তারিখ: {date}", reply_markup=kb.to_json())
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("apppay_"))
-def approve_payment(call):
+@callback_route("apppay_", int, int, str)
+def approve_payment(call, uid, days, plan):
     if not is_admin(call.from_user.id):
         return
-    parts = call.data.split("_")
-    uid, days, plan = parts[1], parts[2], parts[3]
-    expiry = (datetime.now() + timedelta(days=int(days))).isoformat()
-    db_query("INSERT OR REPLACE INTO premium VALUES(?,?,?)", (int(uid), expiry, plan))
-    db_query("UPDATE payment_requests SET status='approved' WHERE user_id=? ORDER BY id DESC LIMIT 1", (int(uid),))
+    expiry = (datetime.now() + timedelta(days=days)).isoformat()
+    db_query("INSERT OR REPLACE INTO premium VALUES(?,?,?)", (uid, expiry, plan))
+    schedule_expiry_check()
+    invalidate_user(uid)
+    db_query("UPDATE payment_requests SET status='approved' WHERE user_id=? ORDER BY id DESC LIMIT 1", (uid,))
     bot.answer_callback_query(call.id, "✅ অনুমোদিত!")
     bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id)
     try:
-        bot.send_message(int(uid), f"🎉 আপনার প্রিমিয়াম অ্যাক্টিভ হয়েছে!\n💎 প্ল্যান: {plan}\n⏰ মেয়াদ: {days} দিন")
+        bot.send_message(uid, f"🎉 আপনার প্রিমিয়াম অ্যাক্টিভ হয়েছে!\n💎 প্ল্যান: {plan}\n⏰ মেয়াদ: {days} দিন")
     except:
         pass
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("rejpay_"))
-def reject_payment(call):
+@callback_route("rejpay_", int)
+def reject_payment(call, uid):
     if not is_admin(call.from_user.id):
         return
-    uid = call.data.split("_")[1]
-    db_query("UPDATE payment_requests SET status='rejected' WHERE user_id=? ORDER BY id DESC LIMIT 1", (int(uid),))
+    db_query("UPDATE payment_requests SET status='rejected' WHERE user_id=? ORDER BY id DESC LIMIT 1", (uid,))
     bot.answer_callback_query(call.id, "❌ প্রত্যাখ্যান করা হয়েছে!")
     try:
-        bot.send_message(int(uid), "❌ আপনার পেমেন্ট রিকোয়েস্ট প্রত্যাখ্যান হয়েছে।")
+        bot.send_message(uid, "❌ আপনার পেমেন্ট রিকোয়েস্ট প্রত্যাখ্যান হয়েছে।")
     except:
         pass
 
@@ -1575,18 +3010,19 @@ def inline_query(query):
         logger.error(f"Inline error: {e}")
 
 # ================= ADMIN PANEL =================
-@bot.message_handler(func=lambda m: is_admin(m.from_user.id) and m.text == "📊 Stats")
+@menu_route("stats", admin=True)
 def bot_stats(msg):
     u = db_query("SELECT COUNT(*) as c FROM users", fetchone=True)["c"]
     f = db_query("SELECT COUNT(*) as c FROM files", fetchone=True)["c"]
     p = db_query("SELECT COUNT(*) as c FROM premium", fetchone=True)["c"]
-    v = db_query("SELECT SUM(views) as c FROM files", fetchone=True)["c"] or 0
+    v = db_query("SELECT SUM(views) as c FROM user_stats", fetchone=True)["c"] or 0
     storage = get_storage_used()
     today = datetime.now().strftime("%Y-%m-%d")
     today_uploads = db_query("SELECT COUNT(*) as c FROM files WHERE date LIKE ?", (f"{today}%",), fetchone=True)["c"] or 0
     today_users = db_query("SELECT COUNT(*) as c FROM users WHERE joined_date LIKE ?", (f"{today}%",), fetchone=True)["c"] or 0
     top_sites = db_query("SELECT name, views FROM files ORDER BY views DESC LIMIT 5", fetch=True) or []
     top_text = "".join(f"\n  {i+1}. {s['name'][:20]}: {s['views']} views" for i, s in enumerate(top_sites))
+    side_pending, side_dead = side_job_counts()
     bot.send_message(
         msg.chat.id,
         f"📊 <b>বট পরিসংখ্যান</b>\n\n"
@@ -1594,28 +3030,194 @@ def bot_stats(msg):
         f"📂 মোট সাইট: <b>{f}</b> (+{today_uploads} আজ)\n"
         f"💎 প্রিমিয়াম ইউজার: <b>{p}</b>\n"
         f"👁 মোট Views: <b>{v}</b>\n"
-        f"💾 Storage: <b>{format_bytes(storage)}</b>\n\n"
+        f"💾 Storage: <b>{format_bytes(storage)}</b>\n"
+        f"🔥 Hot cache: <b>{_hot_stats['hits']}</b> hit / <b>{_hot_stats['misses']}</b> miss ({format_bytes(_hot_bytes)})\n"
+        f"📥 Update queue: <b>{update_queue_depth()}</b> waiting, {_update_stats['handled']} handled, "
+        f"{_update_stats['errors']} errors\n"
+        f"📮 Side jobs: <b>{side_pending}</b> pending, {side_dead} dead\n\n"
         f"🏆 সর্বোচ্চ ভিজিটেড:{top_text or ' N/A'}"
     )
 
-@bot.message_handler(func=lambda m: is_admin(m.from_user.id) and m.text == "📣 Broadcast")
+# ================= BROADCAST =================
+# Jobs live in the broadcasts table; cursor = last user id handled, so a
+# restart continues where it stopped (at most one batch is re-sent).
+# owner/lease make sure only one process sends a job at a time.
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 8))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))   # msgs/sec, Telegram allows ~30 globally
+BROADCAST_BATCH = 100
+BROADCAST_PROGRESS_EVERY = 5    # seconds between progress edits
+BROADCAST_LEASE = 120           # seconds; a job whose owner stops renewing is taken over
+
+_bc_pool = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix="bcast")
+_bc_lock = Lock()
+_bc_next_slot = 0.0
+_bc_pause_until = 0.0
+_bc_running = set()
+_bc_owner = f"{os.getpid()}-{secrets.token_hex(4)}"    # this process, in broadcasts.owner
+
+def bc_throttle():
+    """সব worker মিলে BROADCAST_RATE এর বেশি পাঠাবে না"""
+    global _bc_next_slot
+    with _bc_lock:
+        now = time.monotonic()
+        slot = max(now, _bc_next_slot, _bc_pause_until)
+        _bc_next_slot = slot + 1.0 / BROADCAST_RATE
+    if slot > now:
+        time.sleep(slot - now)
+
+def bc_backoff(seconds):
+    # 429 is global for the bot, so every worker waits
+    global _bc_pause_until
+    with _bc_lock:
+        _bc_pause_until = max(_bc_pause_until, time.monotonic() + seconds)
+
+def bc_send(uid, from_chat, message_id):
+    for _ in range(5):
+        bc_throttle()
+        try:
+            bot.copy_message(uid, from_chat, message_id)
+            return "sent"
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                params = (e.result_json or {}).get("parameters") or {}
+                bc_backoff(params.get("retry_after", 5) + 1)
+                continue
+            if e.error_code == 403:
+                return "blocked"
+            return "failed"
+        except Exception:
+            return "failed"
+    return "failed"
+
+def bc_keyboard(bid, status):
+    kb = types.InlineKeyboardMarkup()
+    if status == "running":
+        kb.row(types.InlineKeyboardButton("⏸ Pause", callback_data=cb("bc_", "pause", bid)),
+               types.InlineKeyboardButton("✖ Cancel", callback_data=cb("bc_", "cancel", bid)))
+    elif status == "paused":
+        kb.row(types.InlineKeyboardButton("▶ Resume", callback_data=cb("bc_", "resume", bid)),
+               types.InlineKeyboardButton("✖ Cancel", callback_data=cb("bc_", "cancel", bid)))
+    return kb
+
+def bc_report(bid):
+    job = db_query("SELECT * FROM broadcasts WHERE id=?", (bid,), fetchone=True)
+    if not job or not job["progress_msg"]:
+        return
+    icons = {"running": "⏳", "paused": "⏸", "cancelled": "✖", "done": "✅"}
+    done = job["sent"] + job["failed"] + job["blocked"]
+    text = (f"📣 <b>ব্রডকাস্ট #{bid}</b> {icons.get(job['status'], '')} {job['status']}\n\n"
+            f"📊 {done}/{job['total']}\n"
+            f"✅ পাঠানো: {job['sent']}\n"
+            f"❌ ব্যর্থ: {job['failed']}\n"
+            f"🚫 ব্লক করেছে: {job['blocked']}")
+    try:
+        bot.edit_message_text(text, job["admin_id"], job["progress_msg"], reply_markup=bc_keyboard(bid, job["status"]))
+    except: pass
+
+def claim_broadcast(bid):
+    """একটাই process একটা job চালাবে — lease শেষ না হলে অন্যরা পাবে না"""
+    now = time.time()
+    with db_tx() as con:
+        return con.execute("UPDATE broadcasts SET owner=?, lease=? WHERE id=? AND status='running' "
+                           "AND (owner IS NULL OR owner=? OR lease<?)",
+                           (_bc_owner, now + BROADCAST_LEASE, bid, _bc_owner, now)).rowcount > 0
+
+def run_broadcast(bid):
+    last_report = 0
+    try:
+        while True:
+            # Renewing the lease also checks we still own the job
+            if not claim_broadcast(bid):
+                break
+            job = db_query("SELECT * FROM broadcasts WHERE id=?", (bid,), fetchone=True)
+            if not job or job["status"] != "running":
+                break
+            users = db_query("SELECT id FROM users WHERE id>? AND blocked=0 ORDER BY id LIMIT ?",
+                             (job["cursor"], BROADCAST_BATCH), fetch=True)
+            if not users:
+                db_query("UPDATE broadcasts SET status='done', updated=? WHERE id=? AND status='running'",
+                         (datetime.now().isoformat(), bid))
+                break
+            ids = [u["id"] for u in users]
+            results = list(_bc_pool.map(lambda uid: bc_send(uid, job["from_chat"], job["message_id"]), ids))
+            blocked = [uid for uid, r in zip(ids, results) if r == "blocked"]
+            with db_tx() as con:
+                con.execute("UPDATE broadcasts SET cursor=?, sent=sent+?, failed=failed+?, blocked=blocked+?, updated=? WHERE id=? AND owner=?",
+                            (ids[-1], results.count("sent"), results.count("failed"), len(blocked),
+                             datetime.now().isoformat(), bid, _bc_owner))
+                con.executemany("UPDATE users SET blocked=1 WHERE id=?", [(uid,) for uid in blocked])
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_EVERY:
+                bc_report(bid)
+                last_report = time.monotonic()
+    except Exception as e:
+        logger.error(f"Broadcast #{bid}: {e}")
+    finally:
+        db_query("UPDATE broadcasts SET owner=NULL WHERE id=? AND owner=?", (bid, _bc_owner))
+        with _bc_lock:
+            _bc_running.discard(bid)
+        bc_report(bid)
+
+def start_broadcast(bid):
+    with _bc_lock:
+        if bid in _bc_running:
+            return
+        _bc_running.add(bid)
+    try:
+        claimed = claim_broadcast(bid)
+    except Exception as e:
+        logger.error(f"Broadcast #{bid} claim: {e}")
+        claimed = False
+    if not claimed:
+        # Another process is sending it (or it is not running any more)
+        with _bc_lock:
+            _bc_running.discard(bid)
+        return
+    Thread(target=run_broadcast, args=(bid,), daemon=True).start()
+
+def resume_broadcasts():
+    for job in db_query("SELECT id FROM broadcasts WHERE status='running'", fetch=True) or []:
+        start_broadcast(job["id"])
+
+def broadcast_resumer():
+    # Picks up jobs whose owner process died once their lease runs out
+    while True:
+        try:
+            resume_broadcasts()
+        except Exception as e:
+            logger.error(f"Broadcast resumer: {e}")
+        time.sleep(BROADCAST_LEASE)
+
+@menu_route("broadcast", admin=True)
 def bc_init(msg):
     bot.send_message(msg.chat.id, "📣 ব্রডকাস্ট মেসেজ পাঠান:")
     bot.register_next_step_handler(msg, bc_process)
 
+@conversation_step
 def bc_process(msg):
-    users = db_query("SELECT id FROM users", fetch=True)
-    count = 0
-    for u in users:
-        try:
-            bot.copy_message(u["id"], msg.chat.id, msg.message_id)
-            count += 1
-            time.sleep(0.05)
-        except:
-            continue
-    bot.send_message(msg.chat.id, f"✅ {count} জনকে ব্রডকাস্ট পাঠানো হয়েছে।")
+    total = db_query("SELECT COUNT(*) as c FROM users WHERE blocked=0", fetchone=True)["c"]
+    now = datetime.now().isoformat()
+    with db_tx() as con:
+        bid = con.execute("INSERT INTO broadcasts(admin_id, from_chat, message_id, total, created, updated) VALUES(?,?,?,?,?,?)",
+                          (msg.from_user.id, msg.chat.id, msg.message_id, total, now, now)).lastrowid
+    progress = bot.send_message(msg.chat.id, f"📣 ব্রডকাস্ট #{bid} শুরু হচ্ছে... ({total} জন)", reply_markup=bc_keyboard(bid, "running"))
+    db_query("UPDATE broadcasts SET progress_msg=? WHERE id=?", (progress.message_id, bid))
+    log_action(msg.from_user.id, "broadcast", f"#{bid}")
+    start_broadcast(bid)
+
+@callback_route("bc_", str, int)
+def bc_control(call, action, bid):
+    if not is_admin(call.from_user.id) or action not in ("pause", "resume", "cancel"): return
+    if action == "pause":
+        db_query("UPDATE broadcasts SET status='paused', updated=? WHERE id=? AND status='running'", (datetime.now().isoformat(), bid))
+    elif action == "resume":
+        db_query("UPDATE broadcasts SET status='running', updated=? WHERE id=? AND status='paused'", (datetime.now().isoformat(), bid))
+        start_broadcast(bid)
+    else:
+        db_query("UPDATE broadcasts SET status='cancelled', updated=? WHERE id=? AND status IN ('running','paused')", (datetime.now().isoformat(), bid))
+    bot.answer_callback_query(call.id, "✅")
+    bc_report(bid)
 
-@bot.message_handler(func=lambda m: is_admin(m.from_user.id) and m.text == "⚙ Admin Panel")
+@menu_route("admin", admin=True)
 def admin_menu(msg):
     kb = types.InlineKeyboardMarkup()
     kb.row(
@@ -1654,7 +3256,7 @@ def admin_menu(msg):
     bot.send_message(msg.chat.id, "⚙ <b>অ্যাডমিন প্যানেল</b>", reply_markup=kb)
 
 # --- Premium List ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_premlist")
+@callback_route("adm_premlist")
 def premium_list(call):
     if not is_admin(call.from_user.id): return
     prems = db_query("SELECT user_id, expiry, plan FROM premium", fetch=True)
@@ -1667,22 +3269,22 @@ def premium_list(call):
         exp = p["expiry"][:10]
         active = "✅" if datetime.fromisoformat(p["expiry"]) > datetime.now() else "❌"
         text += f"{active} <code>{p['user_id']}</code> | {p['plan']} | {exp}\n"
-        kb.add(types.InlineKeyboardButton(f"🗑 Remove: {p['user_id']}", callback_data=f"rem_prem_{p['user_id']}"))
+        kb.add(types.InlineKeyboardButton(f"🗑 Remove: {p['user_id']}", callback_data=cb("rem_prem_", p['user_id'])))
     bot.send_message(call.message.chat.id, text, reply_markup=kb)
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("rem_prem_"))
-def remove_premium(call):
+@callback_route("rem_prem_", int)
+def remove_premium(call, uid):
     if not is_admin(call.from_user.id): return
-    uid = int(call.data.split("_")[2])
     db_query("DELETE FROM premium WHERE user_id=?", (uid,))
+    invalidate_user(uid)
     bot.answer_callback_query(call.id, f"✅ User {uid} এর Premium সরানো হয়েছে!", show_alert=True)
     try:
         bot.send_message(uid, "⚠️ আপনার Premium মেম্বারশিপ সরানো হয়েছে।")
     except: pass
 
 # --- User list ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_users")
+@callback_route("adm_users")
 def list_all_users(call):
     if not is_admin(call.from_user.id): return
     users = db_query("SELECT id, joined_date FROM users ORDER BY id DESC LIMIT 20", fetch=True)
@@ -1694,38 +3296,40 @@ def list_all_users(call):
     bot.answer_callback_query(call.id)
 
 # --- User Export CSV ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_export")
+@callback_route("adm_export")
 def export_users(call):
     if not is_admin(call.from_user.id): return
     bot.answer_callback_query(call.id, "⏳ CSV তৈরি হচ্ছে...")
-    users = db_query("SELECT id, username, joined_date, invites FROM users ORDER BY id", fetch=True)
+    users = db_query("SELECT u.id, u.username, u.joined_date, u.invites, COALESCE(s.sites,0) as sites FROM users u "
+                     "LEFT JOIN user_stats s ON s.user_id=u.id ORDER BY u.id", fetch=True)
     buf = io.StringIO()
     writer = csv.writer(buf)
     writer.writerow(["ID", "Username", "Joined", "Invites", "Premium", "Files"])
     for u in (users or []):
         prem = "Yes" if is_premium(u["id"]) else "No"
-        fc = len(db_query("SELECT short_code FROM files WHERE user_id=?", (u["id"],), fetch=True) or [])
-        writer.writerow([u["id"], u["username"] or "", u["joined_date"] or "", u["invites"], prem, fc])
+        writer.writerow([u["id"], u["username"] or "", u["joined_date"] or "", u["invites"], prem, u["sites"]])
     out = io.BytesIO(buf.getvalue().encode())
     out.name = f"users_{datetime.now().strftime('%Y%m%d')}.csv"
     bot.send_document(call.message.chat.id, out, caption="📤 ইউজার CSV এক্সপোর্ট")
 
 # --- Storage Monitor ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_storage")
+@callback_route("adm_storage")
 def storage_monitor(call):
     if not is_admin(call.from_user.id): return
     total = get_storage_used()
     file_count = db_query("SELECT COUNT(*) as c FROM files", fetchone=True)["c"]
     user_count = db_query("SELECT COUNT(DISTINCT user_id) as c FROM files", fetchone=True)["c"]
+    blobs = db_query("SELECT COUNT(*) as c, COALESCE(SUM(size),0) as b FROM blobs", fetchone=True)
     bot.answer_callback_query(call.id)
     bot.send_message(call.message.chat.id,
                      f"💾 <b>Storage Monitor</b>\n\n"
                      f"📁 মোট ফাইল: {file_count}\n"
                      f"👥 Active Users: {user_count}\n"
-                     f"💽 Total Used: <b>{format_bytes(total)}</b>")
+                     f"💽 Total Used: <b>{format_bytes(total)}</b>\n"
+                     f"🧩 Unique on disk: <b>{format_bytes(blobs['b'])}</b> ({blobs['c']} blobs)")
 
 # --- Bot Logs ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_logs")
+@callback_route("adm_logs")
 def show_logs(call):
     if not is_admin(call.from_user.id): return
     logs = db_query("SELECT user_id, action, detail, date FROM bot_logs ORDER BY id DESC LIMIT 20", fetch=True) or []
@@ -1736,7 +3340,7 @@ def show_logs(call):
     bot.send_message(call.message.chat.id, text[:4000])
 
 # --- Coupon Admin ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_coupon")
+@callback_route("adm_coupon")
 def admin_coupon(call):
     if not is_admin(call.from_user.id): return
     kb = types.InlineKeyboardMarkup()
@@ -1746,12 +3350,13 @@ def admin_coupon(call):
     )
     bot.edit_message_text("🎟 <b>Coupon ম্যানেজমেন্ট</b>", call.message.chat.id, call.message.message_id, reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data == "coupon_create")
+@callback_route("coupon_create")
 def create_coupon_ask(call):
     if not is_admin(call.from_user.id): return
     bot.send_message(call.message.chat.id, "🎟 Coupon তৈরি করুন:\nফরম্যাট: CODE DISCOUNT_PERCENT PLAN USES_COUNT\nউদাহরণ: SAVE50 50 silver 100")
     bot.register_next_step_handler(call.message, create_coupon_save)
 
+@conversation_step
 def create_coupon_save(msg):
     if not is_admin(msg.from_user.id): return
     try:
@@ -1763,7 +3368,7 @@ def create_coupon_save(msg):
     except:
         bot.reply_to(msg, "❌ ভুল ফরম্যাট।")
 
-@bot.callback_query_handler(func=lambda c: c.data == "coupon_list")
+@callback_route("coupon_list")
 def list_coupons(call):
     if not is_admin(call.from_user.id): return
     coupons = db_query("SELECT * FROM coupons", fetch=True) or []
@@ -1777,12 +3382,13 @@ def list_coupons(call):
     bot.answer_callback_query(call.id)
 
 # --- Bulk Delete ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_bulkdel")
+@callback_route("adm_bulkdel")
 def bulk_delete_ask(call):
     if not is_admin(call.from_user.id): return
     bot.send_message(call.message.chat.id, "🗑 Bulk Delete:\nকোন ইউজারের সব ফাইল ডিলিট করবেন? User ID পাঠান:")
     bot.register_next_step_handler(call.message, bulk_delete_do)
 
+@conversation_step
 def bulk_delete_do(msg):
     if not is_admin(msg.from_user.id): return
     uid = msg.text.strip()
@@ -1790,20 +3396,16 @@ def bulk_delete_do(msg):
         bot.reply_to(msg, "❌ বৈধ ID দিন।")
         return
     files = db_query("SELECT short_code FROM files WHERE user_id=?", (int(uid),), fetch=True) or []
-    for f in files:
-        db_query("DELETE FROM site_views WHERE short_code=?", (f["short_code"],))
-        try:
-            shutil.rmtree(os.path.join(UPLOAD_DIR, uid, f["short_code"]))
-        except: pass
-    db_query("DELETE FROM files WHERE user_id=?", (int(uid),))
+    purge_sites((f["short_code"], int(uid)) for f in files)
     bot.reply_to(msg, f"✅ User {uid} এর {len(files)}টি ফাইল ডিলিট হয়েছে।")
 
 # --- Search user ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_search")
+@callback_route("adm_search")
 def search_user_ask(call):
     bot.send_message(call.message.chat.id, "🔍 ইউজার ID লিখুন:")
     bot.register_next_step_handler(call.message, search_user_show)
 
+@conversation_step
 def search_user_show(msg):
     uid = msg.text.strip()
     if not uid.isdigit():
@@ -1813,15 +3415,15 @@ def search_user_show(msg):
     if not u:
         bot.reply_to(msg, "❌ ইউজার পাওয়া যায়নি।")
         return
-    files_count = len(db_query("SELECT short_code FROM files WHERE user_id=?", (int(uid),), fetch=True) or [])
+    files_count = get_user_stats(int(uid))["sites"]
     prem = "💎 Premium" if is_premium(int(uid)) else "🆓 Free"
     banned = "🚫 Banned" if is_banned(int(uid)) else "✅ Active"
     kb = types.InlineKeyboardMarkup()
     kb.row(
-        types.InlineKeyboardButton("🚫 Ban/Unban", callback_data=f"ban_user_{uid}"),
-        types.InlineKeyboardButton("💎 Premium দিন", callback_data=f"quick_prem_{uid}")
+        types.InlineKeyboardButton("🚫 Ban/Unban", callback_data=cb("ban_user_", uid)),
+        types.InlineKeyboardButton("💎 Premium দিন", callback_data=cb("quick_prem_", uid))
     )
-    kb.add(types.InlineKeyboardButton("🗑 Premium সরান", callback_data=f"rem_prem_{uid}"))
+    kb.add(types.InlineKeyboardButton("🗑 Premium সরান", callback_data=cb("rem_prem_", uid)))
     bot.send_message(msg.chat.id,
         f"👤 <b>ইউজার তথ্য</b>\n\n"
         f"🆔 ID: <code>{uid}</code>\n"
@@ -1831,10 +3433,9 @@ def search_user_show(msg):
         f"⚡ অ্যাকাউন্ট: {banned}\n"
         f"📅 যোগদান: {u['joined_date'] or 'N/A'}", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("ban_user_"))
-def quick_ban(call):
+@callback_route("ban_user_", int)
+def quick_ban(call, uid):
     if not is_admin(call.from_user.id): return
-    uid = call.data.split("_")[2]
     key = f"ban_{uid}"
     if db_query("SELECT 1 FROM settings WHERE key=?", (key,), fetch=True):
         db_query("DELETE FROM settings WHERE key=?", (key,))
@@ -1842,14 +3443,15 @@ def quick_ban(call):
     else:
         db_query("INSERT INTO settings VALUES(?,?)", (key, "true"))
         bot.answer_callback_query(call.id, f"🚫 User {uid} Banned!", show_alert=True)
+    invalidate_user(uid)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("quick_prem_"))
-def quick_premium(call):
+@callback_route("quick_prem_", int)
+def quick_premium(call, uid):
     if not is_admin(call.from_user.id): return
-    uid = int(call.data.split("_")[2])
     bot.send_message(call.message.chat.id, f"User {uid} কে কত দিনের প্রিমিয়াম দেবেন?")
     bot.register_next_step_handler(call.message, quick_prem_save, uid)
 
+@conversation_step
 def quick_prem_save(msg, uid):
     if not msg.text.isdigit():
         bot.reply_to(msg, "❌ সংখ্যা দিন।")
@@ -1857,13 +3459,15 @@ def quick_prem_save(msg, uid):
     days = int(msg.text)
     expiry = (datetime.now() + timedelta(days=days)).isoformat()
     db_query("INSERT OR REPLACE INTO premium VALUES(?,?,?)", (uid, expiry, "admin_gift"))
+    schedule_expiry_check()
+    invalidate_user(uid)
     bot.reply_to(msg, f"✅ User {uid} কে {days} দিনের Premium দেওয়া হয়েছে!")
     try:
         bot.send_message(uid, f"💎 আপনি {days} দিনের Premium পেয়েছেন!")
     except: pass
 
 # --- Channels ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_ch")
+@callback_route("adm_ch")
 def adm_ch_manage(call):
     channels = db_query("SELECT username FROM force_channels", fetch=True)
     text = "📢 <b>Force Join Channels:</b>\n"
@@ -1876,35 +3480,40 @@ def adm_ch_manage(call):
     )
     bot.edit_message_text(text or "কোনো চ্যানেল নেই।", call.message.chat.id, call.message.message_id, reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda c: c.data == "ch_add")
+@callback_route("ch_add")
 def ch_add_ask(call):
     bot.send_message(call.message.chat.id, "চ্যানেল Username পাঠান (@ ছাড়া):")
     bot.register_next_step_handler(call.message, ch_add_save)
 
+@conversation_step
 def ch_add_save(msg):
     db_query("INSERT OR IGNORE INTO force_channels VALUES(?)", (msg.text.strip(),))
     bot.send_message(msg.chat.id, "✅ চ্যানেল যোগ করা হয়েছে!")
 
-@bot.callback_query_handler(func=lambda c: c.data == "ch_rem")
+@callback_route("ch_rem")
 def ch_rem_ask(call):
     bot.send_message(call.message.chat.id, "সরাতে চ্যানেল Username পাঠান:")
     bot.register_next_step_handler(call.message, ch_rem_del)
 
+@conversation_step
 def ch_rem_del(msg):
     db_query("DELETE FROM force_channels WHERE username=?", (msg.text.strip(),))
     bot.send_message(msg.chat.id, "🗑 চ্যানেল সরানো হয়েছে!")
 
 # --- Give Premium ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_give")
+@callback_route("adm_give")
 def give_prem_ask(call):
     bot.send_message(call.message.chat.id, "UserID এবং দিন লিখুন (উদাহরণ: 123456 30):")
     bot.register_next_step_handler(call.message, give_prem_save)
 
+@conversation_step
 def give_prem_save(msg):
     try:
         uid, days = msg.text.split()
         expiry = (datetime.now() + timedelta(days=int(days))).isoformat()
         db_query("INSERT OR REPLACE INTO premium VALUES(?,?,?)", (int(uid), expiry, "admin_gift"))
+        schedule_expiry_check()
+        invalidate_user(uid)
         bot.send_message(msg.chat.id, f"✅ User {uid} কে {days} দিনের Premium দেওয়া হয়েছে।")
         try:
             bot.send_message(int(uid), f"💎 আপনি {days} দিনের Premium পেয়েছেন!")
@@ -1913,11 +3522,12 @@ def give_prem_save(msg):
         bot.send_message(msg.chat.id, "❌ ভুল ফরম্যাট। উদাহরণ: 123456 30")
 
 # --- Ban ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_ban")
+@callback_route("adm_ban")
 def ban_ask(call):
     bot.send_message(call.message.chat.id, "Ban/Unban করতে User ID পাঠান:")
     bot.register_next_step_handler(call.message, ban_save)
 
+@conversation_step
 def ban_save(msg):
     uid = msg.text.strip()
     key = f"ban_{uid}"
@@ -1927,9 +3537,10 @@ def ban_save(msg):
     else:
         db_query("INSERT INTO settings VALUES(?,?)", (key, "true"))
         bot.send_message(msg.chat.id, f"🚫 User {uid} Ban করা হয়েছে।")
+    invalidate_user(uid)
 
 # --- Add/Remove Admin ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_addadmin")
+@callback_route("adm_addadmin")
 def add_admin_ask(call):
     if call.from_user.id != OWNER_ID:
         bot.answer_callback_query(call.id, "শুধু Owner করতে পারবেন!", show_alert=True)
@@ -1937,16 +3548,18 @@ def add_admin_ask(call):
     bot.send_message(call.message.chat.id, "নতুন Admin এর User ID পাঠান:")
     bot.register_next_step_handler(call.message, add_admin_save)
 
+@conversation_step
 def add_admin_save(msg):
     uid = msg.text.strip()
     if uid.isdigit():
         db_query("INSERT OR IGNORE INTO admins VALUES(?)", (int(uid),))
+        invalidate_user(uid)
         bot.send_message(msg.chat.id, f"✅ User {uid} কে Admin করা হয়েছে!")
         try:
             bot.send_message(int(uid), "🎉 আপনাকে Admin করা হয়েছে!")
         except: pass
 
-@bot.callback_query_handler(func=lambda c: c.data == "adm_remadmin")
+@callback_route("adm_remadmin")
 def rem_admin_ask(call):
     if call.from_user.id != OWNER_ID:
         bot.answer_callback_query(call.id, "শুধু Owner করতে পারবেন!", show_alert=True)
@@ -1957,19 +3570,19 @@ def rem_admin_ask(call):
     for a in admins:
         if a["id"] != OWNER_ID:
             text += f"• <code>{a['id']}</code>\n"
-            kb.add(types.InlineKeyboardButton(f"❌ Remove {a['id']}", callback_data=f"remadm_{a['id']}"))
+            kb.add(types.InlineKeyboardButton(f"❌ Remove {a['id']}", callback_data=cb("remadm_", a['id'])))
     bot.send_message(call.message.chat.id, text, reply_markup=kb)
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("remadm_"))
-def remove_admin(call):
+@callback_route("remadm_", int)
+def remove_admin(call, uid):
     if call.from_user.id != OWNER_ID: return
-    uid = int(call.data.split("_")[1])
     db_query("DELETE FROM admins WHERE id=?", (uid,))
+    invalidate_user(uid)
     bot.answer_callback_query(call.id, f"✅ Admin {uid} সরানো হয়েছে!", show_alert=True)
 
 # --- Maintenance ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_maintenance")
+@callback_route("adm_maintenance")
 def toggle_maintenance(call):
     current = db_query("SELECT value FROM settings WHERE key='maintenance'", fetchone=True)
     if current and current["value"] == "on":
@@ -1978,9 +3591,10 @@ def toggle_maintenance(call):
     else:
         db_query("INSERT OR REPLACE INTO settings VALUES('maintenance','on')")
         bot.answer_callback_query(call.id, "🔧 Maintenance ON!", show_alert=True)
+    invalidate_maintenance()
 
 # --- Reports ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_reports")
+@callback_route("adm_reports")
 def show_reports(call):
     reports = db_query("SELECT * FROM reports WHERE status='pending' LIMIT 10", fetch=True)
     if not reports:
@@ -1989,8 +3603,8 @@ def show_reports(call):
     for r in reports:
         kb = types.InlineKeyboardMarkup()
         kb.row(
-            types.InlineKeyboardButton("🗑 ডিলিট করুন", callback_data=f"del_{r['short_code']}"),
-            types.InlineKeyboardButton("✅ Dismiss", callback_data=f"dismiss_report_{r['id']}")
+            types.InlineKeyboardButton("🗑 ডিলিট করুন", callback_data=cb("del_", r['short_code'])),
+            types.InlineKeyboardButton("✅ Dismiss", callback_data=cb("dismiss_report_", r['id']))
         )
         bot.send_message(call.message.chat.id,
             f"🚨 <b>Report #{r['id']}</b>\n"
@@ -2000,14 +3614,13 @@ def show_reports(call):
             f"📅 তারিখ: {r['date']}", reply_markup=kb)
     bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda c: c.data.startswith("dismiss_report_"))
-def dismiss_report(call):
-    rid = call.data.split("_")[2]
+@callback_route("dismiss_report_", int)
+def dismiss_report(call, rid):
     db_query("UPDATE reports SET status='dismissed' WHERE id=?", (rid,))
     bot.answer_callback_query(call.id, "✅ Dismissed!", show_alert=True)
 
 # --- Payments ---
-@bot.callback_query_handler(func=lambda c: c.data == "adm_payments")
+@callback_route("adm_payments")
 def show_payments(call):
     payments = db_query("SELECT * FROM payment_requests WHERE status='pending' LIMIT 10", fetch=True)
     if not payments:
@@ -2018,8 +3631,8 @@ def show_payments(call):
         days = plans_days.get(p["plan"], "30")
         kb = types.InlineKeyboardMarkup()
         kb.row(
-            types.InlineKeyboardButton("✅ অনুমোদন", callback_data=f"apppay_{p['user_id']}_{days}_{p['plan']}"),
-            types.InlineKeyboardButton("❌ প্রত্যাখ্যান", callback_data=f"rejpay_{p['user_id']}")
+            types.InlineKeyboardButton("✅ অনুমোদন", callback_data=cb("apppay_", p['user_id'], days, p['plan'])),
+            types.InlineKeyboardButton("❌ প্রত্যাখ্যান", callback_data=cb("rejpay_", p['user_id']))
         )
         bot.send_message(call.message.chat.id,
             f"💳 <b>Payment Request</b>\n"
@@ -2037,11 +3650,26 @@ def unknown_message(msg):
     pass
 
 # ================= FLASK ERROR PAGES =================
+# Bodies are built once per message; only cached once the bot username is known
+_error_pages = {}   # (status, message) -> html
+
 def custom_404(message="পেজটি পাওয়া যায়নি"):
-    bot_username = ""
-    try:
-        bot_username = bot.get_me().username
-    except: pass
+    page = _error_pages.get((404, message))
+    if page is None:
+        page = render_404(message, bot_username())
+        if _bot_username:
+            _error_pages[(404, message)] = page
+    return page, 404
+
+def custom_403():
+    page = _error_pages.get((403, None))
+    if page is None:
+        page = render_403(bot_username())
+        if _bot_username:
+            _error_pages[(403, None)] = page
+    return page, 403
+
+def render_404(message, bot_username):
     return f"""<!DOCTYPE html>
 <html lang="bn">
 <head>
@@ -2067,13 +3695,9 @@ def custom_404(message="পেজটি পাওয়া যায়নি"):
   <a href="https://t.me/{bot_username}">🤖 বটে যান</a>
 </div>
 </body>
-</html>""", 404
+</html>"""
 
-def custom_403():
-    bot_username = ""
-    try:
-        bot_username = bot.get_me().username
-    except: pass
+def render_403(bot_username):
     return f"""<!DOCTYPE html>
 <html lang="bn">
 <head>
@@ -2097,9 +3721,13 @@ def custom_403():
   <a href="https://t.me/{bot_username}">🤖 বটে যান</a>
 </div>
 </body>
-</html>""", 403
+</html>"""
 
 def password_page(slug, error=False):
+    head, tail = _password_pages[error]
+    return head + slug + tail
+
+def render_password_page(slug, error):
     err_html = '<p style="color:#e05252;margin-bottom:12px">❌ ভুল পাসওয়ার্ড!</p>' if error else ''
     return f"""<!DOCTYPE html>
 <html lang="bn">
@@ -2133,8 +3761,11 @@ def password_page(slug, error=False):
 </body>
 </html>"""
 
+# Prebuilt halves around the slug
+_password_pages = {e: tuple(render_password_page("\0", e).split("\0")) for e in (False, True)}
+
 # ================= FLASK APP =================
-app.secret_key = os.getenv("FLASK_SECRET", secrets.token_hex(32))
+app.secret_key = os.getenv("FLASK_SECRET", hashlib.sha256(f"flask:{TOKEN}".encode()).hexdigest())
 
 @app.after_request
 def add_security_headers(response):
@@ -2142,20 +3773,21 @@ def add_security_headers(response):
     response.headers['X-Frame-Options'] = 'SAMEORIGIN'
     response.headers['X-XSS-Protection'] = '1; mode=block'
     response.headers['Referrer-Policy'] = 'no-referrer'
-    if response.content_type and any(ct in response.content_type for ct in ['image/', 'text/css', 'javascript']):
+    # Hosted files carry their own policy (see STATIC DELIVERY)
+    if 'Cache-Control' not in response.headers and response.content_type and any(ct in response.content_type for ct in ['image/', 'text/css', 'javascript']):
         response.headers['Cache-Control'] = 'public, max-age=3600'
     return response
 
 # ================= HOME PAGE =================
 @app.route('/')
 def home():
-    try:
-        username = bot.get_me().username
-    except:
-        username = "htmlhostbot"
+    return cached_page("home", HOME_TTL, render_home)
+
+def render_home():
+    username = bot_username() or "htmlhostbot"
     total_users = db_query("SELECT COUNT(*) as c FROM users", fetchone=True)["c"] or 0
     total_sites = db_query("SELECT COUNT(*) as c FROM files", fetchone=True)["c"] or 0
-    total_views = db_query("SELECT SUM(views) as c FROM files", fetchone=True)["c"] or 0
+    total_views = db_query("SELECT SUM(views) as c FROM user_stats", fetchone=True)["c"] or 0
     return f"""<!DOCTYPE html>
 <html lang="bn">
 <head>
@@ -2210,6 +3842,9 @@ footer{{text-align:center;padding:40px;color:#444;border-top:1px solid #1a1a2e}}
 # ================= USER PROFILE PAGE =================
 @app.route('/u/<int:uid>')
 def user_profile(uid):
+    return cached_page(("profile", uid), PROFILE_TTL, lambda: render_profile(uid))
+
+def render_profile(uid):
     u = db_query("SELECT username, joined_date FROM users WHERE id=?", (uid,), fetchone=True)
     if not u:
         return custom_404("ইউজার পাওয়া যায়নি")
@@ -2270,11 +3905,343 @@ def redirect_short(code):
     db_query("UPDATE short_urls SET clicks=clicks+1 WHERE code=?", (code,))
     return redirect(r['original_url'], 302)
 
+# ================= HOT FILE CACHE =================
+# Small hosted files kept in memory together with their response headers.
+# Dropped when the site changes, and re-checked against disk every few seconds.
+HOT_CACHE_BYTES = int(os.getenv("HOT_CACHE_MB", 64)) * 1024 * 1024
+HOT_FILE_MAX = 256 * 1024
+HOT_REVALIDATE = 5      # seconds between stat checks of a cached file
+
+_hot_cache = OrderedDict()      # (short_code, subpath, encodings) -> entry
+_hot_keys = {}                  # short_code -> set of keys
+_hot_gen = {}                   # short_code -> generation, bumped on invalidation
+_hot_bytes = 0
+_hot_stats = {"hits": 0, "misses": 0}
+_hot_lock = Lock()
+
+def hot_key(code, subpath):
+    # Encodings the client accepts are part of the key, since they pick the variant
+    return code, subpath, tuple(enc for enc, _ in ENCODINGS if request.accept_encodings[enc])
+
+def hot_generation(code):
+    with _hot_lock:
+        return _hot_gen.get(code, 0)
+
+def _hot_remove(key):
+    global _hot_bytes
+    e = _hot_cache.pop(key, None)
+    if e:
+        _hot_bytes -= len(e["body"])
+        keys = _hot_keys.get(key[0])
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del _hot_keys[key[0]]
+
+def hot_get(key):
+    with _hot_lock:
+        e = _hot_cache.get(key)
+        if e is None:
+            _hot_stats["misses"] += 1
+            return None
+        _hot_cache.move_to_end(key)
+        now = time.monotonic()
+        check = now - e["checked"] > HOT_REVALIDATE
+        if check:
+            e["checked"] = now
+    if check:
+        try:
+            st = os.stat(e["src"])
+            fresh = (st.st_mtime_ns, st.st_size) == e["sig"]
+        except OSError:
+            fresh = False
+        if not fresh:
+            with _hot_lock:
+                if _hot_cache.get(key) is e:
+                    _hot_remove(key)
+                _hot_stats["misses"] += 1
+            return None
+    with _hot_lock:
+        _hot_stats["hits"] += 1
+    return e
+
+def hot_put(key, gen, entry):
+    global _hot_bytes
+    with _hot_lock:
+        # Skip if the site changed while we were reading it
+        if _hot_gen.get(key[0], 0) != gen:
+            return
+        _hot_remove(key)
+        _hot_cache[key] = entry
+        _hot_keys.setdefault(key[0], set()).add(key)
+        _hot_bytes += len(entry["body"])
+        while _hot_bytes > HOT_CACHE_BYTES and _hot_cache:
+            _hot_remove(next(iter(_hot_cache)))
+
+def invalidate_hot(code):
+    with _hot_lock:
+        _hot_gen[code] = _hot_gen.get(code, 0) + 1
+        for key in list(_hot_keys.get(code, ())):
+            _hot_remove(key)
+
+def hot_response(e):
+    if not_modified(e["headers"]["ETag"], e["mtime"]):
+        return Response(status=304, headers=e["headers"])
+    return Response(e["body"], headers=e["headers"], mimetype=e["mimetype"])
+
+# ================= STATIC DELIVERY =================
+# HTML/JSON revalidate every time (cheap with ETag), assets are cached
+CACHE_POLICY = [
+    (("text/html", "application/json"), "public, no-cache"),
+    (("text/css", "javascript"), "public, max-age=3600"),
+    (("image/", "font/", "video/", "audio/", "application/pdf", "woff"), "public, max-age=86400"),
+]
+DEFAULT_CACHE_POLICY = "public, max-age=300"
+
+def cache_policy(mime_type, private=False):
+    if private:
+        return "private, no-cache"
+    for kinds, policy in CACHE_POLICY:
+        if mime_type and any(k in mime_type for k in kinds):
+            return policy
+    return DEFAULT_CACHE_POLICY
+
+def file_etag(st):
+    """size+mtime থেকে strong ETag"""
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+def last_modified(st):
+    # Site files are hardlinks into the blob store, so a new upload that
+    # dedups to an old blob has an old mtime. ctime moves forward on every
+    # link/rename, so Last-Modified never goes backwards for a path.
+    return max(st.st_mtime, st.st_ctime)
+
+def not_modified(etag, mtime):
+    # If-None-Match wins over If-Modified-Since (RFC 9110)
+    inm = request.headers.get("If-None-Match")
+    if inm:
+        return inm.strip() == "*" or etag in (t.strip().removeprefix("W/") for t in inm.split(","))
+    ims = request.if_modified_since
+    return bool(ims) and int(mtime) <= ims.timestamp()
+
+def send_site_file(path, mime_type, private=False, vpath=None, hot=None):
+    """vpath: precompressed variant এর base path (.gz/.br ছাড়া), hot: hot cache key"""
+    gen = hot_generation(hot[0]) if hot else 0
+    try:
+        st = os.stat(path)
+    except OSError:
+        return custom_404("ফাইলটি পাওয়া যায়নি")
+    src, sig = path, (st.st_mtime_ns, st.st_size)
+    etag = file_etag(st)
+    lm = last_modified(st)
+    headers = {
+        "Last-Modified": http_date(lm),
+        "Cache-Control": cache_policy(mime_type, private),
+    }
+    variant = None
+    if vpath and is_compressible(path):
+        headers["Vary"] = "Accept-Encoding"
+        variant = pick_variant(vpath, st)
+    if variant:
+        # Each encoding is a different representation, so a different ETag
+        enc, path, st = variant
+        etag = f'{etag[:-1]}-{enc}"'
+        headers["Content-Encoding"] = enc
+    headers["ETag"] = etag
+    if not_modified(etag, lm):
+        return Response(status=304, headers=headers)
+    if hot and st.st_size <= HOT_FILE_MAX and "Range" not in request.headers:
+        try:
+            with open(path, "rb") as f:
+                body = f.read()
+        except OSError:
+            return custom_404("ফাইলটি পাওয়া যায়নি")
+        headers["Accept-Ranges"] = "bytes"
+        entry = {"body": body, "headers": headers, "mimetype": mime_type or "application/octet-stream",
+                 "mtime": lm, "src": src, "sig": sig, "checked": time.monotonic()}
+        hot_put(hot, gen, entry)
+        return hot_response(entry)
+    return file_response(path, st.st_size, lm, mime_type or "application/octet-stream", etag, headers)
+
+def send_archive_member(index, name, private=False, hot=None):
+    """archive সাইটের একটা member — stored হলে সরাসরি, deflated হলে gzip হিসেবে বা খুলে"""
+    gen = hot_generation(hot[0]) if hot else 0
+    m = index["members"][name]
+    mime_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    mtime = index["mtime_ns"] / 1e9
+    etag = f'"{index["mtime_ns"]:x}-{m["offset"]:x}"'
+    headers = {
+        "Last-Modified": http_date(mtime),
+        "Cache-Control": cache_policy(mime_type, private),
+    }
+    if m["encrypted"]:
+        return custom_403()
+    if m["method"] == zipfile.ZIP_STORED:
+        mode = "stored"
+    elif m["method"] == zipfile.ZIP_DEFLATED:
+        headers["Vary"] = "Accept-Encoding"
+        mode = "gzip" if request.accept_encodings["gzip"] else "extract"
+    else:
+        mode = "extract"
+    if mode == "gzip":
+        etag = f'{etag[:-1]}-gzip"'
+        headers["Content-Encoding"] = "gzip"
+    headers["ETag"] = etag
+    if not_modified(etag, mtime):
+        return Response(status=304, headers=headers)
+    if mode == "stored":
+        if hot and m["size"] <= HOT_FILE_MAX and "Range" not in request.headers:
+            with open(index["path"], "rb") as f:
+                body = b"".join(iter_range(f, m["offset"], m["size"]))
+            return hot_store(hot, gen, body, headers, mime_type, mtime, index)
+        return file_response(index["path"], m["size"], mtime, mime_type, etag, headers, offset=m["offset"])
+    if mode == "gzip":
+        # Raw deflate data from the ZIP inside a gzip wrapper — no recompression
+        head = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+        tail = struct.pack("<II", m["crc"], m["size"] & 0xffffffff)
+        length = len(head) + m["csize"] + len(tail)
+        def body():
+            with open(index["path"], "rb") as f:
+                yield head
+                yield from iter_range(f, m["offset"], m["csize"])
+                yield tail
+    else:
+        length = m["size"]
+        def body():
+            with zipfile.ZipFile(index["path"]) as z, z.open(m["raw_name"]) as f:
+                while True:
+                    chunk = f.read(RANGE_CHUNK)
+                    if not chunk:
+                        break
+                    yield chunk
+    if hot and length <= HOT_FILE_MAX:
+        try:
+            data = b"".join(body())
+        except (RuntimeError, NotImplementedError, zipfile.BadZipFile):
+            return custom_403()
+        return hot_store(hot, gen, data, headers, mime_type, mtime, index)
+    response = Response(body(), headers=headers, mimetype=mime_type, direct_passthrough=True)
+    response.content_length = length
+    return response
+
+def hot_store(hot, gen, body, headers, mime_type, mtime, index):
+    headers["Accept-Ranges"] = "bytes"
+    entry = {"body": body, "headers": headers, "mimetype": mime_type, "mtime": mtime,
+             "src": index["path"], "sig": (index["mtime_ns"], index["size"]), "checked": time.monotonic()}
+    hot_put(hot, gen, entry)
+    return hot_response(entry)
+
+# --- Byte ranges ---
+# Single ranges and whole files go through wsgi.file_wrapper with a bounded
+# FileSegment, which gunicorn turns into os.sendfile; multi-range is chunked.
+RANGE_CHUNK = 64 * 1024
+MAX_RANGES = 16
+
+class FileSegment:
+    """ফাইলের একটা অংশ — fileno থাকায় gunicorn sendfile করে, অন্যরা read() দিয়ে পড়ে"""
+    def __init__(self, f, offset, length):
+        f.seek(offset)
+        self.f = f
+        self.remaining = length
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def read(self, n=-1):
+        n = self.remaining if n is None or n < 0 else min(n, self.remaining)
+        data = self.f.read(n) if n else b""
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+def parse_ranges(header, size):
+    """'bytes=0-99,-500' → [(start, end)] (end সহ); None = Range উপেক্ষা করো, [] = 416"""
+    if not header or not header.startswith("bytes="):
+        return None
+    ranges = []
+    for spec in header[6:].split(","):
+        first, sep, last = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if not first:
+                # Suffix range: last N bytes
+                n = int(last)
+                if n <= 0:
+                    continue
+                start, end = max(0, size - n), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if last and end < start:
+                    return None
+                end = min(end, size - 1)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+def if_range_ok(etag, mtime):
+    value = request.headers.get("If-Range")
+    if not value:
+        return True
+    if value.startswith(('"', 'W/')):
+        return value == etag
+    date = parse_date(value)
+    return bool(date) and int(date.timestamp()) == int(mtime)
+
+def iter_range(f, start, length):
+    f.seek(start)
+    while length > 0:
+        chunk = f.read(min(RANGE_CHUNK, length))
+        if not chunk:
+            break
+        length -= len(chunk)
+        yield chunk
+
+def file_response(path, size, mtime, mimetype, etag, headers, offset=0):
+    """path এর offset থেকে size byte (archive member হলে offset > 0)"""
+    headers["Accept-Ranges"] = "bytes"
+    ranges = parse_ranges(request.headers.get("Range"), size) if if_range_ok(etag, mtime) else None
+    if ranges == []:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+    f = open(path, "rb")
+    if not ranges:
+        body, status, length = wrap_file(request.environ, FileSegment(f, offset, size)), 200, size
+    elif len(ranges) == 1:
+        start, end = ranges[0]
+        length, status = end - start + 1, 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        body = wrap_file(request.environ, FileSegment(f, offset + start, length))
+    else:
+        boundary = secrets.token_hex(16)
+        part_type = get_content_type(mimetype, "utf-8")
+        parts = [(f"\r\n--{boundary}\r\nContent-Type: {part_type}\r\nContent-Range: bytes {s}-{e}/{size}\r\n\r\n".encode(), s, e)
+                 for s, e in ranges]
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        length, status = sum(len(h) + e - s + 1 for h, s, e in parts) + len(tail), 206
+        mimetype = f"multipart/byteranges; boundary={boundary}"
+        def body():
+            with f:
+                for h, s, e in parts:
+                    yield h
+                    yield from iter_range(f, offset + s, e - s + 1)
+                yield tail
+        body = body()
+    response = Response(body, status=status, headers=headers, mimetype=mimetype, direct_passthrough=True)
+    response.content_length = length
+    return response
+
 # ================= SITE SERVER =================
 @app.route('/v/<slug>/auth', methods=['POST'])
 def auth_site(slug):
-    res = db_query("SELECT short_code, password FROM files WHERE custom_slug=? OR short_code=?",
-                   (slug, slug), fetchone=True)
+    res = resolve_site(slug)
     if not res:
         return custom_404()
     pw_input = request.form.get('pw', '')
@@ -2289,16 +4256,13 @@ def serve_site(slug, subpath=""):
     ip = request.remote_addr
     ua = request.headers.get('User-Agent', '')
 
-    res = db_query(
-        "SELECT user_id, type, short_code, password, expiry, views, name FROM files WHERE custom_slug=? OR short_code=?",
-        (slug, slug), fetchone=True
-    )
+    res = resolve_site(slug)
     if not res:
         return custom_404()
 
     # Expiry check
     if res["expiry"] and datetime.fromisoformat(res["expiry"]) < datetime.now():
-        db_query("DELETE FROM files WHERE short_code=?", (res["short_code"],))
+        purge_sites([(res["short_code"], res["user_id"])])
         return custom_404("এই সাইটের মেয়াদ শেষ হয়ে গেছে")
 
     # Password check
@@ -2306,56 +4270,47 @@ def serve_site(slug, subpath=""):
         if not session.get(f'auth_{res["short_code"]}'):
             return password_page(slug)
 
-    folder = os.path.join(UPLOAD_DIR, str(res["user_id"]), res["short_code"])
-    if not os.path.exists(folder):
-        return custom_404()
-
-    # Determine actual path
-    if res["type"] == "html" or res["type"] == "media":
-        actual_path = subpath if subpath else "index.html"
-    else:
-        actual_path = subpath if subpath else ""
-
-    # Path traversal protection
-    if actual_path:
-        full_path = os.path.realpath(os.path.join(folder, actual_path))
-        if not full_path.startswith(os.path.realpath(folder)):
-            return custom_403()
-    else:
-        full_path = os.path.realpath(folder)
-
-    # Directory handling
-    if os.path.isdir(full_path):
-        index_path = os.path.join(full_path, 'index.html')
-        if os.path.exists(index_path):
-            actual_path = (actual_path + '/index.html').lstrip('/')
-            full_path = index_path
-        else:
-            # ZIP Auto-index
-            try:
-                listing = make_dir_listing_html(folder, slug, actual_path)
-                return listing, 200
-            except:
-                return custom_404("এই ফোল্ডারে index.html নেই")
-    elif not os.path.exists(full_path):
-        # Try as index.html
-        idx = os.path.join(full_path if not actual_path else os.path.join(folder, actual_path), 'index.html')
-        if not os.path.exists(idx):
-            return custom_404(f"ফাইলটি পাওয়া যায়নি")
-        actual_path = (actual_path + '/index.html').lstrip('/')
-
-    # View count
     country = request.headers.get("CF-IPCountry", "Unknown")
-    db_query("UPDATE files SET views=views+1, last_view=? WHERE short_code=?",
-             (datetime.now().strftime("%Y-%m-%d %H:%M"), res["short_code"]))
-    db_query("INSERT INTO site_views(short_code,ip,country,viewed_at,user_agent) VALUES(?,?,?,?,?)",
-             (res["short_code"], ip, country, datetime.now().strftime("%Y-%m-%d %H:%M"), ua[:200]))
-
-    mime_type, _ = mimetypes.guess_type(actual_path or "index.html")
-    response = make_response(send_from_directory(folder, actual_path or "index.html"))
-    if mime_type:
-        response.headers['Content-Type'] = mime_type
-    return response
+    hot = hot_key(res["short_code"], subpath)
+    if "Range" not in request.headers:
+        cached = hot_get(hot)
+        if cached:
+            record_view(res["short_code"], ip, country, ua)
+            return hot_response(cached)
+
+    if res["storage"] == "archive":
+        try:
+            index = get_zip_index(archive_path(res["user_id"], res["short_code"]))
+        except (OSError, zipfile.BadZipFile):
+            return custom_404()
+        kind, name = archive_lookup(index, subpath)
+        if kind == "bad":
+            return custom_403()
+        if kind == "dir":
+            return make_dir_listing_html(slug, name, index), 200
+        if not kind:
+            return custom_404("ফাইলটি পাওয়া যায়নি")
+        record_view(res["short_code"], ip, country, ua)
+        return send_archive_member(index, name, private=bool(res["password"]), hot=hot)
+
+    # Directory sites resolve against the in-memory manifest (see SITE MANIFEST)
+    index = load_manifest(res["short_code"], res["user_id"])
+    if not subpath and res["type"] in ("html", "media"):
+        subpath = "index.html"
+    kind, name = archive_lookup(index, subpath)
+    if kind == "bad":
+        return custom_403()
+    if kind == "dir":
+        return make_dir_listing_html(slug, name, index), 200
+    if not kind:
+        return custom_404("ফাইলটি পাওয়া যায়নি")
+
+    # View count (write-behind, see VIEW COUNTER)
+    record_view(res["short_code"], ip, country, ua)
+
+    return send_site_file(os.path.join(UPLOAD_DIR, str(res["user_id"]), res["short_code"], name),
+                          index["members"][name]["mime"], private=bool(res["password"]),
+                          vpath=variant_path(res["user_id"], res["short_code"], name), hot=hot)
 
 # ================= ADMIN WEB PANEL =================
 @app.route('/admin')
@@ -2371,13 +4326,14 @@ def admin_web():
 
     total_users = db_query("SELECT COUNT(*) as c FROM users", fetchone=True)["c"] or 0
     total_sites = db_query("SELECT COUNT(*) as c FROM files", fetchone=True)["c"] or 0
-    total_views = db_query("SELECT SUM(views) as c FROM files", fetchone=True)["c"] or 0
+    total_views = db_query("SELECT SUM(views) as c FROM user_stats", fetchone=True)["c"] or 0
     premium_count = db_query("SELECT COUNT(*) as c FROM premium", fetchone=True)["c"] or 0
     storage = format_bytes(get_storage_used())
     pending_pay = db_query("SELECT COUNT(*) as c FROM payment_requests WHERE status='pending'", fetchone=True)["c"] or 0
     pending_rep = db_query("SELECT COUNT(*) as c FROM reports WHERE status='pending'", fetchone=True)["c"] or 0
     top_sites = db_query("SELECT name, views, short_code FROM files ORDER BY views DESC LIMIT 10", fetch=True) or []
     top_rows = "".join(f"<tr><td>{i+1}</td><td>{s['name'][:30]}</td><td>{s['views']}</td><td><a href='/v/{s['short_code']}' target='_blank'>🔗</a></td></tr>" for i, s in enumerate(top_sites))
+    side_pending, side_dead = side_job_counts()
 
     return f"""<!DOCTYPE html>
 <html lang="bn">
@@ -2409,6 +4365,8 @@ a{{color:#7c7cff}}
   <div class="card"><div class="num">{storage}</div><div class="label">💾 Storage</div></div>
   <div class="card"><div class="num">{pending_pay}</div><div class="label">💳 Payments</div></div>
   <div class="card"><div class="num">{pending_rep}</div><div class="label">🚨 Reports</div></div>
+  <div class="card"><div class="num">{update_queue_depth()}</div><div class="label">📥 Update queue</div></div>
+  <div class="card"><div class="num">{side_pending} / {side_dead}</div><div class="label">📮 Side jobs / dead</div></div>
 </div>
 <h2 style="margin-bottom:12px;font-size:18px">🏆 Top Sites</h2>
 <table>
@@ -2418,15 +4376,249 @@ a{{color:#7c7cff}}
 </body>
 </html>"""
 
+# ================= UPDATE QUEUE =================
+# Every web worker only validates a webhook update and stores it in
+# webhook_updates (update_id is the primary key, so a redelivery is a no-op
+# in any process). The one process running run_bot reads them back in
+# update_id order and hands them to UPDATE_WORKERS threads, sharded by chat,
+# so each chat is handled in order however many web workers there are.
+# A row is marked taken when queued and deleted once handled; rows taken
+# but not handled before a restart are handled again.
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 2000))   # in memory, split across workers
+UPDATE_POLL_INTERVAL = 0.2  # seconds; how fast updates stored by other processes are seen
+UPDATE_BATCH = 500
+UPDATE_DRAIN_TIMEOUT = int(os.getenv("UPDATE_DRAIN_TIMEOUT", 30))
+
+_update_queues = []
+_update_lock = Lock()
+_update_stats = {"received": 0, "handled": 0, "rejected": 0, "duplicates": 0, "errors": 0}
+_update_done = []           # handled update_ids, deleted from webhook_updates in batches
+_update_wakeup = Event()
+_update_accepting = True
+
+def update_chat_id(update):
+    msg = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+    if msg:
+        return msg.chat.id
+    cq = update.callback_query
+    if cq:
+        return cq.message.chat.id if cq.message else cq.from_user.id
+    for name in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query",
+                 "my_chat_member", "chat_member", "chat_join_request"):
+        user = getattr(getattr(update, name, None), "from_user", None)
+        if user:
+            return user.id
+    return update.update_id
+
+def update_worker(q):
+    while True:
+        update = q.get()
+        try:
+            bot.process_new_updates([update])
+        except Exception as e:
+            logger.error(f"Update {update.update_id} error: {e}")
+            with _update_lock:
+                _update_stats["errors"] += 1
+        finally:
+            with _update_lock:
+                _update_stats["handled"] += 1
+                _update_done.append(update.update_id)
+            q.task_done()
+
+def start_update_workers():
+    with _update_lock:
+        if _update_queues:
+            return
+        size = max(1, UPDATE_QUEUE_SIZE // UPDATE_WORKERS)
+        for i in range(UPDATE_WORKERS):
+            q = queue.Queue(maxsize=size)
+            _update_queues.append(q)
+            Thread(target=update_worker, args=(q,), name=f"update-{i}", daemon=True).start()
+
+def store_update(update_id, body):
+    """webhook থেকে — True: নতুন, False: আগেই এসেছিল, None: DB error"""
+    try:
+        with db_tx() as con:
+            fresh = con.execute("INSERT OR IGNORE INTO webhook_updates(update_id, body, received) VALUES(?,?,?)",
+                                (update_id, body, time.time())).rowcount > 0
+    except sqlite3.Error as e:
+        logger.error(f"Store update error: {e}")
+        with _update_lock:
+            _update_stats["rejected"] += 1
+        return None
+    with _update_lock:
+        _update_stats["received" if fresh else "duplicates"] += 1
+    _update_wakeup.set()
+    return fresh
+
+def enqueue_update(update):
+    start_update_workers()
+    # Blocks while the chat's worker is full; the rest waits in webhook_updates
+    _update_queues[hash(update_chat_id(update)) % len(_update_queues)].put(update)
+
+def forget_handled_updates():
+    with _update_lock:
+        done = _update_done[:]
+        del _update_done[:]
+    if done:
+        db_query("DELETE FROM webhook_updates WHERE update_id IN (%s)" % ",".join("?" * len(done)), done)
+
+def update_consumer():
+    """শুধু run_bot এর process এ — webhook_updates থেকে ক্রমানুসারে worker দের কাছে"""
+    start_update_workers()
+    # Taken but never handled before the last stop
+    db_query("UPDATE webhook_updates SET taken=0 WHERE taken=1")
+    while _update_accepting:
+        _update_wakeup.clear()
+        try:
+            forget_handled_updates()
+            rows = db_query("SELECT update_id, body FROM webhook_updates WHERE taken=0 ORDER BY update_id LIMIT ?",
+                            (UPDATE_BATCH,), fetch=True) or []
+            if rows:
+                db_query("UPDATE webhook_updates SET taken=1 WHERE update_id IN (%s)" % ",".join("?" * len(rows)),
+                         [r["update_id"] for r in rows])
+        except Exception as e:
+            logger.error(f"Update consumer: {e}")
+            rows = []
+        for r in rows:
+            try:
+                update = telebot.types.Update.de_json(r["body"])
+            except Exception as e:
+                logger.error(f"Bad stored update {r['update_id']}: {e}")
+                with _update_lock:
+                    _update_done.append(r["update_id"])
+                continue
+            enqueue_update(update)
+        if not rows:
+            _update_wakeup.wait(UPDATE_POLL_INTERVAL)
+
+def update_queue_depth():
+    depth = sum(q.qsize() for q in _update_queues) + _async_backlog[0]
+    if USE_WEBHOOK and WEBHOOK_URL:
+        # Stored but not handled yet, also counts what the workers hold
+        r = db_query("SELECT COUNT(*) as c FROM webhook_updates", fetchone=True)
+        depth = r["c"] if r else depth
+    return depth
+
+def drain_updates():
+    """shutdown: নতুন update নেওয়া বন্ধ, যা queue তে আছে তা শেষ হতে দাও"""
+    global _update_accepting
+    _update_accepting = False
+    deadline = time.monotonic() + UPDATE_DRAIN_TIMEOUT
+    while any(q.unfinished_tasks for q in _update_queues) and time.monotonic() < deadline:
+        time.sleep(0.1)
+    forget_handled_updates()
+    left = sum(q.qsize() for q in _update_queues)
+    if left:
+        logger.error(f"Update drain timed out, {left} updates left for the next start")
+
+atexit.register(drain_updates)
+
+# ================= ASYNC RUNTIME =================
+# BOT_RUNTIME=async only moves update *fetching* onto asyncio: AsyncTeleBot
+# long-polls over aiohttp and each chat with pending updates gets a small
+# deque, so waiting chats cost no threads. Handlers are unchanged: they run
+# on a pool of UPDATE_WORKERS threads, one update per chat at a time, and
+# make their Bot API calls (replies, downloads) through the synchronous
+# api_session. A slow Telegram call still holds a thread, so handler
+# concurrency is capped by UPDATE_WORKERS exactly as with threaded polling.
+_async_backlog = [0]        # updates received but not handled yet
+
+async def async_polling():
+    from telebot.async_telebot import AsyncTeleBot
+    from telebot import asyncio_helper
+    asyncio_helper.REQUEST_LIMIT = BOT_API_POOL
+    abot = AsyncTeleBot(TOKEN)
+    loop = asyncio.get_running_loop()
+    pool = ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix="update")
+    room = asyncio.Semaphore(UPDATE_QUEUE_SIZE)
+    stop = asyncio.Event()
+    chats = {}                  # chat id -> deque of updates, present while its task runs
+    tasks = set()
+    import signal
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async def run_chat(chat_id):
+        pending = chats[chat_id]
+        while pending:
+            update = pending.popleft()
+            try:
+                await loop.run_in_executor(pool, bot.process_new_updates, [update])
+            except Exception as e:
+                logger.error(f"Update {update.update_id} error: {e}")
+                _update_stats["errors"] += 1
+            finally:
+                _update_stats["handled"] += 1
+                _async_backlog[0] -= 1
+                room.release()
+        del chats[chat_id]
+
+    logger.info("Bot is polling (async runtime)...")
+    offset = None
+    stopping = asyncio.ensure_future(stop.wait())
+    while not stop.is_set():
+        poll = asyncio.ensure_future(abot.get_updates(offset=offset, timeout=60, request_timeout=75))
+        await asyncio.wait({poll, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        if stop.is_set():
+            # Unconfirmed updates are delivered again on the next start
+            poll.cancel()
+            break
+        try:
+            updates = poll.result()
+        except Exception as e:
+            logger.error(f"getUpdates error: {e}")
+            await asyncio.sleep(3)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            # Back-pressure: stop fetching while UPDATE_QUEUE_SIZE updates are pending
+            await room.acquire()
+            _update_stats["received"] += 1
+            _async_backlog[0] += 1
+            chat_id = update_chat_id(update)
+            if chat_id in chats:
+                chats[chat_id].append(update)
+            else:
+                chats[chat_id] = deque([update])
+                task = asyncio.create_task(run_chat(chat_id))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks, timeout=UPDATE_DRAIN_TIMEOUT)
+    if _async_backlog[0]:
+        logger.error(f"Update drain timed out, {_async_backlog[0]} updates dropped")
+    pool.shutdown(wait=False)
+    try:
+        if offset:
+            # Confirm what we handled so it is not delivered again
+            await abot.get_updates(offset=offset, timeout=0)
+        await abot.close_session()
+    except Exception as e:
+        logger.error(f"Async shutdown: {e}")
+
 # ================= WEBHOOK =================
 @app.route(f'/webhook/{WEBHOOK_SECRET}', methods=['POST'])
 def webhook():
-    if request.headers.get('content-type') == 'application/json':
-        json_str = request.get_data().decode('UTF-8')
-        update = telebot.types.Update.de_json(json_str)
-        bot.process_new_updates([update])
-        return '', 200
-    return 'Bad request', 400
+    if request.headers.get('content-type') != 'application/json':
+        return 'Bad request', 400
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token')
+    if token is not None and token != WEBHOOK_SECRET:
+        return 'Forbidden', 403
+    if not _update_accepting:
+        return 'Shutting down', 503
+    body = request.get_data().decode('UTF-8')
+    try:
+        update_id = json.loads(body)["update_id"]
+    except Exception:
+        return 'Bad request', 400
+    if not isinstance(update_id, int):
+        return 'Bad request', 400
+    if store_update(update_id, body) is None:
+        # Non-2xx makes Telegram retry later
+        return 'Busy', 503
+    return '', 200
 
 @app.errorhandler(404)
 def not_found(e): return custom_404()
@@ -2438,50 +4630,162 @@ def forbidden(e): return custom_403()
 def too_many(e): return "⛔ Too many requests.", 429
 
 # ================= BACKGROUND TASKS =================
+# Expiry times are ISO strings, so they compare correctly as text in SQL
+EXPIRY_BATCH = 500
+EXPIRY_MAX_SLEEP = 3600     # seconds; upper bound in case a wakeup from another process is missed
+EXPIRY_MIN_SLEEP = 5        # a due row that could not be purged must not turn into a busy loop
+PREMIUM_REMIND_DAYS = 3
+
+_expiry_wakeup = Event()
+
+def schedule_expiry_check():
+    # The checker may live in the worker process (see CACHE SYNC)
+    _expiry_wakeup.set()
+    publish_invalidation("expiry", None)
+
+def expire_due_sites():
+    now = datetime.now().isoformat()
+    total = 0
+    while True:
+        rows = db_query("SELECT short_code, user_id FROM files WHERE expiry IS NOT NULL AND expiry <= ? ORDER BY expiry LIMIT ?",
+                        (now, EXPIRY_BATCH), fetch=True) or []
+        deleted = purge_sites((r["short_code"], r["user_id"]) for r in rows)
+        total += deleted
+        if not deleted or len(rows) < EXPIRY_BATCH:
+            return total
+
+def send_premium_reminders():
+    now = datetime.now()
+    due = db_query(
+        "SELECT user_id, expiry FROM premium p WHERE expiry > ? AND expiry <= ? "
+        "AND NOT EXISTS(SELECT 1 FROM expiry_notices n WHERE n.user_id=p.user_id AND n.expiry=p.expiry)",
+        (now.isoformat(), (now + timedelta(days=PREMIUM_REMIND_DAYS)).isoformat()), fetch=True) or []
+    for p in due:
+        exp = datetime.fromisoformat(p["expiry"])
+        # Once per premium period, even if delivery failed; recorded first so
+        # only the process whose insert wins sends it
+        with db_tx() as con:
+            if not con.execute("INSERT OR IGNORE INTO expiry_notices VALUES(?,?,?)",
+                               (p["user_id"], p["expiry"], now.isoformat())).rowcount:
+                continue
+        try:
+            bot.send_message(p["user_id"], f"⚠️ আপনার Premium {(exp - now).days + 1} দিন পরে শেষ হবে!")
+        except: pass
+    db_query("DELETE FROM expiry_notices WHERE expiry < ?", ((now - timedelta(days=30)).isoformat(),))
+
+def next_expiry_wait():
+    now = datetime.now()
+    due = [now + timedelta(seconds=EXPIRY_MAX_SLEEP)]
+    r = db_query("SELECT MIN(expiry) as e FROM files WHERE expiry IS NOT NULL", fetchone=True)
+    if r and r["e"]:
+        due.append(datetime.fromisoformat(r["e"]))
+    r = db_query("SELECT MIN(expiry) as e FROM premium p WHERE expiry > ? "
+                 "AND NOT EXISTS(SELECT 1 FROM expiry_notices n WHERE n.user_id=p.user_id AND n.expiry=p.expiry)",
+                 (now.isoformat(),), fetchone=True)
+    if r and r["e"]:
+        due.append(datetime.fromisoformat(r["e"]) - timedelta(days=PREMIUM_REMIND_DAYS))
+    return max(EXPIRY_MIN_SLEEP, (min(due) - now).total_seconds())
+
 def expiry_checker():
+    # Sleeps until the next site expiry / premium reminder instead of polling hourly
     while True:
+        _expiry_wakeup.clear()
         try:
-            # Site expiry
-            files = db_query("SELECT short_code, user_id, expiry FROM files WHERE expiry IS NOT NULL", fetch=True)
-            for f in (files or []):
-                if datetime.fromisoformat(f["expiry"]) < datetime.now():
-                    db_query("DELETE FROM files WHERE short_code=?", (f["short_code"],))
-                    db_query("DELETE FROM site_views WHERE short_code=?", (f["short_code"],))
-                    try:
-                        shutil.rmtree(os.path.join(UPLOAD_DIR, str(f["user_id"]), f["short_code"]))
-                    except: pass
-
-            # Premium expiry notification
-            prems = db_query("SELECT user_id, expiry FROM premium", fetch=True)
-            for p in (prems or []):
-                exp = datetime.fromisoformat(p["expiry"])
-                if timedelta(days=0) < (exp - datetime.now()) < timedelta(days=3):
-                    try:
-                        bot.send_message(p["user_id"], f"⚠️ আপনার Premium {(exp - datetime.now()).days + 1} দিন পরে শেষ হবে!")
-                    except: pass
+            expire_due_sites()
+            send_premium_reminders()
+            wait = next_expiry_wait()
         except Exception as e:
             logger.error(f"Expiry checker: {e}")
-        time.sleep(3600)
+            wait = 60
+        _expiry_wakeup.wait(wait)
 
 def run_flask():
+    # Development server; production runs `gunicorn -c gunicorn.conf.py wsgi:app`
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 10000)))
 
-# ================= MAIN =================
-if __name__ == "__main__":
-    Thread(target=run_flask, daemon=True).start()
+# ================= PROCESS ROLES =================
+# ROLE=all (default): one process runs everything, as before.
+# ROLE=web: site server only, started by gunicorn through wsgi.py; several workers.
+# ROLE=bot: polling (or registers the webhook), plus the background tasks
+#   unless RUN_WORKER_TASKS=0.
+# ROLE=worker: background tasks only; run the bot with RUN_WORKER_TASKS=0
+#   next to it so they do not run twice.
+# In webhook mode the web processes store updates and the bot process handles
+# them (see UPDATE QUEUE).
+_web_started = False
+_web_lock = Lock()
+
+def start_web_tasks():
+    # Views are buffered in the process that serves the site
+    Thread(target=view_flusher, daemon=True).start()
+    start_cache_sync()
+
+def start_background_tasks():
     Thread(target=expiry_checker, daemon=True).start()
-
+    Thread(target=storage_reconciler, daemon=True).start()
+    Thread(target=conversation_janitor, daemon=True).start()
+    start_side_workers()
+    Thread(target=lambda: (ingest_all_sites(), build_all_variants()), daemon=True).start()
+    Thread(target=broadcast_resumer, daemon=True).start()
+    start_cache_sync()
+
+def create_app():
+    """WSGI application factory — once per gunicorn worker (preload_app off)"""
+    global _web_started
+    with _web_lock:
+        if not _web_started:
+            _web_started = True
+            start_web_tasks()
+    return app
+
+def install_shutdown_handlers():
+    # SIGTERM (docker stop / systemctl) would otherwise kill the process
+    # without atexit: buffered views, bot_logs rows and queued updates lost.
+    # SystemExit unwinds the main loop and the atexit hooks flush them.
+    import signal
+    def shutdown(signum, frame):
+        logger.info(f"Signal {signum}, shutting down")
+        bot.stop_polling()
+        sys.exit(0)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, shutdown)
+
+def run_bot():
     if USE_WEBHOOK and WEBHOOK_URL:
         # Webhook mode
         webhook_full_url = f"{WEBHOOK_URL}/webhook/{WEBHOOK_SECRET}"
         bot.remove_webhook()
         time.sleep(1)
-        bot.set_webhook(url=webhook_full_url)
+        bot.set_webhook(url=webhook_full_url, secret_token=WEBHOOK_SECRET)
         logger.info(f"Webhook set: {webhook_full_url}")
-        # Flask serves webhook, keep main thread alive
-        import signal
-        signal.pause()
+        # Web workers store the updates, this process handles them
+        update_consumer()
+    elif BOT_RUNTIME == "async":
+        asyncio.run(async_polling())
     else:
         # Polling mode
         logger.info("Bot is polling...")
         bot.infinity_polling(timeout=60, long_polling_timeout=60)
+
+# ================= MAIN =================
+if __name__ == "__main__":
+    ROLE = sys.argv[1] if len(sys.argv) > 1 else ROLE
+    if ROLE not in ("all", "web", "bot", "worker"):
+        sys.exit(f"Unknown role: {ROLE} (all | web | bot | worker)")
+    install_shutdown_handlers()
+    bot_username()
+    if ROLE == "web":
+        create_app()
+        run_flask()
+    elif ROLE == "worker":
+        start_background_tasks()
+        Event().wait()
+    else:
+        if ROLE == "all":
+            create_app()
+            Thread(target=run_flask, daemon=True).start()
+        if ROLE == "all" or RUN_WORKER_TASKS:
+            start_background_tasks()
+        # The bot keeps caches too, even when the worker runs the background tasks
+        start_cache_sync()
+        run_bot()
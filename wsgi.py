@@ -0,0 +1,13 @@
+# Site server entry point:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+# Run the bot and background tasks separately with `python main.py bot`.
+# To move the background tasks out of the bot process, run
+# `python main.py worker` and start the bot with RUN_WORKER_TASKS=0 —
+# never both with the default, or every background loop runs twice.
+import os
+
+os.environ.setdefault("ROLE", "web")
+
+from main import create_app
+
+app = create_app()